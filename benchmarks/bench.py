@@ -0,0 +1,476 @@
+"""
+Throughput and latency benchmarks for the tinydist server and CLI.
+
+Starts a real server in a temporary directory and measures uploads (single
+requests, the legacy `/upload_chunk` route and upload sessions across chunk
+sizes and concurrency levels), `/get` of plain files and `_chunks`
+directories, `/metadata` latency as the table grows, and
+`calculate_checksum`. Results are written as JSON, one record per
+benchmark keyed by a stable name, so runs can be compared between commits:
+
+    python benchmarks/bench.py --output before.json
+    python benchmarks/bench.py --output after.json --compare before.json
+"""
+
+import base64
+import contextlib
+import importlib
+import io
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import click
+import requests
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+# Looked up once the path above is set, like the CLI module. The package
+# exports the click group as `cli`, shadowing the module.
+cli = importlib.import_module("tinydist.cli")
+connect = importlib.import_module("tinydist.store").connect
+calculate_checksum = importlib.import_module("tinydist.utils").calculate_checksum
+
+MB = 1024 * 1024
+AUTH_TOKEN = "bench-secret"
+SECTIONS = ("checksum", "upload", "get", "metadata")
+
+# Full runs take several minutes, mostly seeding a million metadata rows.
+FULL = {
+    "checksum_mb": 256,
+    "single_mb": 4,
+    "chunked_mb": 128,
+    "chunk_sizes_mb": (1, 5, 16),
+    "concurrency": (1, 4, 8),
+    "get_mb": 128,
+    "metadata_rows": (10_000, 100_000, 1_000_000),
+    "metadata_requests": 200,
+    "repeats": 3,
+}
+QUICK = {
+    "checksum_mb": 32,
+    "single_mb": 1,
+    "chunked_mb": 16,
+    "chunk_sizes_mb": (1, 5),
+    "concurrency": (1, 4),
+    "get_mb": 16,
+    "metadata_rows": (10_000, 100_000),
+    "metadata_requests": 50,
+    "repeats": 1,
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class Server:
+    """A tinydist server process with its own files/ directory and database."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.database = os.path.join(directory, "metadata.db")
+        self.url = f"http://127.0.0.1:{free_port()}/"
+        self.process = None
+
+    def __enter__(self):
+        os.makedirs(os.path.join(self.directory, "files"), exist_ok=True)
+        port = int(self.url.rstrip("/").rsplit(":", 1)[1])
+        env = dict(
+            os.environ,
+            AUTH_TOKEN=AUTH_TOKEN,
+            DATABASE_NAME=self.database,
+            PYTHONPATH=REPO_ROOT,
+            ANTI_ENTROPY_INTERVAL="0",
+        )
+        for name in ("CLUSTER_NODES", "NODE_URL", "DISK_QUOTA_MB"):
+            env.pop(name, None)
+        self.process = subprocess.Popen(
+            [
+                sys.executable,
+                "-c",
+                "from tinydist.server import create_app; "
+                f"create_app().run(port={port}, threaded=True)",
+            ],
+            cwd=self.directory,
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            try:
+                requests.get(f"{self.url}ring", timeout=1)
+                return self
+            except requests.ConnectionError:
+                time.sleep(0.1)
+        self.__exit__()
+        raise RuntimeError(f"Server at {self.url} did not start")
+
+    def __exit__(self, *exc_info):
+        self.process.terminate()
+        self.process.wait()
+
+
+def write_random_file(path, size):
+    """A file of `size` incompressible bytes, written in 1 MB blocks."""
+    block = os.urandom(MB)
+    with open(path, "wb") as f:
+        f.writelines(block[: min(MB, size - offset)] for offset in range(0, size, MB))
+    return path
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def latency_summary(samples):
+    """p50/p99/mean/max of `samples` (seconds), in milliseconds."""
+    return {
+        "p50_ms": percentile(samples, 0.5) * 1000,
+        "p99_ms": percentile(samples, 0.99) * 1000,
+        "mean_ms": sum(samples) / len(samples) * 1000,
+        "max_ms": max(samples) * 1000,
+        "requests": len(samples),
+    }
+
+
+def throughput(name, size, durations, **params):
+    """Record of the best of `durations` moving `size` bytes, in MB/s."""
+    return dict(
+        name=name,
+        metric="MB/s",
+        value=size / MB / min(durations),
+        median_s=sorted(durations)[len(durations) // 2],
+        bytes=size,
+        repeats=len(durations),
+        **params,
+    )
+
+
+def timed(function, *args, **kwargs):
+    started = time.perf_counter()
+    function(*args, **kwargs)
+    return time.perf_counter() - started
+
+
+@contextlib.contextmanager
+def quiet():
+    """Keep CLI progress bars and messages out of the benchmark output."""
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(
+        io.StringIO()
+    ):
+        yield
+
+
+def bench_checksum(workdir, size_mb, repeats):
+    path = write_random_file(os.path.join(workdir, "checksum.bin"), size_mb * MB)
+    durations = [timed(calculate_checksum, path) for _ in range(repeats)]
+    os.remove(path)
+    return [throughput("checksum/calculate_checksum", size_mb * MB, durations)]
+
+
+def legacy_chunked_upload(session, server, path, chunk_size):
+    """Upload `path` the way older clients do, one `/upload_chunk` at a time."""
+    size = os.path.getsize(path)
+    total_chunks = -(-size // chunk_size)
+    filename = os.path.basename(path)
+    with open(path, "rb") as f:
+        for index in range(total_chunks):
+            response = session.post(
+                f"{server.url}upload_chunk",
+                files={"file": (filename, f.read(chunk_size))},
+                data={
+                    "filename": filename,
+                    "chunkIndex": index,
+                    "totalChunks": total_chunks,
+                    "category": "bench",
+                },
+                headers={"Authorization": AUTH_TOKEN},
+            )
+            response.raise_for_status()
+
+
+def bench_uploads(server, workdir, config):
+    results = []
+    repeats = config["repeats"]
+
+    single = write_random_file(
+        os.path.join(workdir, "single.bin"), config["single_mb"] * MB
+    )
+    session = cli.make_session()
+    durations = [
+        timed(
+            cli.upload_file,
+            single,
+            "bench",
+            chunk_size=2 * config["single_mb"] * MB,
+            session=session,
+            server_url=server.url,
+        )
+        for _ in range(repeats)
+    ]
+    results.append(throughput("upload/single", config["single_mb"] * MB, durations))
+
+    size = config["chunked_mb"] * MB
+    chunked = write_random_file(os.path.join(workdir, "chunked.bin"), size)
+    for chunk_mb in config["chunk_sizes_mb"]:
+        durations = [
+            timed(legacy_chunked_upload, session, server, chunked, chunk_mb * MB)
+            for _ in range(repeats)
+        ]
+        results.append(
+            throughput(
+                f"upload/upload_chunk/chunk={chunk_mb}MB",
+                size,
+                durations,
+                chunk_mb=chunk_mb,
+            )
+        )
+        for concurrency in config["concurrency"]:
+            pooled = cli.make_session(concurrency)
+            durations = [
+                timed(
+                    cli.upload_file,
+                    chunked,
+                    "bench",
+                    chunk_size=chunk_mb * MB,
+                    concurrency=concurrency,
+                    session=pooled,
+                    server_url=server.url,
+                )
+                for _ in range(repeats)
+            ]
+            results.append(
+                throughput(
+                    f"upload/session/chunk={chunk_mb}MB/concurrency={concurrency}",
+                    size,
+                    durations,
+                    chunk_mb=chunk_mb,
+                    concurrency=concurrency,
+                )
+            )
+    os.remove(single)
+    os.remove(chunked)
+    return results
+
+
+def download(session, url):
+    response = session.get(url, stream=True)
+    response.raise_for_status()
+    for _ in response.iter_content(MB):
+        pass
+
+
+def bench_gets(server, workdir, config):
+    """`/get` of the same content stored as a plain file and as `_chunks`."""
+    size = config["get_mb"] * MB
+    session = cli.make_session()
+    results = []
+    for layout, assemble in (("plain", True), ("chunks", False)):
+        path = write_random_file(os.path.join(workdir, f"get-{layout}.bin"), size)
+        cli.upload_file(
+            path,
+            "bench",
+            chunk_size=5 * MB,
+            assemble=assemble,
+            session=session,
+            server_url=server.url,
+        )
+        os.remove(path)
+        url = f"{server.url}get?filename={os.path.basename(path)}"
+        durations = [
+            timed(download, session, url) for _ in range(config["repeats"] + 1)
+        ]
+        # The first read warms the page cache and the lookup cache.
+        results.append(throughput(f"get/{layout}", size, durations[1:]))
+    return results
+
+
+def seed_metadata(database, start, stop):
+    """Insert metadata rows `start`..`stop` spread over 16 categories."""
+    epoch = datetime(2024, 1, 1)
+    conn = connect(database)
+    with conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO metadata (filename, path, upload_timestamp, "
+            "category, checksum, size) VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                (
+                    f"seed/{i:07d}.npz",
+                    f"files/seed/{i:07d}.npz",
+                    (epoch + timedelta(seconds=i)).isoformat(" "),
+                    f"category{i % 16}",
+                    f"{i:064x}",
+                    i % 4096,
+                )
+                for i in range(start, stop)
+            ),
+        )
+    conn.close()
+
+
+def bench_metadata(server, config):
+    """`/metadata` page latency at each table size, for a few typical queries."""
+    session = cli.make_session()
+    headers = {"Authorization": AUTH_TOKEN}
+    rng = random.Random(0)
+    results = []
+    seeded = 0
+    for rows in config["metadata_rows"]:
+        seed_metadata(server.database, seeded, rows)
+        seeded = rows
+
+        def cursor(rows=rows):
+            # Any (upload_timestamp, id) position is valid for keyset paging.
+            i = rng.randrange(rows)
+            timestamp = (datetime(2024, 1, 1) + timedelta(seconds=i)).isoformat(" ")
+            position = json.dumps([timestamp, i])
+            return base64.urlsafe_b64encode(position.encode()).decode()
+
+        queries = {
+            "first_page": lambda: {"limit": 100},
+            "cursor_page": lambda: {"limit": 100, "cursor": cursor()},
+            "category": lambda: {
+                "limit": 100,
+                "category": f"category{rng.randrange(16)}",
+            },
+            # Prefixes matching about 100 rows each.
+            "prefix": lambda rows=rows: {
+                "limit": 100,
+                "prefix": f"seed/{rng.randrange(rows):07d}"[:-2],
+            },
+        }
+        for query, params in queries.items():
+            samples = []
+            for _ in range(config["metadata_requests"]):
+                started = time.perf_counter()
+                response = session.get(
+                    f"{server.url}metadata", params=params(), headers=headers
+                )
+                response.raise_for_status()
+                samples.append(time.perf_counter() - started)
+            summary = latency_summary(samples)
+            results.append(
+                dict(
+                    name=f"metadata/{query}/rows={rows}",
+                    metric="p99_ms",
+                    value=summary["p99_ms"],
+                    rows=rows,
+                    **summary,
+                )
+            )
+    return results
+
+
+@contextlib.contextmanager
+def cli_settings(server_url, ring_cache):
+    """Point the CLI, which reads its settings from module globals, at a server."""
+    saved = cli.SERVER_URL, cli.AUTH_TOKEN, cli.RING_CACHE, cli._ring
+    cli.SERVER_URL, cli.AUTH_TOKEN, cli.RING_CACHE = server_url, AUTH_TOKEN, ring_cache
+    cli._ring = None
+    try:
+        yield
+    finally:
+        cli.SERVER_URL, cli.AUTH_TOKEN, cli.RING_CACHE, cli._ring = saved
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=REPO_ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(config, sections=SECTIONS):
+    """Run the selected benchmark sections and return the results document."""
+    results = []
+    with tempfile.TemporaryDirectory(prefix="tinydist-bench-") as workdir:
+        if "checksum" in sections:
+            results += bench_checksum(workdir, config["checksum_mb"], config["repeats"])
+        server_dir = os.path.join(workdir, "server")
+        ring_cache = os.path.join(workdir, "ring.json")
+        with Server(server_dir) as server, quiet(), cli_settings(
+            server.url, ring_cache
+        ):
+            if "upload" in sections:
+                results += bench_uploads(server, workdir, config)
+            if "get" in sections:
+                results += bench_gets(server, workdir, config)
+            if "metadata" in sections:
+                results += bench_metadata(server, config)
+    return {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": config,
+        "results": results,
+    }
+
+
+def compare(baseline, current):
+    """Lines giving the change of each benchmark present in both documents."""
+    before = {result["name"]: result for result in baseline["results"]}
+    lines = []
+    for result in current["results"]:
+        old = before.get(result["name"])
+        if not old or not old["value"]:
+            continue
+        change = (result["value"] - old["value"]) / old["value"] * 100
+        lines.append(
+            f"{result['name']}: {old['value']:.2f} -> {result['value']:.2f} "
+            f"{result['metric']} ({change:+.1f}%)"
+        )
+    return lines
+
+
+@click.command()
+@click.option("--quick", is_flag=True, help="Smaller sizes for a fast check.")
+@click.option(
+    "--only",
+    multiple=True,
+    type=click.Choice(SECTIONS),
+    help="Run only these sections (repeatable).",
+)
+@click.option("--output", type=click.Path(), help="Write the JSON results here.")
+@click.option(
+    "--compare",
+    "baseline",
+    type=click.Path(exists=True),
+    help="Earlier results to print the change against.",
+)
+def main(quick, only, output, baseline):
+    document = run(QUICK if quick else FULL, only or SECTIONS)
+    text = json.dumps(document, indent=2)
+    if output:
+        with open(output, "w") as f:
+            f.write(text + "\n")
+    else:
+        click.echo(text)
+    if baseline:
+        with open(baseline) as f:
+            for line in compare(json.load(f), document):
+                click.echo(line, err=True)
+
+
+if __name__ == "__main__":
+    main()
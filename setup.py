@@ -12,9 +12,10 @@ setup(
         "Flask",
         "python-dotenv",
         "tqdm",
+        "numpy",
         "aiofiles",
-        "aiosqlite",
     ],
+    extras_require={"zstd": ["zstandard"]},
     entry_points={
         "console_scripts": [
             "tinydist=tinydist:cli",
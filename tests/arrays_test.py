@@ -0,0 +1,62 @@
+import io
+
+import numpy as np
+import pytest
+
+from tinydist import arrays
+from tinydist.utils import Segment
+
+
+def stored_as_parts(tmp_path, data, part_size):
+    """Segments of `data` split over several part files, like a chunked upload."""
+    segments = []
+    for i in range(0, len(data), part_size):
+        path = tmp_path / f"stored.part{i // part_size}"
+        path.write_bytes(data[i : i + part_size])
+        segments.append(Segment(str(path), 0, len(data[i : i + part_size])))
+    return segments
+
+
+def load(pieces):
+    return np.load(io.BytesIO(b"".join(pieces)))
+
+
+@pytest.mark.parametrize("save", [np.savez, np.savez_compressed])
+def test_row_ranges_of_npz_members(tmp_path, save):
+    inputs = np.arange(600, dtype=np.float32).reshape(200, 3)
+    labels = np.arange(200, dtype=np.int64)
+    buffer = io.BytesIO()
+    save(buffer, inputs=inputs, labels=labels, scale=np.float64(2.5))
+    segments = stored_as_parts(tmp_path, buffer.getvalue(), 1000)
+
+    infos = {info.name: info for info in arrays.list_arrays(segments, "data.npz")}
+    assert arrays.describe(infos["inputs"])["shape"] == [200, 3]
+    assert infos["labels"].dtype == np.int64
+    assert infos["inputs"].compressed == (save is np.savez_compressed)
+
+    result = load(arrays.iter_array(segments, infos["inputs"], 10, 20))
+    np.testing.assert_array_equal(result, inputs[10:20])
+    result = load(arrays.iter_array(segments, infos["labels"], -5))
+    np.testing.assert_array_equal(result, labels[-5:])
+    assert load(arrays.iter_array(segments, infos["scale"])) == 2.5
+    with pytest.raises(ValueError):
+        arrays.iter_array(segments, infos["scale"], 0, 1)
+
+
+def test_npy_and_fortran_order(tmp_path):
+    matrix = np.asfortranarray(np.arange(20, dtype=np.int16).reshape(5, 4))
+    path = tmp_path / "matrix.npy"
+    np.save(path, matrix)
+    segments = [Segment(str(path), 0, path.stat().st_size)]
+
+    (info,) = arrays.list_arrays(segments, "matrix.npy")
+    assert info.name == "matrix" and info.fortran_order
+    result = load(arrays.iter_array(segments, info, 1, 3))
+    np.testing.assert_array_equal(result, matrix[1:3])
+
+
+def test_rejects_files_that_are_not_arrays(tmp_path):
+    path = tmp_path / "notes.txt"
+    path.write_bytes(b"not an array")
+    with pytest.raises(ValueError):
+        arrays.list_arrays([Segment(str(path), 0, 12)], "notes.txt")
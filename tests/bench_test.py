@@ -0,0 +1,46 @@
+import importlib.util
+import json
+import os
+
+from helpers import REPO_ROOT
+
+spec = importlib.util.spec_from_file_location(
+    "bench", os.path.join(REPO_ROOT, "benchmarks", "bench.py")
+)
+bench = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(bench)
+
+TINY = {
+    "checksum_mb": 1,
+    "single_mb": 1,
+    "chunked_mb": 2,
+    "chunk_sizes_mb": (1,),
+    "concurrency": (2,),
+    "get_mb": 1,
+    "metadata_rows": (100,),
+    "metadata_requests": 5,
+    "repeats": 1,
+}
+
+
+def test_benchmarks_run_against_a_real_server():
+    document = bench.run(TINY)
+    names = [result["name"] for result in document["results"]]
+    assert names == [
+        "checksum/calculate_checksum",
+        "upload/single",
+        "upload/upload_chunk/chunk=1MB",
+        "upload/session/chunk=1MB/concurrency=2",
+        "get/plain",
+        "get/chunks",
+        "metadata/first_page/rows=100",
+        "metadata/cursor_page/rows=100",
+        "metadata/category/rows=100",
+        "metadata/prefix/rows=100",
+    ]
+    assert all(result["value"] > 0 for result in document["results"])
+    json.dumps(document)
+
+    slower = json.loads(json.dumps(document))
+    slower["results"][0]["value"] *= 2
+    assert bench.compare(slower, document)[0].endswith("(-50.0%)")
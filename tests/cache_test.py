@@ -0,0 +1,32 @@
+import time
+
+from tinydist.cache import MISSING, LRUCache
+
+
+def test_evicts_least_recently_used():
+    cache = LRUCache(capacity=2, ttl=60)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert cache.get("b") is MISSING
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["evictions"]) == (3, 1, 1)
+
+
+def test_entries_expire_after_ttl():
+    cache = LRUCache(capacity=2, ttl=0.01)
+    cache.put("a", 1)
+    time.sleep(0.02)
+    assert cache.get("a") is MISSING
+    assert cache.stats()["expirations"] == 1
+
+
+def test_put_from_before_invalidation_is_dropped():
+    cache = LRUCache()
+    generation = cache.generation
+    cache.pop("a")
+    cache.put("a", "stale", generation)
+    assert cache.get("a") is MISSING
@@ -0,0 +1,411 @@
+import hashlib
+import importlib
+import io
+import json
+import os
+
+import dotenv
+import numpy as np
+import pytest
+import requests
+from click.testing import CliRunner
+from helpers import unique_name
+
+# `tinydist.cli` the attribute is the click group, not the module.
+cli = importlib.import_module("tinydist.cli")
+
+dotenv.load_dotenv()
+
+AUTH_TOKEN = os.getenv("AUTH_TOKEN")
+
+
+def test_upload_file_in_parallel_chunks(client, cli_session, tmp_path):
+    content = os.urandom(10 * 1024 + 123)
+    source = tmp_path / "parallel.bin"
+    source.write_bytes(content)
+
+    sent = cli.upload_file(
+        str(source), "default", chunk_size=1024, concurrency=3, session=cli_session
+    )
+    assert sent == len(content)
+
+    chunks_dir = os.path.join("files", "parallel.bin_chunks")
+    parts = [
+        open(os.path.join(chunks_dir, f"parallel.bin.part{i}"), "rb").read()
+        for i in range(11)
+    ]
+    assert b"".join(parts) == content
+
+    response = client.post(
+        "/verify_get",
+        data={
+            "filename": "parallel.bin",
+            "checksum": hashlib.sha256(content).hexdigest(),
+        },
+    )
+    assert response.status_code == 200
+
+
+def test_upload_file_resume_sends_missing_chunks(client, cli_session, tmp_path):
+    content = os.urandom(4 * 1024)
+    source = tmp_path / "resumed.bin"
+    source.write_bytes(content)
+
+    status = cli.create_upload_session(
+        cli_session, "resumed.bin", "default", len(content), 1024, resume=False
+    )
+    cli.upload_session_chunk(cli_session, status["session_id"], 1, content[1024:2048])
+
+    sent = cli.upload_file(
+        str(source), "default", chunk_size=1024, resume=True, session=cli_session
+    )
+    assert sent == 3 * 1024
+
+    response = client.post(
+        "/verify_get",
+        data={
+            "filename": "resumed.bin",
+            "checksum": hashlib.sha256(content).hexdigest(),
+        },
+    )
+    assert response.status_code == 200
+
+
+def test_upload_file_resume_resends_chunks_that_changed(client, cli_session, tmp_path):
+    stale = os.urandom(4 * 1024)
+    status = cli.create_upload_session(
+        cli_session, "changed.bin", "default", len(stale), 1024, resume=False
+    )
+    for i in (0, 1):
+        cli.upload_session_chunk(
+            cli_session, status["session_id"], i, stale[i * 1024 : (i + 1) * 1024]
+        )
+    # Same size, so the session is resumed, but the second chunk differs.
+    content = stale[:1024] + os.urandom(3 * 1024)
+    source = tmp_path / "changed.bin"
+    source.write_bytes(content)
+
+    sent = cli.upload_file(
+        str(source), "default", chunk_size=1024, resume=True, session=cli_session
+    )
+    assert sent == 3 * 1024
+    assert client.get("/get?filename=changed.bin").data == content
+
+
+def upload_chunked(client, cli_session, tmp_path, name, content):
+    source = tmp_path / name
+    source.write_bytes(content)
+    cli.upload_file(str(source), "default", chunk_size=1024, session=cli_session)
+    response = client.get(
+        f"/metadata?prefix={name}&fields=id", headers={"Authorization": AUTH_TOKEN}
+    )
+    return response.get_json()[0]["id"]
+
+
+def test_download_file_in_parallel_ranges(client, cli_session, tmp_path):
+    content = os.urandom(5 * 1024 + 7)
+    file_id = upload_chunked(client, cli_session, tmp_path, "ranges.bin", content)
+    output_dir = tmp_path / "out"
+    output_dir.mkdir()
+
+    path = cli.download_file(
+        cli_session, file_id, str(output_dir), concurrency=3, piece_size=1000
+    )
+    with open(path, "rb") as f:
+        assert f.read() == content
+    assert os.listdir(output_dir) == ["ranges.bin"]
+
+
+def test_download_file_resumes_from_saved_state(
+    client, cli_session, tmp_path, monkeypatch
+):
+    content = os.urandom(3000)
+    file_id = upload_chunked(client, cli_session, tmp_path, "resume_get.bin", content)
+    etag = client.get(f"/get?id={file_id}").headers["ETag"]
+    path = tmp_path / "resume_get.bin"
+    with open(f"{path}.tdpart", "wb") as f:
+        f.write(content[:1000] + b"\0" * 2000)
+    cli.save_download_state(f"{path}.tdstate", len(content), etag, [[1000, 3000]])
+
+    fetched = []
+    original_fetch_piece = cli.fetch_piece
+
+    def fetch_piece(session, url, fd, piece, etag, on_progress):
+        fetched.append(list(piece))
+        return original_fetch_piece(session, url, fd, piece, etag, on_progress)
+
+    monkeypatch.setattr(cli, "fetch_piece", fetch_piece)
+    cli.download_file(cli_session, file_id, str(tmp_path), piece_size=1000)
+    assert fetched == [[1000, 3000]]
+    assert path.read_bytes() == content
+
+
+def test_download_archive_unpacks_and_verifies(client, cli_session, tmp_path):
+    contents = {"unpacked1.bin": os.urandom(2000), "unpacked2.bin": b"tiny"}
+    for name, content in contents.items():
+        source = tmp_path / name
+        source.write_bytes(content)
+        cli.upload_file(str(source), "unpack", chunk_size=1024, session=cli_session)
+    output_dir = tmp_path / "out"
+    output_dir.mkdir()
+
+    written, corrupted = cli.download_archive(
+        cli_session, category="unpack", output_dir=str(output_dir)
+    )
+    assert corrupted == []
+    assert sorted(os.path.basename(path) for path in written) == sorted(contents)
+    for name, content in contents.items():
+        assert (output_dir / name).read_bytes() == content
+
+
+def test_upload_folder_batches_small_files(client, cli_session, tmp_path, monkeypatch):
+    folder = tmp_path / "labels"
+    folder.mkdir()
+    for index in range(5):
+        (folder / f"label{index}.txt").write_bytes(b"%d" % index)
+
+    batches = []
+    original_upload_batch = cli.upload_batch
+
+    def upload_batch(session, file_paths, category, server_url=None):
+        batches.append(len(file_paths))
+        return original_upload_batch(session, file_paths, category, server_url)
+
+    monkeypatch.setattr(cli, "upload_batch", upload_batch)
+    result = CliRunner().invoke(
+        cli.cli,
+        ["upload", str(folder), "--category", "labels", "--batch-files", "2"],
+    )
+    assert result.exit_code == 0, result.output
+    assert batches == [2, 2, 1]
+
+    response = client.get(
+        "/metadata?category=labels&fields=filename",
+        headers={"Authorization": AUTH_TOKEN},
+    )
+    assert len(response.get_json()) == 5
+
+
+def test_deduplicated_upload_sends_only_new_chunks(client, cli_session, tmp_path):
+    base = os.urandom(4 * 1024)
+    first = tmp_path / "model_v1.bin"
+    first.write_bytes(base)
+    second = tmp_path / "model_v2.bin"
+    second.write_bytes(base[:3072] + os.urandom(1024))
+
+    sent = cli.upload_deduplicated(
+        str(first), "default", chunk_size=1024, session=cli_session
+    )
+    assert sent == len(base)
+    sent = cli.upload_deduplicated(
+        str(second), "default", chunk_size=1024, session=cli_session
+    )
+    assert sent == 1024
+
+    for source in (first, second):
+        response = client.get(f"/get?filename={source.name}")
+        assert response.data == source.read_bytes()
+
+
+def test_fetch_array_rows_from_stored_npz(client, cli_session):
+    targets = np.arange(1000, dtype=np.float64).reshape(250, 4)
+    buffer = io.BytesIO()
+    np.savez(buffer, targets=targets, ids=np.arange(250))
+    client.put(
+        "/upload/targets.npz",
+        data=buffer.getvalue(),
+        headers={"Authorization": AUTH_TOKEN},
+    )
+
+    listed = cli.list_arrays(cli_session, filename="targets.npz")
+    assert {info["name"]: info["shape"] for info in listed} == {
+        "targets": [250, 4],
+        "ids": [250],
+    }
+    rows = cli.fetch_array(
+        cli_session, "targets", start=100, stop=103, filename="targets.npz"
+    )
+    np.testing.assert_array_equal(rows, targets[100:103])
+    response = client.get("/array?filename=targets.npz&name=missing")
+    assert response.status_code == 404
+
+
+def test_download_refetches_only_chunks_failing_verification(
+    client, cli_session, tmp_path, monkeypatch
+):
+    content = os.urandom(4 * 1024 + 7)
+    file_id = upload_chunked(client, cli_session, tmp_path, "flaky.bin", content)
+    ranges = []
+    original_get = cli_session.get
+
+    def get(url, **kwargs):
+        response = original_get(url, **kwargs)
+        requested = kwargs.get("headers", {}).get("Range")
+        if requested:
+            ranges.append(requested)
+            if requested == "bytes=1024-2047" and ranges.count(requested) == 1:
+                response.raw = io.BytesIO(b"\0" * 1024)  # Corrupted in transit.
+        return response
+
+    monkeypatch.setattr(cli_session, "get", get)
+    output_dir = tmp_path / "out"
+    output_dir.mkdir()
+    path, verified = cli.download_and_verify(cli_session, file_id, str(output_dir))
+    assert verified
+    assert open(path, "rb").read() == content
+    assert sorted(ranges) == sorted(
+        [
+            f"bytes={start}-{min(start + 1024, len(content)) - 1}"
+            for start in range(0, len(content), 1024)
+        ]
+        + ["bytes=1024-2047"]
+    )
+
+
+def test_download_without_ranges_fails_on_an_error_status(
+    client, cli_session, tmp_path, monkeypatch
+):
+    file_id = upload_chunked(client, cli_session, tmp_path, "erroring.bin", b"data")
+    original_head, original_get = cli_session.head, cli_session.get
+
+    def head(url, **kwargs):
+        response = original_head(url, **kwargs)
+        del response.headers["Accept-Ranges"]
+        return response
+
+    def get(url, **kwargs):
+        response = original_get(url, **kwargs)
+        if "/get?" in url:
+            response.status_code = 503
+            response.raw = io.BytesIO(b"Service Unavailable")
+        return response
+
+    monkeypatch.setattr(cli_session, "head", head)
+    monkeypatch.setattr(cli_session, "get", get)
+    output_dir = tmp_path / "out"
+    output_dir.mkdir()
+    with pytest.raises(requests.HTTPError):
+        cli.download_and_verify(cli_session, file_id, str(output_dir))
+    assert not (output_dir / "erroring.bin").exists()
+
+
+def test_download_cache_revalidates_instead_of_downloading(
+    client, cli_session, tmp_path, monkeypatch
+):
+    content = os.urandom(3000)
+    file_id = upload_chunked(client, cli_session, tmp_path, "cached.bin", content)
+    cache = cli.DownloadCache(str(tmp_path / "cache"), 5000)
+    first, second = tmp_path / "first", tmp_path / "second"
+    first.mkdir()
+    second.mkdir()
+    path, verified = cli.download_and_verify(
+        cli_session, file_id, str(first), cache=cache
+    )
+    assert verified
+
+    requests_made = []
+    original_request = cli_session.request
+
+    def request(method, url, **kwargs):
+        response = original_request(method, url, **kwargs)
+        requests_made.append((method, response.status_code))
+        return response
+
+    monkeypatch.setattr(cli_session, "request", request)
+    path, verified = cli.download_and_verify(
+        cli_session, file_id, str(second), cache=cache
+    )
+    assert requests_made == [("HEAD", 304)]
+    assert verified and open(path, "rb").read() == content
+
+    # Caching another file goes over 5000 bytes and evicts the older one.
+    other_id = upload_chunked(
+        client, cli_session, tmp_path, "evicting.bin", content[::-1]
+    )
+    cli.download_and_verify(cli_session, other_id, str(first), cache=cache)
+    assert cache.get(hashlib.sha256(content).hexdigest()) is None
+    assert cache.get(hashlib.sha256(content[::-1]).hexdigest())
+
+
+def test_editing_a_download_does_not_corrupt_the_cache(client, cli_session, tmp_path):
+    content = os.urandom(2000)
+    file_id = upload_chunked(client, cli_session, tmp_path, "edited.bin", content)
+    for link in (False, True):
+        cache = cli.DownloadCache(str(tmp_path / f"cache-{link}"), 5000)
+        cache.link = link
+        target = tmp_path / f"out-{link}"
+        target.mkdir()
+        path, _ = cli.download_and_verify(
+            cli_session, file_id, str(target), cache=cache
+        )
+        assert (
+            not os.stat(cache.get(hashlib.sha256(content).hexdigest())).st_mode & 0o222
+        )
+        # Linked downloads are read-only; making one writable drops it from the cache.
+        os.chmod(path, 0o644)
+        with open(path, "r+b") as f:
+            f.write(b"edited")
+        path, verified = cli.download_and_verify(
+            cli_session, file_id, str(target), cache=cache
+        )
+        assert verified and open(path, "rb").read() == content
+
+
+def test_sync_uploads_only_changes(client, cli_session, tmp_path, monkeypatch):
+    category = unique_name("synced")
+    a, b, c = (unique_name(name) for name in ("a.txt", "b.txt", "c.txt"))
+    folder = tmp_path / "dataset"
+    (folder / "nested").mkdir(parents=True)
+    for name in (a, b, f"nested/{c}"):
+        (folder / name).write_text(f"version 1 of {name}")
+    client.put(
+        f"/upload/{unique_name('stale.txt')}?category={category}",
+        data=b"stale",
+        headers={"Authorization": AUTH_TOKEN},
+    )
+
+    def synced():
+        response = client.get(
+            f"/metadata?format=ndjson&category={category}&fields=filename,checksum",
+            headers={"Authorization": AUTH_TOKEN},
+        )
+        lines = response.data.decode().splitlines()
+        return {row["filename"]: row["checksum"] for row in map(json.loads, lines)}
+
+    runner = CliRunner()
+    args = ["sync", str(folder), "--category", category, "--delete"]
+    result = runner.invoke(cli.cli, args)
+    assert result.exit_code == 0, result.output
+    assert "3 uploaded" in result.output and "1 deleted" in result.output
+    assert synced() == {
+        name: hashlib.sha256(f"version 1 of {path}".encode()).hexdigest()
+        for name, path in ((a, a), (b, b), (c, f"nested/{c}"))
+    }
+
+    (folder / b).write_text("version 2 of b.txt, longer")
+    (folder / a).unlink()
+    hashed = []
+    original_checksum = cli.calculate_checksum
+
+    def calculate_checksum(path):
+        hashed.append(os.path.basename(path))
+        return original_checksum(path)
+
+    monkeypatch.setattr(cli, "calculate_checksum", calculate_checksum)
+    result = runner.invoke(cli.cli, args)
+    assert result.exit_code == 0, result.output
+    assert hashed == [b]
+    assert "1 unchanged, 1 uploaded" in result.output
+    expected = {
+        b: hashlib.sha256(b"version 2 of b.txt, longer").hexdigest(),
+        c: hashlib.sha256(f"version 1 of nested/{c}".encode()).hexdigest(),
+    }
+    assert synced() == expected
+
+    result = runner.invoke(cli.cli, args)
+    assert "0 uploaded" in result.output and "0 deleted" in result.output
+
+    # The manifest sync keeps in the folder is not uploaded with it.
+    result = runner.invoke(cli.cli, ["upload", str(folder), "--category", category])
+    assert result.exit_code == 0, result.output
+    assert synced() == expected
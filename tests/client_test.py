@@ -0,0 +1,84 @@
+import hashlib
+import os
+
+import pytest
+from helpers import TEST_SERVER_URL
+
+from tinydist.client import ChecksumMismatch, DatasetReader
+
+AUTH_TOKEN = os.getenv("AUTH_TOKEN")
+
+CONTENTS = {f"sample{i}.bin": bytes([i]) * (1000 + i) for i in range(8)}
+
+
+@pytest.fixture
+def dataset(client, cli_session):
+    for name, content in CONTENTS.items():
+        client.put(
+            f"/upload/{name}?category=streamed",
+            data=content,
+            headers={"Authorization": AUTH_TOKEN},
+        )
+
+    def reader(**options):
+        return DatasetReader(
+            "streamed",
+            server_url=TEST_SERVER_URL,
+            auth_token=AUTH_TOKEN,
+            session=cli_session,
+            **options,
+        )
+
+    return reader
+
+
+def test_reader_shuffles_and_shards_across_ranks(dataset):
+    assert dict(dataset(prefetch=3)) == CONTENTS
+    assert [name for name, _ in dataset()] == sorted(CONTENTS)
+
+    shards = []
+    for rank in range(3):
+        reader = dataset(shuffle=True, seed=7, rank=rank, world_size=3)
+        reader.set_epoch(1)
+        shards.append([name for name, _ in reader])
+    assert sorted(sum(shards, [])) == sorted(CONTENTS)
+    assert [len(shard) for shard in shards] == [3, 3, 2]
+
+    reader = dataset(shuffle=True, seed=7)
+    orders = []
+    for epoch in range(2):
+        reader.set_epoch(epoch)
+        orders.append([name for name, _ in reader])
+    assert orders[0] != orders[1]
+
+
+def test_reader_prefetches_within_memory_budget(dataset):
+    def events(reader):
+        log = []
+        original_fetch = reader.fetch
+
+        def fetch(row):
+            log.append(("fetch", row["filename"]))
+            return original_fetch(row)
+
+        reader.fetch = fetch
+        for name, data in reader.streams():
+            assert data.read() == CONTENTS[name]
+            log.append(("use", name))
+        return log
+
+    # Two files fit in the budget: only one is fetched ahead.
+    log = events(dataset(prefetch=4, memory_budget_mb=2500 / 1024 / 1024))
+    for i, (kind, name) in enumerate(log):
+        if kind == "fetch":
+            fetched = sum(1 for k, _ in log[: i + 1] if k == "fetch")
+            used = sum(1 for k, _ in log[:i] if k == "use")
+            assert fetched - used <= 2
+    assert [name for kind, name in log if kind == "use"] == sorted(CONTENTS)
+
+
+def test_reader_verifies_checksums(dataset):
+    reader = dataset()
+    reader.list_files()[0]["checksum"] = hashlib.sha256(b"other").hexdigest()
+    with pytest.raises(ChecksumMismatch):
+        list(reader)
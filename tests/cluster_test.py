@@ -0,0 +1,65 @@
+import importlib
+import os
+
+import requests
+from click.testing import CliRunner
+from helpers import CLUSTER_AUTH_TOKEN as AUTH_TOKEN
+
+from tinydist.ring import HashRing
+
+cli = importlib.import_module("tinydist.cli")
+
+
+def test_uploads_are_routed_to_owners_and_rebalanced(
+    start_nodes, tmp_path, monkeypatch
+):
+    nodes = start_nodes(3)
+    folder = tmp_path / "targets"
+    folder.mkdir()
+    contents = {f"target{i}.npz": os.urandom(100 + i) for i in range(40)}
+    for name, content in contents.items():
+        (folder / name).write_bytes(content)
+    large = tmp_path / "checkpoint.bin"
+    large.write_bytes(os.urandom(3 * 1024 * 1024 + 5))
+    contents[large.name] = large.read_bytes()
+
+    result = CliRunner().invoke(cli.cli, ["upload", str(folder)])
+    assert result.exit_code == 0, result.output
+    # A stale ring map that only knows the first node is corrected by a 421.
+    cli.save_ring(HashRing([nodes[0].url]))
+    result = CliRunner().invoke(cli.cli, ["upload", str(large), "--chunk-size", "1"])
+    assert result.exit_code == 0, result.output
+
+    ring = HashRing(node.url for node in nodes)
+    by_url = {node.url: node for node in nodes}
+    owners = {ring.node_for(name) for name in contents}
+    assert len(owners) == 3
+    for name, content in contents.items():
+        owner = by_url[ring.node_for(name)]
+        assert owner.get(name).content == content
+        other = next(node for node in nodes if node is not owner)
+        assert other.get(name).status_code == 421
+
+    monkeypatch.chdir(tmp_path)
+    name = next(iter(contents))
+    result = CliRunner().invoke(cli.cli, ["get", "--by-name", name])
+    assert result.exit_code == 0, result.output
+    assert "verified successfully" in result.output
+
+    # The third node leaves: the others restart without it, then its files move.
+    for node in nodes[:2]:
+        node.stop()
+        node.start(nodes[:2])
+    result = CliRunner().invoke(cli.cli, ["rebalance", "--drain", nodes[2].url])
+    assert result.exit_code == 0, result.output
+
+    ring = HashRing(node.url for node in nodes[:2])
+    for name, content in contents.items():
+        assert by_url[ring.node_for(name)].get(name).content == content
+    assert nodes[2].get(next(iter(contents))).status_code in (404, 421)
+    response = requests.get(
+        f"{nodes[2].url}metadata",
+        params={"format": "ndjson"},
+        headers={"Authorization": AUTH_TOKEN},
+    )
+    assert response.text.strip() == ""
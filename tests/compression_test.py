@@ -0,0 +1,123 @@
+import gzip
+import hashlib
+import importlib
+import io
+import os
+import tarfile
+
+import pytest
+
+from tinydist.compression import (
+    GZIP,
+    ZSTD,
+    compress,
+    decoded_digest,
+    iter_decoding,
+    worth_compressing,
+)
+from tinydist.scrubber import hash_stored
+from tinydist.store import get_metadata
+from tinydist.utils import file_segments
+
+cli = importlib.import_module("tinydist.cli")
+
+AUTH_TOKEN = os.getenv("AUTH_TOKEN")
+
+CONTENT = b"".join(b"%d,label_%d,0.%d\n" % (i, i % 7, i) for i in range(600))
+
+
+def test_worth_compressing(tmp_path):
+    text = tmp_path / "targets.csv"
+    text.write_bytes(CONTENT)
+    noise = tmp_path / "noise.bin"
+    noise.write_bytes(os.urandom(10000))
+    archive = tmp_path / "arrays.npz"
+    archive.write_bytes(CONTENT)
+    assert worth_compressing(str(text))
+    assert not worth_compressing(str(noise))
+    assert not worth_compressing(str(archive))
+
+
+def test_compressed_upload_is_served_encoded_or_decoded(client, cli_session, tmp_path):
+    source = tmp_path / "labels.csv"
+    source.write_bytes(CONTENT)
+    cli.upload_file(
+        str(source), "labels", chunk_size=4096, session=cli_session, compression=GZIP
+    )
+    row = get_metadata("labels.csv")
+    assert row["storage"] == GZIP and row["size"] == len(CONTENT)
+    segments = file_segments(row["path"])
+    assert len(segments) == -(-len(CONTENT) // 4096)
+    assert sum(segment.length for segment in segments) < len(CONTENT) / 2
+
+    response = client.get(
+        "/get?filename=labels.csv", headers={"Accept-Encoding": "gzip"}
+    )
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(response.data) == CONTENT
+    response = client.get(
+        "/get?filename=labels.csv", headers={"Accept-Encoding": "identity"}
+    )
+    assert "Content-Encoding" not in response.headers
+    assert response.headers["Content-Length"] == str(len(CONTENT))
+    assert response.data == CONTENT
+    checksum = hashlib.sha256(CONTENT).hexdigest()
+    response = client.get(
+        "/get?filename=labels.csv", headers={"If-None-Match": f'"{checksum}"'}
+    )
+    assert response.status_code == 304
+
+    response = client.get(
+        "/files?filename=labels.csv&format=tar", headers={"Authorization": AUTH_TOKEN}
+    )
+    with tarfile.open(fileobj=io.BytesIO(response.data)) as archive:
+        assert archive.extractfile("labels.csv").read() == CONTENT
+    assert hash_stored(row["path"], segments, GZIP) == checksum
+
+    output_dir = tmp_path / "out"
+    output_dir.mkdir()
+    path, verified = cli.download_and_verify(
+        cli_session, filename="labels.csv", output_dir=str(output_dir)
+    )
+    assert verified and open(path, "rb").read() == CONTENT
+
+
+def test_iter_decoding_spans_member_boundaries():
+    body = compress(CONTENT[:1000], GZIP) + compress(CONTENT[1000:], GZIP)
+    for size in (1, 7, 1000, len(body)):
+        pieces = (body[i : i + size] for i in range(0, len(body), size))
+        assert b"".join(iter_decoding(pieces, GZIP)) == CONTENT
+
+
+def test_compressed_chunks_are_checked(client):
+    response = client.post(
+        "/upload_session",
+        json={
+            "filename": "checked.csv",
+            "file_size": len(CONTENT),
+            "chunk_size": len(CONTENT),
+            "encoding": GZIP,
+        },
+        headers={"Authorization": AUTH_TOKEN},
+    )
+    session_id = response.get_json()["session_id"]
+    url = f"/upload_session/{session_id}/0"
+    response = client.put(url, data=CONTENT, headers={"Authorization": AUTH_TOKEN})
+    assert response.status_code == 415
+    headers = {"Authorization": AUTH_TOKEN, "Content-Encoding": GZIP}
+    response = client.put(url, data=b"not gzip", headers=headers)
+    assert response.status_code == 400
+    response = client.put(url, data=compress(CONTENT[:-1], GZIP), headers=headers)
+    assert response.status_code == 400
+    response = client.put(url, data=compress(CONTENT, GZIP), headers=headers)
+    assert response.status_code == 200
+
+
+def test_zstd_round_trip(tmp_path):
+    pytest.importorskip("zstandard")
+    path = tmp_path / "part0"
+    path.write_bytes(compress(CONTENT, ZSTD))
+    assert decoded_digest(str(path), ZSTD) == (
+        len(CONTENT),
+        hashlib.sha256(CONTENT).hexdigest(),
+    )
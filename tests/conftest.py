@@ -1,9 +1,20 @@
+import importlib
+import io
 import os
-import sqlite3
+import socket
+import subprocess
+import sys
+import time
+from urllib.parse import urlsplit
 
 import pytest
+import requests
+from helpers import CLUSTER_AUTH_TOKEN, REPO_ROOT, TEST_SERVER_URL
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
 
-from tinydist.server import DB_NAME, app
+from tinydist.server import app
+from tinydist.store import init_db
 
 
 @pytest.fixture(scope="module")
@@ -15,20 +26,146 @@ def client():
     )
     os.makedirs("./files", exist_ok=True)
 
-    create_table_statements = """CREATE TABLE IF NOT EXISTS metadata (
-                            id INTEGER PRIMARY KEY AUTOINCREMENT,
-                            filename TEXT UNIQUE,
-                            path TEXT,
-                            checksum TEXT,
-                            upload_timestamp DATETIME,
-                            last_accessed DATETIME,
-                            access_count INTEGER DEFAULT 0,
-                            category TEXT)"""
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.executescript(create_table_statements)
-        conn.commit()
+    init_db()
 
     with app.test_client() as testing_client:
         with app.app_context():
             yield testing_client
+
+
+class FlaskAdapter(BaseAdapter):
+    """Transport adapter that sends `requests` traffic to the Flask test client."""
+
+    def __init__(self, flask_app):
+        super().__init__()
+        self.flask_app = flask_app
+
+    def send(self, request, stream=False, **kwargs):
+        url = urlsplit(request.url)
+        body = request.body
+        headers = dict(request.headers)
+        if body is not None and not isinstance(body, (bytes, str)):
+            # Streamed bodies arrive whole, so they are no longer chunked.
+            body = b"".join(bytes(part) for part in body)
+            headers.pop("Transfer-Encoding", None)
+        # A fresh client per request keeps worker threads out of each
+        # other's (and the fixture's) application contexts.
+        flask_response = self.flask_app.test_client().open(
+            url.path,
+            method=request.method,
+            query_string=url.query,
+            headers=headers,
+            data=body,
+        )
+        response = requests.Response()
+        response.status_code = flask_response.status_code
+        response.headers = CaseInsensitiveDict(flask_response.headers)
+        response.raw = io.BytesIO(flask_response.get_data())
+        response.url = request.url
+        response.request = request
+        response.reason = flask_response.status
+        return response
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def cli_session(client, monkeypatch, tmp_path):
+    """Point the CLI at the in-process test server."""
+    cli = importlib.import_module("tinydist.cli")
+
+    def make_session(pool_size=cli.DEFAULT_CONCURRENCY):
+        session = requests.Session()
+        session.mount(TEST_SERVER_URL, FlaskAdapter(app))
+        return session
+
+    monkeypatch.setattr(cli, "SERVER_URL", TEST_SERVER_URL)
+    monkeypatch.setattr(cli, "AUTH_TOKEN", os.getenv("AUTH_TOKEN"))
+    monkeypatch.setattr(cli, "make_session", make_session)
+    monkeypatch.setattr(cli, "RING_CACHE", str(tmp_path / "ring.json"))
+    monkeypatch.setattr(cli, "_ring", None)
+    monkeypatch.setattr(cli, "CACHE_DIRECTORY", str(tmp_path / "cache"))
+    return make_session()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class Node:
+    """A tinydist server process with its own files/ directory and database."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.url = f"http://127.0.0.1:{free_port()}/"
+        os.makedirs(os.path.join(directory, "files"), exist_ok=True)
+        self.process = None
+
+    def start(self, members, **settings):
+        env = dict(
+            os.environ,
+            AUTH_TOKEN=CLUSTER_AUTH_TOKEN,
+            DATABASE_NAME="metadata.db",
+            CLUSTER_NODES=",".join(node.url for node in members),
+            NODE_URL=self.url,
+            PYTHONPATH=REPO_ROOT,
+            ANTI_ENTROPY_INTERVAL="0",
+            **settings,
+        )
+        port = int(self.url.rstrip("/").rsplit(":", 1)[1])
+        self.process = subprocess.Popen(
+            [
+                sys.executable,
+                "-c",
+                "from tinydist.server import create_app; "
+                f"create_app().run(port={port}, threaded=True)",
+            ],
+            cwd=self.directory,
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        deadline = time.monotonic() + 20
+        while time.monotonic() < deadline:
+            try:
+                requests.get(f"{self.url}ring", timeout=1)
+                return
+            except requests.ConnectionError:
+                time.sleep(0.1)
+        raise RuntimeError(f"{self.url} did not start")
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+
+    def get(self, filename):
+        return requests.get(f"{self.url}get", params={"filename": filename})
+
+
+@pytest.fixture
+def start_nodes(tmp_path, monkeypatch):
+    """
+    Start `count` server processes forming one cluster and point the CLI at
+    the first of them.
+    """
+    cli = importlib.import_module("tinydist.cli")
+    started = []
+
+    def start(count, **settings):
+        nodes = [Node(str(tmp_path / f"node{i}")) for i in range(count)]
+        for node in nodes:
+            node.start(nodes, **settings)
+            started.append(node)
+        monkeypatch.setattr(cli, "SERVER_URL", nodes[0].url)
+        monkeypatch.setattr(cli, "AUTH_TOKEN", CLUSTER_AUTH_TOKEN)
+        monkeypatch.setattr(cli, "RING_CACHE", str(tmp_path / "ring.json"))
+        monkeypatch.setattr(cli, "_ring", None)
+        monkeypatch.setattr(cli, "CACHE_DIRECTORY", str(tmp_path / "cache"))
+        return nodes
+
+    yield start
+    for node in started:
+        node.stop()
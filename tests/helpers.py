@@ -0,0 +1,16 @@
+"""Constants shared by the fixtures in conftest.py and the tests."""
+
+import os
+import uuid
+
+TEST_SERVER_URL = "http://tinydist.test/"
+CLUSTER_AUTH_TOKEN = "cluster-secret"
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def unique_name(filename):
+    """
+    `filename` with a random prefix, so that what earlier runs of the suite
+    left in the shared database and files/ cannot collide with it.
+    """
+    return f"{uuid.uuid4().hex[:8]}_{filename}"
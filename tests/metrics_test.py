@@ -0,0 +1,132 @@
+import io
+import os
+import re
+import threading
+
+from helpers import unique_name
+from werkzeug.test import EnvironBuilder
+from werkzeug.wsgi import FileWrapper
+
+from tinydist import metrics
+from tinydist.server import app
+
+AUTH_TOKEN = os.getenv("AUTH_TOKEN")
+
+
+def scrape(client):
+    """{(name, labels): value} of the samples at /metrics."""
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.mimetype == "text/plain"
+    samples = {}
+    for line in response.data.decode().splitlines():
+        if line.startswith("#"):
+            continue
+        match = re.fullmatch(r"(\w+)(?:\{(.*)\})? (\S+)", line)
+        samples[(match[1], match[2] or "")] = float(match[3])
+    return samples
+
+
+def test_samples_from_exited_threads_are_kept():
+    def work():
+        metrics.inc("tinydist_request_bytes_total", (("route", "/test"),), 10)
+        metrics.observe("tinydist_sqlite_query_seconds", 0.002, (("statement", "x"),))
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    work()
+
+    for _ in range(2):  # The second pass reads them from the retired total.
+        samples = metrics.collect()
+        assert samples[("tinydist_request_bytes_total", (("route", "/test"),))] == 50
+        histogram = samples[("tinydist_sqlite_query_seconds", (("statement", "x"),))]
+        # 0.002 falls in the (0.001, 0.005] bucket.
+        assert histogram[metrics.QUERY_BUCKETS.index(0.005)] == 5
+        assert sum(histogram[:-1]) == 5
+
+    text = metrics.render()
+    assert 'tinydist_sqlite_query_seconds_bucket{statement="x",le="0.001"} 0' in text
+    assert 'tinydist_sqlite_query_seconds_bucket{statement="x",le="0.005"} 5' in text
+    assert 'tinydist_sqlite_query_seconds_count{statement="x"} 5' in text
+
+
+def test_exited_threads_are_pruned_without_scrapes():
+    def work():
+        metrics.inc("tinydist_request_bytes_total", (("route", "/prune"),))
+
+    for _ in range(50):
+        thread = threading.Thread(target=work)
+        thread.start()
+        thread.join()
+    # Each thread registering retired the ones that exited before it.
+    assert len(metrics._threads) <= threading.active_count() + 1
+    samples = metrics.collect()
+    assert samples[("tinydist_request_bytes_total", (("route", "/prune"),))] == 50
+
+
+def test_in_flight_gauge_counts_running_views():
+    key = ("tinydist_chunk_uploads_in_flight", ())
+
+    @metrics.tracks_in_flight("tinydist_chunk_uploads_in_flight")
+    def view():
+        return metrics.collect()[key]
+
+    before = metrics.collect().get(key, 0)
+    assert view() == before + 1
+    assert metrics.collect()[key] == before
+
+
+def test_metrics_endpoint(client):
+    content = b"measured" * 1000
+    response = client.post(
+        "/upload",
+        data={"file": (io.BytesIO(content), "measured.bin"), "category": "default"},
+        content_type="multipart/form-data",
+        headers={"Authorization": AUTH_TOKEN},
+    )
+    assert response.get_json()["filename"] == "measured.bin"
+    before = scrape(client)
+    assert client.get("/get?filename=measured.bin").data == content
+    after = scrape(client)
+
+    get = 'route="/get",method="GET"'
+    assert after[("tinydist_request_duration_seconds_count", get)] == (
+        before.get(("tinydist_request_duration_seconds_count", get), 0) + 1
+    )
+    assert after[("tinydist_response_bytes_total", get)] - before.get(
+        ("tinydist_response_bytes_total", get), 0
+    ) == len(content)
+    upload = 'route="/upload",method="POST"'
+    assert after[("tinydist_request_bytes_total", upload)] > len(content)
+    assert after[("tinydist_sqlite_query_seconds_count", 'statement="select"')] > 0
+    assert after[("tinydist_disk_usage_bytes", 'directory="files/"')] > 0
+
+
+def test_send_file_responses_are_passed_through_and_measured(client):
+    filename = unique_name("sent.bin")
+    content = os.urandom(5000)
+    client.put(
+        f"/upload/{filename}", data=content, headers={"Authorization": AUTH_TOKEN}
+    )
+    key = (
+        "tinydist_response_bytes_total",
+        (("route", "/get"), ("method", "GET")),
+    )
+    before = metrics.collect().get(key, 0)
+
+    class ServerFileWrapper(FileWrapper):
+        """Stands in for a server's wsgi.file_wrapper, which it sendfiles."""
+
+    environ = EnvironBuilder(
+        path="/get", query_string={"filename": filename}
+    ).get_environ()
+    environ["wsgi.file_wrapper"] = ServerFileWrapper
+    result = app.wsgi_app(environ, lambda status, headers, exc_info=None: None)
+    assert isinstance(result, ServerFileWrapper)
+    assert metrics.collect().get(key, 0) == before
+    assert b"".join(result) == content
+    result.close()
+    assert metrics.collect()[key] == before + len(content)
@@ -0,0 +1,154 @@
+import hashlib
+import io
+import os
+import tarfile
+
+import pytest
+from werkzeug.test import EnvironBuilder
+
+from tinydist import server
+from tinydist.packs import PackWriter, compact
+from tinydist.store import PACK_STORAGE, get_metadata, lookup_file, stored_segments
+
+AUTH_TOKEN = os.getenv("AUTH_TOKEN")
+
+
+@pytest.fixture
+def writer(monkeypatch, tmp_path):
+    writer = PackWriter(str(tmp_path / "packs"), 2048)
+    monkeypatch.setattr(server, "packer", writer)
+    monkeypatch.setattr(server, "PACK_MAX_SIZE", 1024)
+    return writer
+
+
+def put(client, filename, data):
+    response = client.put(
+        f"/upload/{filename}", data=data, headers={"Authorization": AUTH_TOKEN}
+    )
+    assert response.status_code == 200
+
+
+def test_small_uploads_are_packed(client, writer, monkeypatch):
+    monkeypatch.setattr(server, "PACK_MAX_SIZE", 0)
+    put(client, "small-0.bin", b"unpacked")
+    plain_path = get_metadata("small-0.bin")["path"]
+    monkeypatch.setattr(server, "PACK_MAX_SIZE", 1024)
+
+    contents = {f"small-{i}.bin": os.urandom(300 + i) for i in range(3)}
+    put(client, "small-0.bin", contents["small-0.bin"])
+    response = client.post(
+        "/upload",
+        data={"file": (io.BytesIO(contents["small-1.bin"]), "small-1.bin")},
+        headers={"Authorization": AUTH_TOKEN},
+    )
+    assert response.status_code == 200
+    contents["large.bin"] = os.urandom(3000)
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode="w") as tar:
+        for filename in ("small-2.bin", "large.bin"):
+            info = tarfile.TarInfo(filename)
+            info.size = len(contents[filename])
+            tar.addfile(info, io.BytesIO(contents[filename]))
+    response = client.post(
+        "/upload_batch",
+        data=archive.getvalue(),
+        headers={"Authorization": AUTH_TOKEN},
+    )
+    assert response.json["filenames"] == ["small-2.bin", "large.bin"]
+
+    for filename, data in contents.items():
+        row = get_metadata(filename)
+        assert row["checksum"] == hashlib.sha256(data).hexdigest()
+        assert client.get(f"/get?filename={filename}").data == data
+        if filename == "large.bin":
+            assert row["storage"] is None and row["pack_offset"] is None
+            continue
+        assert row["storage"] == PACK_STORAGE
+        assert row["path"] == writer.segment_path(1)
+    offsets = sorted(get_metadata(f"small-{i}.bin")["pack_offset"] for i in range(3))
+    assert offsets == [0, 300, 601]
+    assert not os.path.exists(plain_path)
+
+    response = client.get("/get?filename=small-1.bin", headers={"Range": "bytes=10-19"})
+    assert response.status_code == 206
+    assert response.data == contents["small-1.bin"][10:20]
+    response = client.get(
+        "/get?filename=small-1.bin",
+        headers={"If-None-Match": f'"{get_metadata("small-1.bin")["checksum"]}"'},
+    )
+    assert response.status_code == 304
+
+
+def test_compaction_reclaims_deleted_files(client, writer):
+    contents = {f"pack-{i}.bin": os.urandom(600) for i in range(8)}
+    for filename, data in contents.items():
+        put(client, filename, data)
+    assert len(writer.segments()) == 3
+    for i in (0, 1, 3, 4):
+        client.delete(
+            f"/delete?filename=pack-{i}.bin", headers={"Authorization": AUTH_TOKEN}
+        )
+        del contents[f"pack-{i}.bin"]
+    put(client, "pack-2.bin", contents["pack-2.bin"])
+    assert client.get("/packs", headers={"Authorization": AUTH_TOKEN}).json == {
+        "segments": 3,
+        "size": 9 * 600,
+        "used": 4 * 600,
+    }
+
+    summary = compact(writer)
+    assert summary == {"segments": 2, "moved": 1, "reclaimed": 3000}
+    assert len(writer.segments()) == 2
+    for filename, data in contents.items():
+        assert get_metadata(filename)["path"] in writer.segments()
+        assert client.get(f"/get?filename={filename}").data == data
+    assert compact(writer) == {"segments": 0, "moved": 0, "reclaimed": 0}
+
+
+def test_records_read_before_compaction_still_resolve(client, writer, monkeypatch):
+    data = os.urandom(600)
+    for filename in ("moved.bin", "dead-0.bin", "dead-1.bin", "next.bin"):
+        put(client, filename, data if filename == "moved.bin" else os.urandom(600))
+    for filename in ("dead-0.bin", "dead-1.bin"):
+        client.delete(
+            f"/delete?filename={filename}", headers={"Authorization": AUTH_TOKEN}
+        )
+    stale = lookup_file("moved.bin", False)
+    assert compact(writer)["moved"] == 1
+    assert stored_segments(stale)[0].path != stale[2]
+
+    monkeypatch.setattr(server, "lookup_file", lambda *args: stale)
+    assert client.get("/get?filename=moved.bin").data == data
+    response = client.get(
+        "/files?filename=moved.bin&format=tar", headers={"Authorization": AUTH_TOKEN}
+    )
+    with tarfile.open(fileobj=io.BytesIO(response.data)) as tar:
+        assert tar.extractfile("moved.bin").read() == data
+    client.delete("/delete?filename=moved.bin", headers={"Authorization": AUTH_TOKEN})
+    assert client.get("/get?filename=moved.bin").status_code == 404
+    assert client.get("/arrays?filename=moved.bin").status_code == 404
+
+
+def test_responses_outlive_the_segment_they_read(client, writer):
+    data = os.urandom(600)
+    for filename in ("streamed.bin", "gone-0.bin", "gone-1.bin", "later.bin"):
+        put(client, filename, data if filename == "streamed.bin" else os.urandom(600))
+    for filename in ("gone-0.bin", "gone-1.bin"):
+        client.delete(
+            f"/delete?filename={filename}", headers={"Authorization": AUTH_TOKEN}
+        )
+    segment = get_metadata("streamed.bin")["path"]
+
+    # Straight to the app, since the test client reads the first chunk itself.
+    environ = EnvironBuilder(
+        path="/get", query_string={"filename": "streamed.bin"}
+    ).get_environ()
+    sent = {}
+    body = server.app.wsgi_app(
+        environ, lambda status, headers, *_: sent.update(headers)
+    )
+    assert sent["Content-Length"] == "600"
+    assert compact(writer)["moved"] == 1
+    assert not os.path.exists(segment)
+    assert b"".join(body) == data
+    body.close()
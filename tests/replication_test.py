@@ -0,0 +1,135 @@
+import importlib
+import os
+import shutil
+import time
+
+import requests
+from helpers import CLUSTER_AUTH_TOKEN as AUTH_TOKEN
+
+from tinydist.ring import HashRing
+
+cli = importlib.import_module("tinydist.cli")
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.05)
+
+
+def held_by(node, filename):
+    """Whether `node` serves `filename` itself, without failing over."""
+    response = requests.get(
+        f"{node.url}get", params={"filename": filename, "failover": "0"}
+    )
+    return response.status_code == 200
+
+
+def test_uploads_are_replicated_per_category(start_nodes, tmp_path):
+    nodes = start_nodes(3, REPLICAS="2", CATEGORY_REPLICAS="targets=3")
+    by_url = {node.url: node for node in nodes}
+    ring = HashRing(node.url for node in nodes)
+    session = cli.make_session()
+
+    model = tmp_path / "model.bin"
+    model.write_bytes(os.urandom(2000))
+    target = tmp_path / "target.npz"
+    target.write_bytes(os.urandom(500))
+    cli.upload_file(str(model), "default", session=session)
+    cli.upload_file(str(target), "targets", session=session)
+
+    owner, replica = (by_url[url] for url in ring.nodes_for(model.name, 2))
+    (outsider,) = [node for node in nodes if node not in (owner, replica)]
+    wait_for(lambda: held_by(replica, model.name))
+    wait_for(lambda: all(held_by(node, target.name) for node in nodes))
+    assert not held_by(outsider, model.name)
+
+    # Nodes without a copy, or that lost theirs, redirect to a replica.
+    response = requests.get(f"{outsider.url}get", params={"filename": model.name})
+    assert response.content == model.read_bytes()
+    os.remove(os.path.join(owner.directory, "files", model.name))
+    response = requests.get(f"{owner.url}get", params={"filename": model.name})
+    assert response.history[0].status_code == 307
+    assert response.content == model.read_bytes()
+
+    # The CLI falls back to a replica when the owner is down.
+    owner.stop()
+    path = cli.download_file(session, filename=model.name, output_dir=str(tmp_path))
+    assert open(path, "rb").read() == model.read_bytes()
+
+
+def test_anti_entropy_repairs_missed_replicas(start_nodes, tmp_path):
+    settings = {"REPLICAS": "2"}
+    nodes = start_nodes(2, **settings)
+    ring = HashRing(node.url for node in nodes)
+    session = cli.make_session()
+    headers = {"Authorization": AUTH_TOKEN}
+
+    first = tmp_path / "first.bin"
+    first.write_bytes(b"first version")
+    cli.upload_file(str(first), "default", session=session)
+    owner = next(node for node in nodes if node.url == ring.node_for(first.name))
+    replica = next(node for node in nodes if node is not owner)
+    wait_for(lambda: held_by(replica, first.name))
+
+    # The replica loses its disk while down, missing an update meanwhile.
+    replica.stop()
+    shutil.rmtree(replica.directory)
+    os.makedirs(os.path.join(replica.directory, "files"))
+    first.write_bytes(b"second version")
+    cli.upload_file(str(first), "default", session=session)
+    replica.start(nodes, **settings)
+    assert not held_by(replica, first.name)
+
+    response = requests.post(f"{owner.url}sync", headers=headers)
+    assert response.json()["pushed"] == 1
+    response = requests.get(
+        f"{replica.url}get", params={"filename": first.name, "failover": "0"}
+    )
+    assert response.content == b"second version"
+    # Nothing differs any more, so a second pass moves nothing.
+    assert requests.post(f"{owner.url}sync", headers=headers).json()["pushed"] == 0
+
+    requests.delete(
+        f"{owner.url}delete", params={"filename": first.name}, headers=headers
+    )
+    wait_for(lambda: not held_by(replica, first.name))
+
+
+def test_anti_entropy_passes_on_missed_deletes(start_nodes, tmp_path):
+    settings = {"REPLICAS": "2"}
+    nodes = start_nodes(2, **settings)
+    ring = HashRing(node.url for node in nodes)
+    session = cli.make_session()
+    headers = {"Authorization": AUTH_TOKEN}
+
+    doomed = tmp_path / "doomed.bin"
+    doomed.write_bytes(b"to be deleted")
+    cli.upload_file(str(doomed), "default", session=session)
+    owner = next(node for node in nodes if node.url == ring.node_for(doomed.name))
+    replica = next(node for node in nodes if node is not owner)
+    wait_for(lambda: held_by(replica, doomed.name))
+
+    # The replica is down while the file is deleted, so it keeps its copy.
+    replica.stop()
+    response = requests.delete(
+        f"{owner.url}delete", params={"filename": doomed.name}, headers=headers
+    )
+    assert response.status_code == 200
+    replica.start(nodes, **settings)
+    assert held_by(replica, doomed.name)
+
+    # The replica's pass must not restore the file on the owner...
+    assert requests.post(f"{replica.url}sync", headers=headers).json()["pushed"] == 0
+    assert not held_by(owner, doomed.name)
+    # ...and the owner's deletes the replica's copy.
+    assert requests.post(f"{owner.url}sync", headers=headers).json()["pushed"] == 1
+    assert not held_by(replica, doomed.name)
+    for node in nodes:
+        response = requests.post(f"{node.url}sync", headers=headers)
+        assert response.json()["pushed"] == 0
+
+    # Uploading it again wins over the tombstones.
+    cli.upload_file(str(doomed), "default", session=session)
+    wait_for(lambda: held_by(replica, doomed.name))
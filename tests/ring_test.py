@@ -0,0 +1,30 @@
+from tinydist.ring import HashRing
+
+KEYS = [f"data_{i}.npz" for i in range(2000)]
+
+
+def test_keys_spread_over_nodes():
+    ring = HashRing(["http://a:1", "http://b:1/", "http://c:1"])
+    assert ring.nodes == ["http://a:1/", "http://b:1/", "http://c:1/"]
+    counts = {node: 0 for node in ring.nodes}
+    for key in KEYS:
+        counts[ring.node_for(key)] += 1
+    assert min(counts.values()) > len(KEYS) / 6
+
+
+def test_adding_a_node_only_moves_keys_to_it():
+    before = HashRing(["http://a:1", "http://b:1", "http://c:1"])
+    after = HashRing(["http://a:1", "http://b:1", "http://c:1", "http://d:1"])
+    moved = [key for key in KEYS if before.node_for(key) != after.node_for(key)]
+    assert all(after.node_for(key) == "http://d:1/" for key in moved)
+    assert len(moved) < len(KEYS) / 2
+    assert before.version != after.version
+
+
+def test_replica_nodes_are_distinct_and_round_trip():
+    ring = HashRing(["http://a:1", "http://b:1", "http://c:1"], vnodes=16)
+    nodes = ring.nodes_for("model.bin", 5)
+    assert sorted(nodes) == ring.nodes
+    assert nodes[0] == ring.node_for("model.bin")
+    assert HashRing.from_dict(ring.to_dict()).nodes_for("model.bin", 3) == nodes
+    assert HashRing().node_for("model.bin") is None
@@ -0,0 +1,86 @@
+import io
+import os
+import subprocess
+import sys
+import time
+
+from helpers import REPO_ROOT
+
+from tinydist.scrubber import MISMATCH, OK, hash_segments, scrub
+from tinydist.store import get_metadata, lookup_file
+from tinydist.utils import Segment, quarantine_directory
+
+AUTH_TOKEN = os.getenv("AUTH_TOKEN")
+
+
+def upload(client, name, content):
+    response = client.post(
+        "/upload",
+        data={"file": (io.BytesIO(content), name), "category": "scrubbed"},
+        content_type="multipart/form-data",
+        headers={"Authorization": AUTH_TOKEN},
+    )
+    assert response.status_code == 200
+
+
+def test_scrub_records_results_and_quarantines_mismatches(client):
+    upload(client, "intact.bin", b"intact" * 1000)
+    upload(client, "rotten.bin", b"rotten" * 1000)
+    path = get_metadata("rotten.bin")["path"]
+    with open(path, "r+b") as f:
+        f.seek(100)
+        f.write(b"X")
+
+    summary = scrub(workers=2, max_mbps=0, quarantine_mismatches=True)
+    assert summary["mismatch"] == ["rotten.bin"]
+    assert summary["quarantined"] == ["rotten.bin"]
+    assert not os.path.exists(path)
+    assert any(
+        name.startswith("rotten.bin.") for name in os.listdir(quarantine_directory)
+    )
+    assert get_metadata("rotten.bin")["verify_result"] == MISMATCH
+    intact = get_metadata("intact.bin")
+    assert intact["verify_result"] == OK and intact["verified_at"]
+    assert lookup_file("intact.bin", False)
+
+    # Everything was just verified, so an incremental pass has nothing to do.
+    assert scrub(days=1, workers=1)["checked"] == 0
+    # Re-uploading clears the result, so the new version is checked again.
+    upload(client, "intact.bin", b"replaced")
+    assert get_metadata("intact.bin")["verify_result"] is None
+    assert scrub(days=1, workers=1)["checked"] == 1
+
+
+def test_hash_segments_is_throttled(tmp_path):
+    path = tmp_path / "data.bin"
+    path.write_bytes(b"x" * 200_000)
+    started = time.monotonic()
+    hash_segments([Segment(str(path), 0, 200_000)], rate=1_000_000)
+    assert time.monotonic() - started >= 0.19
+
+
+def test_importing_the_server_starts_nothing(tmp_path):
+    # Spawned scrub workers import the server again when it runs as a script.
+    env = dict(
+        os.environ,
+        PYTHONPATH=REPO_ROOT,
+        DATABASE_NAME="metadata.db",
+        SCRUB_INTERVAL="1",
+        ANTI_ENTROPY_INTERVAL="1",
+        CLUSTER_NODES="http://127.0.0.1:1/",
+        NODE_URL="http://127.0.0.1:1/",
+    )
+    output = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import threading, tinydist.server; print(threading.active_count())",
+        ],
+        cwd=tmp_path,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    assert output.split() == ["1"]
+    assert not (tmp_path / "metadata.db").exists()
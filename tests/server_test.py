@@ -1,8 +1,16 @@
+import hashlib
 import io
 import json
 import os
+import tarfile
+import zipfile
 
 import dotenv
+from helpers import unique_name
+
+from tinydist.archive import ArchiveEntry, iter_tar
+from tinydist.store import get_metadata
+from tinydist.utils import CHUNK_SIZE, ChunkHasher, generate_file_stream, object_path
 
 dotenv.load_dotenv()
 
@@ -70,3 +78,492 @@ def test_upload_large_file(client):
 #     download_response = client.get(f'/get?filename={filename}')
 #     assert download_response.status_code == 200
 #     assert download_response.data == file_content
+
+
+def create_session(client, filename, file_size, chunk_size, resume=False):
+    return client.post(
+        "/upload_session",
+        json={
+            "filename": filename,
+            "category": "default",
+            "file_size": file_size,
+            "chunk_size": chunk_size,
+            "resume": resume,
+        },
+        headers={"Authorization": AUTH_TOKEN},
+    )
+
+
+def test_upload_session_out_of_order(client):
+    content = b"0123456789" * 25
+    response = create_session(client, "session.txt", len(content), 100)
+    assert response.status_code == 201
+    session = json.loads(response.data.decode("utf-8"))
+    assert session["missing"] == [0, 1, 2]
+    session_url = f"/upload_session/{session['session_id']}"
+
+    for index in (2, 0):
+        response = client.put(
+            f"{session_url}/{index}",
+            data=content[index * 100 : (index + 1) * 100],
+            headers={"Authorization": AUTH_TOKEN},
+        )
+        assert response.status_code == 200
+
+    response = client.post(
+        f"{session_url}/finalize", json={}, headers={"Authorization": AUTH_TOKEN}
+    )
+    assert response.status_code == 409
+    assert json.loads(response.data.decode("utf-8"))["missing"] == [1]
+
+    response = create_session(client, "session.txt", len(content), 100, resume=True)
+    assert json.loads(response.data.decode("utf-8"))["session_id"] == (
+        session["session_id"]
+    )
+
+    response = client.put(
+        f"{session_url}/1", data=content[100:200], headers={"Authorization": AUTH_TOKEN}
+    )
+    assert response.status_code == 200
+    response = client.post(
+        f"{session_url}/finalize", json={}, headers={"Authorization": AUTH_TOKEN}
+    )
+    assert response.status_code == 200
+    response = client.get(session_url, headers={"Authorization": AUTH_TOKEN})
+    assert response.status_code == 404
+
+
+def test_upload_session_rejects_wrong_chunk_size(client):
+    response = create_session(client, "short.txt", 150, 100)
+    session = json.loads(response.data.decode("utf-8"))
+    response = client.put(
+        f"/upload_session/{session['session_id']}/0",
+        data=b"too short",
+        headers={"Authorization": AUTH_TOKEN},
+    )
+    assert response.status_code == 400
+
+
+def upload_session_chunks(client, filename, content, chunk_size):
+    response = create_session(client, filename, len(content), chunk_size)
+    session = json.loads(response.data.decode("utf-8"))
+    for index in session["missing"]:
+        client.put(
+            f"/upload_session/{session['session_id']}/{index}",
+            data=content[index * chunk_size : (index + 1) * chunk_size],
+            headers={"Authorization": AUTH_TOKEN},
+        )
+    return session["session_id"]
+
+
+def test_finalize_assembles_parts_in_numeric_order(client):
+    content = bytes(range(12)) * 10
+    session_id = upload_session_chunks(client, "assembled.bin", content, 10)
+    response = client.post(
+        f"/upload_session/{session_id}/finalize",
+        json={"checksum": hashlib.sha256(content).hexdigest(), "assemble": True},
+        headers={"Authorization": AUTH_TOKEN},
+    )
+    assert response.status_code == 200
+    with open(os.path.join("files", "assembled.bin"), "rb") as f:
+        assert f.read() == content
+    assert not os.path.exists(os.path.join("files", "assembled.bin_chunks"))
+
+
+def test_finalize_assemble_rejects_checksum_mismatch(client):
+    client.put(
+        "/upload/mismatch.bin", data=b"old", headers={"Authorization": AUTH_TOKEN}
+    )
+    content = b"x" * 30
+    session_id = upload_session_chunks(client, "mismatch.bin", content, 10)
+    response = client.post(
+        f"/upload_session/{session_id}/finalize",
+        json={"checksum": "0" * 64, "assemble": True},
+        headers={"Authorization": AUTH_TOKEN},
+    )
+    assert response.status_code == 400
+    # The stored version is untouched and the session is dropped.
+    assert client.get("/get?filename=mismatch.bin").data == b"old"
+    response = client.get(
+        f"/upload_session/{session_id}", headers={"Authorization": AUTH_TOKEN}
+    )
+    assert response.status_code == 404
+    session_id = upload_session_chunks(client, "mismatch.bin", content, 10)
+    response = client.post(
+        f"/upload_session/{session_id}/finalize",
+        json={"checksum": hashlib.sha256(content).hexdigest(), "assemble": True},
+        headers={"Authorization": AUTH_TOKEN},
+    )
+    assert response.status_code == 200
+    assert client.get("/get?filename=mismatch.bin").data == content
+
+
+def test_finalize_stores_the_checksum_of_the_received_parts(client):
+    content = os.urandom(25)
+    filename = unique_name("declared.bin")
+    session_id = upload_session_chunks(client, filename, content, 10)
+    response = client.post(
+        f"/upload_session/{session_id}/finalize",
+        json={"checksum": "not-a-checksum"},
+        headers={"Authorization": AUTH_TOKEN},
+    )
+    assert response.status_code == 400
+    assert get_metadata(filename) is None
+    session_id = upload_session_chunks(client, filename, content, 10)
+    response = client.post(
+        f"/upload_session/{session_id}/finalize",
+        json={},
+        headers={"Authorization": AUTH_TOKEN},
+    )
+    assert response.status_code == 200
+    checksum = hashlib.sha256(content).hexdigest()
+    assert get_metadata(filename)["checksum"] == checksum
+    assert client.get(f"/get?filename={filename}").headers["ETag"] == f'"{checksum}"'
+
+
+def test_chunk_stream_uses_numeric_part_order(tmp_path):
+    for index in range(12):
+        (tmp_path / f"data.part{index}").write_bytes(bytes([index]))
+    assert b"".join(generate_file_stream(str(tmp_path))) == bytes(range(12))
+
+
+def test_get_range_of_single_file(client):
+    upload_dummy_file(client, filename="ranged.txt", content=b"0123456789")
+    response = client.get("/get?filename=ranged.txt", headers={"Range": "bytes=2-5"})
+    assert response.status_code == 206
+    assert response.data == b"2345"
+
+
+def test_get_range_across_chunk_parts(client):
+    content = bytes(range(256)) * 2
+    session_id = upload_session_chunks(client, "ranged.bin", content, 100)
+    client.post(
+        f"/upload_session/{session_id}/finalize",
+        json={},
+        headers={"Authorization": AUTH_TOKEN},
+    )
+
+    response = client.get("/get?filename=ranged.bin")
+    assert response.status_code == 200
+    assert response.data == content
+    etag = response.headers["ETag"]
+
+    response = client.get(
+        "/get?filename=ranged.bin", headers={"Range": "bytes=150-349", "If-Range": etag}
+    )
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == f"bytes 150-349/{len(content)}"
+    assert response.data == content[150:350]
+
+    response = client.get(
+        "/get?filename=ranged.bin",
+        headers={"Range": "bytes=150-349", "If-Range": '"stale"'},
+    )
+    assert response.status_code == 200
+    assert response.data == content
+
+    response = client.get("/get?filename=ranged.bin", headers={"Range": "bytes=900-"})
+    assert response.status_code == 416
+
+
+def test_lookup_cache_is_invalidated_on_upload_and_delete(client):
+    upload_dummy_file(client, filename="cached.txt", content=b"first")
+    assert client.get("/get?filename=cached.txt").data == b"first"
+    hits = client.get("/cache_stats", headers={"Authorization": AUTH_TOKEN}).get_json()[
+        "hits"
+    ]
+    assert client.get("/get?filename=cached.txt").data == b"first"
+    stats = client.get("/cache_stats", headers={"Authorization": AUTH_TOKEN}).get_json()
+    assert stats["hits"] == hits + 1
+
+    session_id = upload_session_chunks(client, "cached.txt", b"second", 3)
+    client.post(
+        f"/upload_session/{session_id}/finalize",
+        json={},
+        headers={"Authorization": AUTH_TOKEN},
+    )
+    assert client.get("/get?filename=cached.txt").data == b"second"
+
+    client.delete("/delete?filename=cached.txt", headers={"Authorization": AUTH_TOKEN})
+    assert client.get("/get?filename=cached.txt").status_code == 404
+
+
+def test_metadata_keyset_pagination(client):
+    for index in range(5):
+        upload_dummy_file(client, filename=f"page{index}.txt", category="paged")
+    seen = []
+    cursor = None
+    while True:
+        url = "/metadata?category=paged&limit=2&fields=filename,size"
+        if cursor:
+            url += f"&cursor={cursor}"
+        response = client.get(url, headers={"Authorization": AUTH_TOKEN})
+        rows = response.get_json()
+        assert all(set(row) == {"filename", "size"} for row in rows)
+        seen.extend(row["filename"] for row in rows)
+        cursor = response.headers.get("X-Next-Cursor")
+        if not cursor:
+            break
+    assert seen == [f"page{index}.txt" for index in reversed(range(5))]
+    for limit in (0, -1):
+        response = client.get(
+            f"/metadata?category=paged&limit={limit}",
+            headers={"Authorization": AUTH_TOKEN},
+        )
+        assert response.status_code == 400
+
+
+def test_metadata_filters_and_ndjson_stream(client):
+    upload_dummy_file(client, filename="prefix_a.txt", content=b"a" * 10)
+    upload_dummy_file(client, filename="prefix_b.txt", content=b"b" * 100)
+    response = client.get(
+        "/metadata?format=ndjson&prefix=prefix_&min_size=50&fields=filename,size",
+        headers={"Authorization": AUTH_TOKEN},
+    )
+    assert response.mimetype == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.data.decode().splitlines()]
+    assert lines == [{"filename": "prefix_b.txt", "size": 100}]
+
+    response = client.get(
+        "/metadata?fields=nope", headers={"Authorization": AUTH_TOKEN}
+    )
+    assert response.status_code == 400
+
+
+def test_files_streams_zip_of_plain_and_chunked_files(client):
+    upload_dummy_file(client, filename="zipped.txt", content=b"plain file")
+    content = os.urandom(250)
+    session_id = upload_session_chunks(client, "zipped.bin", content, 100)
+    client.post(
+        f"/upload_session/{session_id}/finalize",
+        json={},
+        headers={"Authorization": AUTH_TOKEN},
+    )
+
+    response = client.get(
+        "/files?filename=zipped.txt&filename=zipped.bin",
+        headers={"Authorization": AUTH_TOKEN},
+    )
+    assert response.status_code == 200
+    assert response.is_streamed
+    with zipfile.ZipFile(io.BytesIO(response.data)) as archive:
+        assert archive.read("zipped.txt") == b"plain file"
+        assert archive.read("zipped.bin") == content
+
+
+def test_files_streams_tar_by_category(client):
+    upload_dummy_file(client, filename="tarred1.txt", content=b"one", category="tar")
+    upload_dummy_file(client, filename="tarred2.txt", content=b"two", category="tar")
+    response = client.get(
+        "/files?category=tar&format=tar", headers={"Authorization": AUTH_TOKEN}
+    )
+    with tarfile.open(fileobj=io.BytesIO(response.data)) as archive:
+        contents = {
+            member.name: archive.extractfile(member).read() for member in archive
+        }
+    assert contents == {"tarred1.txt": b"one", "tarred2.txt": b"two"}
+
+    response = client.get("/files?id=999999", headers={"Authorization": AUTH_TOKEN})
+    assert response.status_code == 404
+
+
+def test_upload_batch_from_tar_stream(client):
+    entries = [
+        ArchiveEntry(name, len(data), 0, hashlib.sha256(data).hexdigest(), [data])
+        for name, data in (("batch1.txt", b"one"), ("batch2.txt", b"two"))
+    ]
+    response = client.post(
+        "/upload_batch?category=batch",
+        data=b"".join(iter_tar(entries)),
+        headers={"Authorization": AUTH_TOKEN},
+    )
+    assert response.status_code == 200
+    assert response.get_json()["filenames"] == ["batch1.txt", "batch2.txt"]
+
+    response = client.get(
+        "/metadata?category=batch&fields=filename,checksum,size",
+        headers={"Authorization": AUTH_TOKEN},
+    )
+    rows = {row["filename"]: row for row in response.get_json()}
+    assert rows["batch2.txt"]["size"] == 3
+    assert rows["batch2.txt"]["checksum"] == hashlib.sha256(b"two").hexdigest()
+
+    response = client.post(
+        "/upload_batch", data=b"not a tar", headers={"Authorization": AUTH_TOKEN}
+    )
+    assert response.status_code == 400
+
+
+def test_put_upload_stores_server_computed_checksum(client):
+    content = b"streamed body"
+    response = client.put(
+        "/upload/streamed.txt?category=raw",
+        data=content,
+        headers={
+            "Authorization": AUTH_TOKEN,
+            "X-Checksum": hashlib.sha256(content).hexdigest(),
+        },
+    )
+    assert response.status_code == 200
+    assert response.get_json()["checksum"] == hashlib.sha256(content).hexdigest()
+    response = client.post(
+        "/verify_get",
+        data={
+            "filename": "streamed.txt",
+            "checksum": hashlib.sha256(content).hexdigest(),
+        },
+    )
+    assert response.status_code == 200
+
+    response = client.put(
+        "/upload/streamed.txt",
+        data=b"corrupted body",
+        headers={"Authorization": AUTH_TOKEN, "X-Checksum": "0" * 64},
+    )
+    assert response.status_code == 400
+    assert client.get("/get?filename=streamed.txt").data == content
+
+
+def test_multipart_upload_records_checksum(client):
+    upload_dummy_file(client, filename="hashed.txt", content=b"hash me")
+    response = client.post(
+        "/verify_get",
+        data={
+            "filename": "hashed.txt",
+            "checksum": hashlib.sha256(b"hash me").hexdigest(),
+        },
+    )
+    assert response.status_code == 200
+
+
+def test_content_addressed_upload_shares_and_frees_chunks(client):
+    headers = {"Authorization": AUTH_TOKEN}
+    shared, first_tail, second_tail = (os.urandom(size) for size in (100, 5, 6))
+    first_name = unique_name("cas_first.bin")
+    second_name = unique_name("cas_second.bin")
+    digest = {data: hashlib.sha256(data).hexdigest() for data in (shared, first_tail)}
+
+    response = client.post(
+        "/cas/have", json={"hashes": list(digest.values())}, headers=headers
+    )
+    assert response.get_json()["missing"] == list(digest.values())
+    for data, chunk_hash in digest.items():
+        assert client.put(f"/cas/chunk/{chunk_hash}", data=data, headers=headers)
+    response = client.put(f"/cas/chunk/{'0' * 64}", data=b"not zeros", headers=headers)
+    assert response.status_code == 400
+
+    first = {
+        "filename": first_name,
+        "checksum": hashlib.sha256(shared + first_tail).hexdigest(),
+        "chunks": [digest[shared], digest[first_tail]],
+    }
+    assert client.post("/cas/commit", json=first, headers=headers).status_code == 200
+
+    # A second version only has to send the chunk the server lacks.
+    second_hash = hashlib.sha256(second_tail).hexdigest()
+    second = {
+        "filename": second_name,
+        "chunks": [digest[shared], second_hash],
+    }
+    response = client.post(
+        "/cas/have", json={"hashes": second["chunks"]}, headers=headers
+    )
+    assert response.get_json()["missing"] == [second_hash]
+    response = client.post("/cas/commit", json=second, headers=headers)
+    assert response.status_code == 409
+    assert response.get_json()["missing"] == [second_hash]
+    client.put(f"/cas/chunk/{second_hash}", data=second_tail, headers=headers)
+    wrong = dict(second, checksum="not-a-checksum")
+    assert client.post("/cas/commit", json=wrong, headers=headers).status_code == 400
+    assert client.post("/cas/commit", json=second, headers=headers).status_code == 200
+    # The checksum is computed by the server even when none is declared.
+    assert get_metadata(second_name)["checksum"] == (
+        hashlib.sha256(shared + second_tail).hexdigest()
+    )
+
+    assert client.get(f"/get?filename={first_name}").data == shared + first_tail
+    response = client.get(
+        f"/get?filename={second_name}", headers={"Range": "bytes=98-103"}
+    )
+    assert response.status_code == 206
+    assert response.data == shared[-2:] + second_tail[:4]
+
+    client.delete(f"/delete?filename={first_name}", headers=headers)
+    assert not os.path.exists(object_path(digest[first_tail]))
+    assert os.path.exists(object_path(digest[shared]))
+    assert client.get(f"/get?filename={second_name}").data == shared + second_tail
+
+
+def test_chunk_hasher_splits_at_chunk_boundaries():
+    content = os.urandom(2500)
+    hasher = ChunkHasher(1000)
+    for start in range(0, len(content), 700):
+        hasher.update(content[start : start + 700])
+    assert hasher.digests() == [
+        (size, hashlib.sha256(content[start : start + size]).hexdigest())
+        for start, size in ((0, 1000), (1000, 1000), (2000, 500))
+    ]
+
+
+def test_manifest_lists_chunk_checksums(client):
+    def manifest(filename):
+        response = client.get(f"/manifest?filename={filename}")
+        assert response.status_code == 200
+        return response.get_json()
+
+    content = os.urandom(CHUNK_SIZE + 100)
+    client.put(
+        "/upload/manifested.bin", data=content, headers={"Authorization": AUTH_TOKEN}
+    )
+    data = manifest("manifested.bin")
+    assert data["size"] == len(content)
+    assert data["checksum"] == hashlib.sha256(content).hexdigest()
+    assert data["chunks"] == [
+        {
+            "offset": offset,
+            "size": size,
+            "sha256": hashlib.sha256(content[offset : offset + size]).hexdigest(),
+        }
+        for offset, size in ((0, CHUNK_SIZE), (CHUNK_SIZE, 100))
+    ]
+
+    # Session chunks are hashed as they arrive.
+    content = bytes(range(50)) * 5
+    session_id = upload_session_chunks(client, "session_manifest.bin", content, 100)
+    client.post(
+        f"/upload_session/{session_id}/finalize", headers={"Authorization": AUTH_TOKEN}
+    )
+    chunks = manifest("session_manifest.bin")["chunks"]
+    assert [chunk["size"] for chunk in chunks] == [100, 100, 50]
+    assert chunks[2]["sha256"] == hashlib.sha256(content[200:]).hexdigest()
+
+    client.delete(
+        "/delete?filename=session_manifest.bin", headers={"Authorization": AUTH_TOKEN}
+    )
+    assert client.get("/manifest?filename=session_manifest.bin").status_code == 404
+
+
+def test_get_revalidates_with_checksum_etag(client):
+    content = b"revalidated" * 100
+    client.put(
+        "/upload/revalidated.bin", data=content, headers={"Authorization": AUTH_TOKEN}
+    )
+    checksum = hashlib.sha256(content).hexdigest()
+    session_id = upload_session_chunks(client, "revalidated_chunks.bin", content, 500)
+    client.post(
+        f"/upload_session/{session_id}/finalize",
+        json={"checksum": checksum},
+        headers={"Authorization": AUTH_TOKEN},
+    )
+    etag = f'"{checksum}"'
+    for filename in ("revalidated.bin", "revalidated_chunks.bin"):
+        response = client.get(
+            f"/get?filename={filename}", headers={"If-None-Match": '"stale"'}
+        )
+        assert response.data == content
+        assert response.headers["ETag"] == etag
+        response = client.get(
+            f"/get?filename={filename}", headers={"If-None-Match": etag}
+        )
+        assert response.status_code == 304
+        assert response.data == b""
@@ -0,0 +1,58 @@
+import os
+
+from helpers import unique_name
+
+from tinydist import store
+
+
+def test_schema_is_migrated_with_wal_and_indexes(client):
+    with store.connection() as conn:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        journal_mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+        indexes = {
+            row[0]
+            for row in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index'"
+            )
+        }
+    assert version == len(store.MIGRATIONS)
+    assert journal_mode == "wal"
+    assert {"metadata_category", "metadata_upload_timestamp"} <= indexes
+
+
+def test_init_db_is_idempotent(client):
+    store.init_db()
+    store.init_db()
+
+
+def test_lookups_by_id_and_filename(client):
+    store.upsert_metadata("store.txt", "files/store.txt", "default", "abc")
+    with store.connection() as conn:
+        file_id = conn.execute(
+            "SELECT id FROM metadata WHERE filename = 'store.txt'"
+        ).fetchone()[0]
+    assert store.get_path(file_id, True) == "files/store.txt"
+    assert store.get_path("store.txt", False) == "files/store.txt"
+    assert store.get_checksum("store.txt") == ("abc",)
+    assert store.get_path("missing.txt", False) is None
+
+
+def test_uncommitted_chunks_are_kept_for_a_grace_period(client):
+    fresh, committed = os.urandom(32).hex(), os.urandom(32).hex()
+    filename = unique_name("grace.bin")
+    store.add_chunk(fresh, 5)
+    store.add_chunk(committed, 5)
+    assert store.commit_manifest(filename, "default", None, [committed]) == (
+        [],
+        None,
+    )
+    with store.connection() as conn:
+        store.release_manifest(conn, filename)
+    # Released chunks go at once; ones never committed wait out the grace.
+    removed = store.remove_unreferenced_chunks()
+    assert committed in removed and fresh not in removed
+    assert fresh in store.remove_unreferenced_chunks(grace=-1)
+    assert store.commit_manifest(filename, "default", None, [fresh]) == (
+        [fresh],
+        None,
+    )
@@ -0,0 +1,185 @@
+import importlib
+import io
+import os
+import time
+
+import requests
+from helpers import CLUSTER_AUTH_TOKEN, unique_name
+
+from tinydist.store import (
+    COLD_STORAGE,
+    flush_accesses,
+    get_metadata,
+    lookup_file,
+    record_access,
+)
+from tinydist.tiering import demote, eviction_order
+from tinydist.utils import cold_path
+
+cli = importlib.import_module("tinydist.cli")
+
+AUTH_TOKEN = os.getenv("AUTH_TOKEN")
+
+
+def upload(client, name, content, category="default"):
+    response = client.post(
+        "/upload",
+        data={"file": (io.BytesIO(content), name), "category": category},
+        content_type="multipart/form-data",
+        headers={"Authorization": AUTH_TOKEN},
+    )
+    assert response.status_code == 200
+
+
+def test_accesses_are_buffered_then_flushed(client):
+    filename = unique_name("counted.txt")
+    upload(client, filename, b"counted")
+    flush_accesses()
+    file_id = get_metadata(filename)["id"]
+    for _ in range(3):
+        record_access(file_id)
+    assert get_metadata(filename)["access_count"] == 0
+
+    assert flush_accesses() == 1  # One row updated for all three.
+    row = get_metadata(filename)
+    assert row["access_count"] == 3
+    assert row["last_accessed"] is not None
+    assert flush_accesses() == 0
+
+
+def test_eviction_order_ranks_each_category_by_its_policy():
+    def row(name, category, last_accessed, access_count):
+        return {
+            "filename": name,
+            "category": category,
+            "last_accessed": last_accessed,
+            "upload_timestamp": "2024-01-01",
+            "access_count": access_count,
+            "size": 1,
+        }
+
+    rows = [
+        row("recent-rare", "targets", "2024-03-01", 1),
+        row("old-frequent", "targets", "2024-02-01", 50),
+        row("recent", "default", "2024-03-01", 0),
+        row("never-read", "default", None, 0),
+    ]
+    order = [row["filename"] for row in eviction_order(rows, "lru", {})]
+    assert order.index("never-read") < order.index("recent")
+    assert order.index("old-frequent") < order.index("recent-rare")
+
+    order = [row["filename"] for row in eviction_order(rows, "lru", {"targets": "lfu"})]
+    assert order.index("recent-rare") < order.index("old-frequent")
+    # Categories give up their coldest files in turn.
+    assert {order[0], order[1]} == {"never-read", "recent-rare"}
+
+
+def test_cold_files_are_promoted_when_read(client):
+    filename = unique_name("archived.bin")
+    content = b"cold data " * 1000
+    upload(client, filename, content)
+    assert demote(get_metadata(filename))
+
+    file_id, _, path, _, storage = lookup_file(filename, False)
+    assert storage == COLD_STORAGE and path == cold_path(filename)
+    assert not os.path.exists(os.path.join("files", filename))
+    assert os.path.getsize(path) < len(content)
+
+    response = client.get(f"/get?id={file_id}")
+    assert response.data == content
+    assert lookup_file(filename, False)[4] is None
+    assert not os.path.exists(path)
+    assert get_metadata(filename)["access_count"] == 1
+
+
+def test_uploading_again_discards_the_cold_copy(client):
+    upload(client, "replaced.txt", b"old")
+    assert demote(get_metadata("replaced.txt"))
+    upload(client, "replaced.txt", b"new")
+    assert not os.path.exists(cold_path("replaced.txt"))
+    assert client.get("/get?filename=replaced.txt").data == b"new"
+
+
+def test_demote_leaves_a_file_uploaded_again_meanwhile(client):
+    upload(client, "raced.txt", b"old")
+    row = get_metadata("raced.txt")
+    time.sleep(0.01)
+    upload(client, "raced.txt", b"new")
+    # The new upload has the path the stale row was read with.
+    assert not demote(row)
+    assert get_metadata("raced.txt")["storage"] is None
+    assert not os.path.exists(cold_path("raced.txt"))
+    assert client.get("/get?filename=raced.txt").data == b"new"
+
+
+def test_quota_moves_least_recently_used_files_off(start_nodes, tmp_path):
+    (node,) = start_nodes(1, DISK_QUOTA_MB=str(10_000 / 1024 / 1024))
+    headers = {"Authorization": CLUSTER_AUTH_TOKEN}
+    contents = {f"shard{i}.bin": os.urandom(4000) for i in range(3)}
+
+    def tiering():
+        return requests.get(f"{node.url}tiering", headers=headers).json()
+
+    def wait_until_within_quota():
+        deadline = time.monotonic() + 10
+        while (stats := tiering())["hot_bytes"] > 9_000:
+            assert time.monotonic() < deadline, stats
+            time.sleep(0.05)
+        return stats
+
+    for name, content in contents.items():
+        response = requests.put(
+            f"{node.url}upload/{name}", data=content, headers=headers
+        )
+        assert response.status_code == 200
+    assert wait_until_within_quota()["cold_files"] == 1
+    assert os.path.exists(os.path.join(node.directory, "cold", "shard0.bin.gz"))
+
+    # Reading the coldest file brings it back; the next coldest makes way.
+    assert node.get("shard0.bin").content == contents["shard0.bin"]
+    stats = wait_until_within_quota()
+    assert stats["cold_files"] == 1
+    assert os.path.exists(os.path.join(node.directory, "cold", "shard1.bin.gz"))
+    assert os.path.exists(os.path.join(node.directory, "files", "shard0.bin"))
+
+
+def test_quota_below_the_data_that_cannot_move(start_nodes, tmp_path):
+    (node,) = start_nodes(1, DISK_QUOTA_MB=str(50_000 / 1024 / 1024), PACK_MAX_KB="16")
+    headers = {"Authorization": CLUSTER_AUTH_TOKEN}
+
+    def tiering():
+        return requests.get(f"{node.url}tiering", headers=headers).json()
+
+    def wait_until_within_quota():
+        deadline = time.monotonic() + 10
+        while (stats := tiering())["hot_bytes"] > 45_000:
+            assert time.monotonic() < deadline, stats
+            time.sleep(0.05)
+        return stats
+
+    # Packed files share their segment and cannot move off: 60 KB of them.
+    for i in range(15):
+        response = requests.put(
+            f"{node.url}upload/packed{i}.bin", data=os.urandom(4000), headers=headers
+        )
+        assert response.status_code == 200
+    assert tiering()["hot_bytes"] == 0
+    chunked = tmp_path / "chunked.bin"
+    chunked.write_bytes(os.urandom(20_000))
+    cli.upload_file(str(chunked), "default", chunk_size=8192)
+    contents = {f"plain{i}.bin": os.urandom(20_000) for i in range(2)}
+    for name, content in contents.items():
+        response = requests.put(
+            f"{node.url}upload/{name}", data=content, headers=headers
+        )
+        assert response.status_code == 200
+
+    # Only the coldest file, a chunk directory, has to make way.
+    assert wait_until_within_quota()["cold_files"] == 1
+    assert not os.path.exists(
+        os.path.join(node.directory, "files", "chunked.bin_chunks")
+    )
+    assert node.get("chunked.bin").content == chunked.read_bytes()
+    assert wait_until_within_quota()["cold_files"] == 1
+    assert os.path.exists(os.path.join(node.directory, "files", "chunked.bin"))
+    assert os.path.exists(os.path.join(node.directory, "cold", "plain0.bin.gz"))
@@ -0,0 +1,83 @@
+import tarfile
+import time
+import zipfile
+from collections import namedtuple
+
+# One archive member: `chunks` yields its `size` bytes of content.
+ArchiveEntry = namedtuple("ArchiveEntry", "name size mtime checksum chunks")
+
+# PAX header carrying the stored SHA-256 so readers can verify as they unpack.
+CHECKSUM_PAX_HEADER = "TINYDIST.sha256"
+
+TAR_BLOCK_SIZE = tarfile.BLOCKSIZE
+
+
+def iter_tar(entries):
+    """
+    Yield a PAX tar archive of `entries` piece by piece. Member data is passed
+    through as it is read, so the archive is never held in memory.
+    """
+    for entry in entries:
+        info = tarfile.TarInfo(entry.name)
+        info.size = entry.size
+        info.mtime = entry.mtime
+        info.mode = 0o644
+        if entry.checksum:
+            info.pax_headers = {CHECKSUM_PAX_HEADER: entry.checksum}
+        yield info.tobuf(format=tarfile.PAX_FORMAT)
+        written = 0
+        for chunk in entry.chunks:
+            written += len(chunk)
+            yield chunk
+        if written != entry.size:
+            raise OSError(f"{entry.name} changed size while being archived")
+        if entry.size % TAR_BLOCK_SIZE:
+            yield b"\0" * (TAR_BLOCK_SIZE - entry.size % TAR_BLOCK_SIZE)
+    yield b"\0" * (2 * TAR_BLOCK_SIZE)
+
+
+class _StreamBuffer:
+    """Write-only file object whose contents are drained by a generator."""
+
+    def __init__(self):
+        self._parts = []
+        self._position = 0
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._parts)
+        self._parts.clear()
+        return data
+
+
+def iter_zip(entries):
+    """
+    Yield a ZIP archive of `entries` piece by piece, storing members
+    uncompressed and switching to ZIP64 records for large members. The output
+    is not seekable, so sizes and CRCs follow each member in data descriptors.
+    """
+    buffer = _StreamBuffer()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_STORED) as archive:
+        for entry in entries:
+            info = zipfile.ZipInfo(entry.name, time.localtime(entry.mtime)[:6])
+            info.compress_type = zipfile.ZIP_STORED
+            info.file_size = entry.size
+            info.external_attr = 0o644 << 16
+            with archive.open(info, "w") as member:
+                for chunk in entry.chunks:
+                    member.write(chunk)
+                    if data := buffer.drain():
+                        yield data
+            if data := buffer.drain():
+                yield data
+    yield buffer.drain()
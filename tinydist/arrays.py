@@ -0,0 +1,240 @@
+import io
+import itertools
+import math
+import mmap
+import os
+import struct
+import zipfile
+from collections import namedtuple
+
+import numpy as np
+
+from tinydist.utils import CHUNK_SIZE, iter_segments
+
+NPY_MAGIC = b"\x93NUMPY"
+ZIP_LOCAL_HEADER = struct.Struct("<4s22xHH")
+
+# One array of a stored `.npy` or `.npz`. `offset` is where its raw data starts
+# in the stored file, or None when the member is compressed.
+ArrayInfo = namedtuple(
+    "ArrayInfo", "name dtype shape fortran_order compressed offset member"
+)
+
+
+class SegmentReader(io.RawIOBase):
+    """Seekable read-only file over the concatenation of `segments`."""
+
+    def __init__(self, segments):
+        self.segments = segments
+        self.size = sum(segment.length for segment in segments)
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: self.size}
+        self.position = max(base[whence] + offset, 0)
+        return self.position
+
+    def readinto(self, buffer):
+        stop = min(self.position + len(buffer), self.size)
+        written = 0
+        for data in iter_segments(self.segments, self.position, stop):
+            buffer[written : written + len(data)] = data
+            written += len(data)
+        self.position += written
+        return written
+
+
+def read_npy_header(f):
+    """(dtype, shape, fortran_order) from the `.npy` header at the position of `f`."""
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+    elif version == (2, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+    else:
+        raise ValueError(f"Unsupported .npy format version {version}")
+    return dtype, shape, fortran_order
+
+
+def list_arrays(segments, filename):
+    """
+    The arrays of a stored `.npy` or `.npz` file, found by reading only the
+    zip directory and each member's header.
+    """
+    reader = SegmentReader(segments)
+    if reader.read(len(NPY_MAGIC)) == NPY_MAGIC:
+        reader.seek(0)
+        dtype, shape, fortran_order = read_npy_header(reader)
+        name = os.path.splitext(filename)[0]
+        return [
+            ArrayInfo(name, dtype, shape, fortran_order, False, reader.tell(), None)
+        ]
+    reader.seek(0)
+    try:
+        archive = zipfile.ZipFile(reader)
+    except zipfile.BadZipFile:
+        raise ValueError(f"{filename} is not a .npy or .npz file")
+
+    arrays = []
+    with archive:
+        for member in archive.infolist():
+            if not member.filename.endswith(".npy"):
+                continue
+            with archive.open(member) as f:
+                dtype, shape, fortran_order = read_npy_header(f)
+                header_size = f.tell()
+            compressed = member.compress_type != zipfile.ZIP_STORED
+            offset = None
+            if not compressed:
+                reader.seek(member.header_offset)
+                _, name_size, extra_size = ZIP_LOCAL_HEADER.unpack(
+                    reader.read(ZIP_LOCAL_HEADER.size)
+                )
+                offset = (
+                    member.header_offset
+                    + ZIP_LOCAL_HEADER.size
+                    + name_size
+                    + extra_size
+                    + header_size
+                )
+            arrays.append(
+                ArrayInfo(
+                    member.filename[: -len(".npy")],
+                    dtype,
+                    shape,
+                    fortran_order,
+                    compressed,
+                    offset,
+                    member.filename,
+                )
+            )
+    return arrays
+
+
+def describe(info):
+    """JSON-serialisable summary of an array."""
+    return {
+        "name": info.name,
+        "dtype": np.lib.format.dtype_to_descr(info.dtype),
+        "shape": list(info.shape),
+        "fortran_order": info.fortran_order,
+        "compressed": info.compressed,
+    }
+
+
+def row_range(info, start=None, stop=None):
+    """Clamp a row range of `info` like a slice does, or reject it for a scalar."""
+    if not info.shape:
+        if start is not None or stop is not None:
+            raise ValueError(f"{info.name} is a scalar and has no rows")
+        return None, None
+    return slice(start, stop).indices(info.shape[0])[:2]
+
+
+def npy_header(dtype, shape):
+    """A C-order `.npy` header for an array of `dtype` and `shape`."""
+    header = {
+        "descr": np.lib.format.dtype_to_descr(dtype),
+        "fortran_order": False,
+        "shape": tuple(shape),
+    }
+    buffer = io.BytesIO()
+    try:
+        np.lib.format.write_array_header_1_0(buffer, header)
+    except ValueError:
+        buffer = io.BytesIO()
+        np.lib.format.write_array_header_2_0(buffer, header)
+    return buffer.getvalue()
+
+
+def iter_mapped(path, start, stop, buffer_size=CHUNK_SIZE):
+    """Yield bytes [start, stop) of the file at `path` through a memory map."""
+    with open(path, "rb") as f, mmap.mmap(
+        f.fileno(), 0, access=mmap.ACCESS_READ
+    ) as mapped:
+        for offset in range(start, stop, buffer_size):
+            yield mapped[offset : min(offset + buffer_size, stop)]
+
+
+def iter_stored(segments, start, stop):
+    """
+    Yield bytes [start, stop) of a stored file, memory-mapping it when the
+    range lies within a single segment.
+    """
+    position = 0
+    for segment in segments:
+        if position <= start and stop <= position + segment.length:
+            offset = segment.offset + start - position
+            yield from iter_mapped(segment.path, offset, offset + stop - start)
+            return
+        position += segment.length
+    yield from iter_segments(segments, start, stop)
+
+
+def iter_member(segments, info, skip, length, buffer_size=CHUNK_SIZE):
+    """
+    Yield `length` bytes of the data of a compressed member after skipping
+    `skip` bytes, decompressing only up to the end of the range.
+    """
+    with zipfile.ZipFile(SegmentReader(segments)) as archive, archive.open(
+        info.member
+    ) as f:
+        read_npy_header(f)
+        while skip:
+            skip -= len(f.read(min(skip, buffer_size)))
+        while length > 0:
+            data = f.read(min(length, buffer_size))
+            if not data:
+                raise OSError(f"{info.member} is truncated")
+            length -= len(data)
+            yield data
+
+
+def fortran_rows(segments, info, start, stop):
+    """Rows [start, stop) of an array stored in Fortran order, read whole."""
+    size = info.dtype.itemsize * math.prod(info.shape)
+    if info.compressed:
+        data = b"".join(iter_member(segments, info, 0, size))
+    else:
+        data = b"".join(iter_segments(segments, info.offset, info.offset + size))
+    array = np.frombuffer(data, info.dtype).reshape(info.shape, order="F")
+    yield np.ascontiguousarray(array[start:stop]).tobytes()
+
+
+def iter_array(segments, info, start=None, stop=None):
+    """
+    Rows [start, stop) of an array as the pieces of a `.npy` file, reading
+    only the bytes those rows occupy. Arrays stored in Fortran order are the
+    exception: their rows are not contiguous, so the array is read whole.
+
+    Raises ValueError straight away, before anything is read, if the array
+    cannot be served that way.
+    """
+    if info.dtype.hasobject:
+        raise ValueError(f"{info.name} holds Python objects and cannot be served")
+    start, stop = row_range(info, start, stop)
+    if start is None:
+        shape, skip, length = info.shape, 0, info.dtype.itemsize
+    else:
+        shape = (max(stop - start, 0),) + info.shape[1:]
+        row_size = info.dtype.itemsize * math.prod(info.shape[1:])
+        skip, length = start * row_size, max(stop - start, 0) * row_size
+
+    if info.fortran_order and len(info.shape) > 1:
+        data = fortran_rows(segments, info, start, stop)
+    elif info.compressed:
+        data = iter_member(segments, info, skip, length)
+    elif length:
+        data = iter_stored(segments, info.offset + skip, info.offset + skip + length)
+    else:
+        data = ()
+    return itertools.chain((npy_header(info.dtype, shape),), data)
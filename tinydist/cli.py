@@ -1,12 +1,32 @@
+import hashlib
+import io
+import json
 import os
-import tempfile
-from urllib.parse import unquote
+import re
+import shutil
+import tarfile
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import quote, unquote, urlsplit, urlunsplit
 
 import click
 import dotenv
+import numpy as np
 import requests
 from tqdm import tqdm
 
+from tinydist.archive import CHECKSUM_PAX_HEADER, ArchiveEntry, iter_tar
+from tinydist.compression import (
+    ENCODINGS,
+    IDENTITY,
+    available_encodings,
+    compress,
+    iter_decoding,
+    worth_compressing,
+)
+from tinydist.replication import REPLICA_HEADER
+from tinydist.ring import HashRing, normalize_url
 from tinydist.utils import CHUNK_SIZE, calculate_checksum
 
 dotenv.load_dotenv()
@@ -14,6 +34,91 @@ dotenv.load_dotenv()
 SERVER_URL = os.getenv("SERVER_URL")
 AUTH_TOKEN = os.getenv("AUTH_TOKEN")
 
+MB = 1024 * 1024
+DEFAULT_CONCURRENCY = 4
+DEFAULT_BATCH_FILES = 1000
+DEFAULT_BATCH_MB = 64
+# Rounds of re-fetching chunks of a download that failed verification.
+CHUNK_RETRIES = 3
+# Kept in a synced folder: size, mtime and checksum of each file.
+SYNC_MANIFEST = ".tinydist-sync.json"
+RING_CACHE = os.getenv(
+    "TINYDIST_RING_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "tinydist", "ring.json"),
+)
+# Verified downloads kept by checksum, up to TINYDIST_CACHE_MB in total.
+CACHE_DIRECTORY = os.getenv(
+    "TINYDIST_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "tinydist", "downloads"),
+)
+CACHE_MB = float(os.getenv("TINYDIST_CACHE_MB", "10240"))
+
+_ring = None
+
+
+def make_session(pool_size=DEFAULT_CONCURRENCY):
+    """Create a requests session whose connection pool fits `pool_size` workers."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class Misdirected(click.ClickException):
+    """A cluster node answered that another node owns the file."""
+
+
+def save_ring(ring):
+    """Remembers the ring map of the cluster behind SERVER_URL, on disk too."""
+    global _ring
+    _ring = ring
+    os.makedirs(os.path.dirname(RING_CACHE) or ".", exist_ok=True)
+    with open(RING_CACHE, "w") as f:
+        json.dump(dict(ring.to_dict(), server_url=SERVER_URL), f)
+
+
+def load_ring(session, refresh=False):
+    """
+    Ring map of the cluster behind SERVER_URL, read from the cache unless
+    `refresh` is set. A single server has an empty ring.
+    """
+    global _ring
+    if not refresh:
+        if _ring is not None:
+            return _ring
+        try:
+            with open(RING_CACHE) as f:
+                data = json.load(f)
+            if data.get("server_url") == SERVER_URL:
+                _ring = HashRing.from_dict(data)
+                return _ring
+        except (OSError, ValueError):
+            pass
+    response = session.get(f"{SERVER_URL}ring")
+    save_ring(HashRing.from_dict(response.json() if response.ok else {}))
+    return _ring
+
+
+def node_for(session, filename):
+    """URL of the server that owns `filename`."""
+    return load_ring(session).node_for(filename) or SERVER_URL
+
+
+def reroute(response):
+    """Updates the ring map from a 421 answer and returns the owning node."""
+    data = response.json()
+    save_ring(HashRing.from_dict(data["ring"]))
+    return normalize_url(data["owner"])
+
+
+def raise_for_misdirected(response):
+    if response.status_code == 421:
+        owner = reroute(response)
+        raise Misdirected(f"The file belongs to {owner}; the ring map was stale.")
+
 
 def chunk_file(file_path, chunk_size=CHUNK_SIZE):
     """
@@ -26,84 +131,734 @@ def chunk_file(file_path, chunk_size=CHUNK_SIZE):
             chunk = f.read(chunk_size)
 
 
-def upload_file_chunk(
-    file_path, filename, total_chunks, chunk_index, category, checksum=None
+def put_file(session, data, filename, category, checksum, server_url=None):
+    """
+    Uploads a whole file as a raw request body. The server hashes it while
+    writing and rejects it if the result differs from `checksum`.
+    """
+    response = session.put(
+        f"{server_url or SERVER_URL}upload/{quote(filename)}",
+        params={"category": category},
+        headers={"Authorization": AUTH_TOKEN, "X-Checksum": checksum},
+        data=data,
+    )
+    raise_for_misdirected(response)
+    if response.status_code != 200:
+        raise click.ClickException(
+            f"Uploading {filename} failed with status {response.status_code}: "
+            f"{response.text}"
+        )
+    return response
+
+
+def create_upload_session(
+    session,
+    filename,
+    category,
+    file_size,
+    chunk_size,
+    resume,
+    server_url=None,
+    encoding=None,
 ):
     """
-    Uploads a single chunk of a file to the server.
+    Opens (or, with `resume`, reopens) an upload session on the server. Its
+    chunks are compressed with `encoding`, or with the category's default
+    when it is None; the status returned says which.
     """
-    url = f"{SERVER_URL}{'upload' if total_chunks == 1 else 'upload_chunk'}"
-    headers = {"Authorization": AUTH_TOKEN}
-    data = {
+    params = {
         "filename": filename,
-        "chunkIndex": chunk_index,
-        "totalChunks": total_chunks,
         "category": category,
-        "checksum": checksum,
+        "file_size": file_size,
+        "chunk_size": chunk_size,
+        "resume": resume,
+        "encodings": list(available_encodings()),
     }
-    with open(file_path, "rb") as f:
-        files = {"file": (filename, f, "application/octet-stream")}
-        response = requests.post(url, headers=headers, data=data, files=files)
+    if encoding:
+        params["encoding"] = encoding
+    response = session.post(
+        f"{server_url or SERVER_URL}upload_session",
+        headers={"Authorization": AUTH_TOKEN},
+        json=params,
+    )
+    raise_for_misdirected(response)
+    if response.status_code not in (200, 201):
+        raise click.ClickException(
+            f"Could not start upload of {filename}: {response.status_code}."
+        )
+    return response.json()
+
+
+def upload_session_chunk(
+    session, session_id, chunk_index, data, server_url=None, encoding=None
+):
+    """
+    Sends one chunk of an upload session as a raw request body, compressed on
+    its own with `encoding` if given.
+    """
+    headers = {"Authorization": AUTH_TOKEN}
+    if encoding:
+        data = compress(data, encoding)
+        headers["Content-Encoding"] = encoding
+    response = session.put(
+        f"{server_url or SERVER_URL}upload_session/{session_id}/{chunk_index}",
+        headers=headers,
+        data=data,
+    )
+    if response.status_code != 200:
+        raise click.ClickException(
+            f"Uploading chunk {chunk_index} failed with status "
+            f"{response.status_code}."
+        )
+    return response
+
+
+def finalize_upload_session(
+    session, session_id, checksum, assemble=False, server_url=None
+):
+    """
+    Asks the server to publish a session once all of its chunks arrived,
+    optionally joining them into a single file.
+    """
+    response = session.post(
+        f"{server_url or SERVER_URL}upload_session/{session_id}/finalize",
+        headers={"Authorization": AUTH_TOKEN},
+        json={"checksum": checksum, "assemble": assemble},
+    )
+    if response.status_code != 200:
+        raise click.ClickException(
+            f"Finalizing upload failed with status {response.status_code}: "
+            f"{response.text}"
+        )
     return response
 
 
-def upload_file(file_path, category):
+def upload_file(
+    file_path,
+    category,
+    chunk_size=CHUNK_SIZE,
+    concurrency=DEFAULT_CONCURRENCY,
+    resume=False,
+    assemble=False,
+    session=None,
+    server_url=None,
+    compression=None,
+):
     """
     Handles upload a file, automatically chunking and uploading as necessary.
+
+    Larger files go through an upload session. Chunks are read once, in order,
+    feeding the whole-file SHA-256 as they go, and up to `concurrency` of them
+    are in flight at a time. With `resume`, chunks the server already holds
+    from an interrupted upload are hashed but not sent again, unless their
+    hash shows the file changed since. With `assemble`, the server joins the
+    chunks into one file on finalize. In a cluster the file goes to the node
+    that owns it. Returns the number of bytes sent.
+
+    Session chunks are compressed one by one with `compression` ("gzip" or
+    "zstd"), or as the category is configured on the server when it is None;
+    IDENTITY turns that off. Files that do not compress are sent as they are.
+    A file that fits in one chunk only goes through a session, to be
+    compressed, when `compression` is given.
     """
+    session = session or make_session(concurrency)
     file_size = os.path.getsize(file_path)
     filename = os.path.basename(file_path)
+    server_url = server_url or node_for(session, filename)
     total_chunks = max(
-        (file_size // CHUNK_SIZE) + (1 if file_size % CHUNK_SIZE else 0), 1
+        (file_size // chunk_size) + (1 if file_size % chunk_size else 0), 1
     )
+    started = time.perf_counter()
+    sent = 0
+    if compression != IDENTITY and not worth_compressing(file_path):
+        compression = IDENTITY
 
-    if file_size <= CHUNK_SIZE:
+    if total_chunks == 1 and compression in (None, IDENTITY):
         with tqdm(total=1, desc=f"Uploading {filename}", unit="file") as pbar:
-            upload_file_chunk(file_path, filename, 1, 0, category)
+            with open(file_path, "rb") as f:
+                data = f.read()
+            checksum = hashlib.sha256(data).hexdigest()
+            put_file(session, data, filename, category, checksum, server_url)
+            sent = len(data)
             pbar.update()
     else:
-        with tqdm(
-            total=total_chunks, desc=f"Uploading {filename}", unit="chunk"
+        status = create_upload_session(
+            session,
+            filename,
+            category,
+            file_size,
+            chunk_size,
+            resume,
+            server_url,
+            compression,
+        )
+        session_id = status["session_id"]
+        encoding = status.get("encoding")
+        missing = set(status["missing"])
+        held = status.get("hashes")
+        sha256 = hashlib.sha256()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor, tqdm(
+            total=total_chunks,
+            desc=f"Uploading {filename}",
+            unit="chunk",
         ) as pbar:
-            for i, chunk in enumerate(chunk_file(file_path)):
-                chunk_path = f"{file_path}.part{i}"
-                with open(chunk_path, "wb") as temp_chunk_file:
-                    temp_chunk_file.write(chunk)
-                upload_file_chunk(
-                    chunk_path,
-                    filename,
-                    total_chunks,
-                    i,
-                    category,
-                    checksum=calculate_checksum(file_path),
+            pending = set()
+
+            def drain(limit):
+                nonlocal pending
+                while len(pending) > limit:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                        pbar.update()
+
+            for i, chunk in enumerate(chunk_file(file_path, chunk_size)):
+                sha256.update(chunk)
+                if i not in missing and (
+                    held is None or held[i] == hashlib.sha256(chunk).hexdigest()
+                ):
+                    pbar.update()
+                    continue
+                drain(concurrency - 1)
+                pending.add(
+                    executor.submit(
+                        upload_session_chunk,
+                        session,
+                        session_id,
+                        i,
+                        chunk,
+                        server_url,
+                        encoding,
+                    )
                 )
+                sent += len(chunk)
+            drain(0)
+        finalize_upload_session(
+            session, session_id, sha256.hexdigest(), assemble, server_url
+        )
+
+    elapsed = time.perf_counter() - started
+    click.echo(
+        f"{filename} uploaded successfully ({format_throughput(sent, elapsed)})."
+    )
+    return sent
+
+
+def hash_chunks(file_path, chunk_size=CHUNK_SIZE):
+    """
+    SHA-256 of every chunk of a file and of the whole file, in one pass.
+    Returns (chunk hashes, chunk sizes, whole-file checksum).
+    """
+    hashes, sizes = [], []
+    sha256 = hashlib.sha256()
+    for chunk in chunk_file(file_path, chunk_size):
+        sha256.update(chunk)
+        hashes.append(hashlib.sha256(chunk).hexdigest())
+        sizes.append(len(chunk))
+    return hashes, sizes, sha256.hexdigest()
+
+
+def missing_chunks(session, hashes, server_url=None):
+    """Asks the server which of `hashes` it does not store yet."""
+    response = session.post(
+        f"{server_url or SERVER_URL}cas/have",
+        headers={"Authorization": AUTH_TOKEN},
+        json={"hashes": hashes},
+    )
+    if response.status_code != 200:
+        raise click.ClickException(
+            f"Chunk negotiation failed with status {response.status_code}."
+        )
+    return response.json()["missing"]
+
+
+def put_chunk(session, chunk_hash, data, server_url=None):
+    """Stores one content-addressed chunk on the server."""
+    response = session.put(
+        f"{server_url or SERVER_URL}cas/chunk/{chunk_hash}",
+        headers={"Authorization": AUTH_TOKEN},
+        data=data,
+    )
+    if response.status_code != 200:
+        raise click.ClickException(
+            f"Uploading chunk {chunk_hash} failed with status "
+            f"{response.status_code}."
+        )
+    return response
+
+
+def commit_chunks(session, filename, category, checksum, hashes, server_url=None):
+    """
+    Publishes a file as its ordered chunk hashes. Returns the hashes the
+    server reported missing, empty on success.
+    """
+    response = session.post(
+        f"{server_url or SERVER_URL}cas/commit",
+        headers={"Authorization": AUTH_TOKEN},
+        json={
+            "filename": filename,
+            "category": category,
+            "checksum": checksum,
+            "chunks": hashes,
+        },
+    )
+    raise_for_misdirected(response)
+    if response.status_code == 409:
+        return response.json()["missing"]
+    if response.status_code != 200:
+        raise click.ClickException(
+            f"Committing {filename} failed with status {response.status_code}: "
+            f"{response.text}"
+        )
+    return []
+
+
+def upload_deduplicated(
+    file_path,
+    category,
+    chunk_size=CHUNK_SIZE,
+    concurrency=DEFAULT_CONCURRENCY,
+    session=None,
+    server_url=None,
+):
+    """
+    Uploads a file to the content-addressed store, sending only the chunks
+    the server does not already hold from this or any other file. Returns the
+    number of bytes sent.
+    """
+    session = session or make_session(concurrency)
+    filename = os.path.basename(file_path)
+    server_url = server_url or node_for(session, filename)
+    started = time.perf_counter()
+    hashes, sizes, checksum = hash_chunks(file_path, chunk_size)
+    offsets = {}
+    offset = 0
+    for chunk_hash, size in zip(hashes, sizes):
+        offsets.setdefault(chunk_hash, (offset, size))
+        offset += size
+
+    def send(wanted):
+        with open(file_path, "rb") as f, ThreadPoolExecutor(
+            max_workers=concurrency
+        ) as executor, tqdm(
+            total=len(wanted), desc=f"Uploading {filename}", unit="chunk"
+        ) as pbar:
+
+            def send_chunk(chunk_hash):
+                chunk_offset, size = offsets[chunk_hash]
+                data = os.pread(f.fileno(), size, chunk_offset)
+                put_chunk(session, chunk_hash, data, server_url)
+                pbar.update()
+                return size
+
+            return sum(executor.map(send_chunk, wanted))
+
+    sent = send(missing_chunks(session, hashes, server_url))
+    # Chunks may be collected between negotiation and commit; send those again.
+    missing = commit_chunks(session, filename, category, checksum, hashes, server_url)
+    if missing:
+        sent += send(missing)
+        if commit_chunks(session, filename, category, checksum, hashes, server_url):
+            raise click.ClickException(f"Could not commit {filename}.")
+
+    elapsed = time.perf_counter() - started
+    total = sum(sizes)
+    saved = 1 - sent / total if total else 0.0
+    click.echo(
+        f"{filename} uploaded successfully ({format_throughput(sent, elapsed)}, "
+        f"{saved:.0%} deduplicated)."
+    )
+    return sent
+
+
+def iter_batch_entries(file_paths):
+    """Archive entries for small files, each read and hashed in one go."""
+    for file_path in file_paths:
+        with open(file_path, "rb") as f:
+            data = f.read()
+        yield ArchiveEntry(
+            os.path.basename(file_path),
+            len(data),
+            int(os.path.getmtime(file_path)),
+            hashlib.sha256(data).hexdigest(),
+            (data,),
+        )
+
+
+def upload_batch(session, file_paths, category, server_url=None):
+    """
+    Uploads many small files in one request, streamed as a tar archive.
+    Returns the number of bytes sent.
+    """
+    with tqdm(total=len(file_paths), desc="Uploading batch", unit="file") as pbar:
+
+        def entries():
+            for entry in iter_batch_entries(file_paths):
+                yield entry
                 pbar.update()
-                os.remove(chunk_path)  # Clean up the temporary chunk file
-    click.echo(f"{filename} uploaded successfully.")
+
+        response = session.post(
+            f"{server_url or SERVER_URL}upload_batch",
+            params={"category": category},
+            headers={"Authorization": AUTH_TOKEN},
+            data=iter_tar(entries()),
+        )
+    if response.status_code != 200:
+        raise click.ClickException(
+            f"Batch upload failed with status {response.status_code}: "
+            f"{response.text}"
+        )
+    rejected = response.json()["rejected"]
+    if rejected:
+        raise click.ClickException(
+            f"Checksum mismatch or wrong node, files rejected: {', '.join(rejected)}"
+        )
+    return sum(os.path.getsize(file_path) for file_path in file_paths)
+
+
+def format_throughput(num_bytes, elapsed):
+    """Human readable size, duration and rate for a transfer."""
+    rate = num_bytes / MB / elapsed if elapsed > 0 else 0.0
+    return f"{num_bytes / MB:.1f} MB in {elapsed:.2f}s, {rate:.1f} MB/s"
 
 
 @click.group()
 def cli():
     """TinyDist CLI tool."""
-    pass
 
 
 @cli.command()
 @click.option("--category", default="default", help="Category for files.")
+@click.option(
+    "--chunk-size",
+    default=CHUNK_SIZE // MB,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Chunk size in MB.",
+)
+@click.option(
+    "--concurrency",
+    default=DEFAULT_CONCURRENCY,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Number of chunks uploaded in parallel.",
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    help="Continue interrupted uploads, sending only the chunks the server lacks.",
+)
+@click.option(
+    "--assemble",
+    is_flag=True,
+    help="Have the server join chunked uploads into a single file.",
+)
+@click.option(
+    "--batch-files",
+    default=DEFAULT_BATCH_FILES,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Most small files sent together when uploading a folder.",
+)
+@click.option(
+    "--batch-mb",
+    default=DEFAULT_BATCH_MB,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Most MB of small files sent together when uploading a folder.",
+)
+@click.option(
+    "--dedup",
+    is_flag=True,
+    help="Store files as content-addressed chunks, sending only unknown ones.",
+)
+@click.option(
+    "--compress",
+    "compression",
+    type=click.Choice(ENCODINGS + ("none",)),
+    default=None,
+    help="Compress each chunk before sending it; the default follows the "
+    "category's setting on the server. Files that do not compress are sent as "
+    "they are.",
+)
 @click.argument("paths", nargs=-1, type=click.Path(exists=True))
-def upload(paths, category):
-    """Upload a file or all files in a folder."""
+def upload(
+    paths,
+    category,
+    chunk_size,
+    concurrency,
+    resume,
+    assemble,
+    batch_files,
+    batch_mb,
+    dedup,
+    compression,
+):
+    """
+    Upload a file or all files in a folder. Files in a folder that fit in one
+    chunk are sent together in batches, unless `--dedup` or `--compress` is
+    given.
+    """
+    session = make_session(concurrency)
+    if compression == "none":
+        compression = IDENTITY
+    options = {"chunk_size": chunk_size * MB, "concurrency": concurrency}
+    if dedup:
+        upload_one = upload_deduplicated
+    else:
+        upload_one = upload_file
+        options.update(
+            resume=resume,
+            assemble=assemble,
+            compression=compression,
+        )
+    started = time.perf_counter()
+    total_bytes = 0
+    total_files = 0
+    # Small files waiting to be sent, as [paths, bytes] per owning node.
+    batches = {}
+
+    def send(file_path):
+        nonlocal total_bytes, total_files
+        try:
+            total_bytes += upload_one(file_path, category, session=session, **options)
+        except Misdirected:
+            # The ring map was refreshed from the answer; the owner is known now.
+            total_bytes += upload_one(file_path, category, session=session, **options)
+        total_files += 1
+
+    def flush_batch(node):
+        nonlocal total_bytes, total_files
+        batch, _ = batches.pop(node, ([], 0))
+        if batch:
+            total_bytes += upload_batch(session, batch, category, node)
+            total_files += len(batch)
 
     for path in paths:
         if os.path.isdir(path):
             for root, dirs, files in os.walk(path):
                 for name in files:
-                    upload_file(os.path.join(root, name), category)
+                    if name in (SYNC_MANIFEST, f"{SYNC_MANIFEST}.tmp"):
+                        continue  # Left by `sync`; not part of the data.
+                    file_path = os.path.join(root, name)
+                    file_size = os.path.getsize(file_path)
+                    compressed = compression not in (None, IDENTITY)
+                    if dedup or compressed or file_size > options["chunk_size"]:
+                        send(file_path)
+                        continue
+                    node = node_for(session, name)
+                    batch = batches.setdefault(node, [[], 0])
+                    batch[0].append(file_path)
+                    batch[1] += file_size
+                    if len(batch[0]) >= batch_files or batch[1] >= batch_mb * MB:
+                        flush_batch(node)
+            for node in list(batches):
+                flush_batch(node)
         elif os.path.isfile(path):
-            upload_file(path, category)
+            send(path)
         else:
             click.echo("Path does not exist.")
 
+    if total_files > 1:
+        elapsed = time.perf_counter() - started
+        click.echo(
+            f"Uploaded {total_files} files "
+            f"({format_throughput(total_bytes, elapsed)})."
+        )
+
+
+def load_sync_manifest(manifest_path):
+    """{relative path: [size, mtime_ns, checksum]} from the last sync."""
+    try:
+        with open(manifest_path) as f:
+            return json.load(f)["files"]
+    except (OSError, ValueError, KeyError):
+        return {}
+
+
+def save_sync_manifest(manifest_path, files):
+    temp_path = f"{manifest_path}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump({"files": files}, f)
+    os.replace(temp_path, manifest_path)
+
+
+def scan_directory(directory, concurrency=DEFAULT_CONCURRENCY):
+    """
+    {filename: (path, size, checksum)} of the files under `directory`. Only
+    files whose size or mtime changed since the last scan are hashed, in
+    parallel; the rest take their checksum from the manifest kept in
+    `directory`, which is updated.
+    """
+    manifest_path = os.path.join(directory, SYNC_MANIFEST)
+    previous = load_sync_manifest(manifest_path)
+    files = {}
+    to_hash = []
+    for root, _, names in os.walk(directory):
+        for name in names:
+            path = os.path.join(root, name)
+            relative = os.path.relpath(path, directory)
+            if relative in (SYNC_MANIFEST, f"{SYNC_MANIFEST}.tmp"):
+                continue
+            stat = os.stat(path)
+            entry = previous.get(relative)
+            if entry and entry[:2] == [stat.st_size, stat.st_mtime_ns]:
+                files[relative] = entry
+            else:
+                files[relative] = [stat.st_size, stat.st_mtime_ns, None]
+                to_hash.append(relative)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        paths = [os.path.join(directory, relative) for relative in to_hash]
+        for relative, checksum in zip(to_hash, executor.map(calculate_checksum, paths)):
+            files[relative][2] = checksum
+    save_sync_manifest(manifest_path, files)
+
+    scanned = {}
+    for relative, (size, _, checksum) in files.items():
+        name = os.path.basename(relative)
+        if name in scanned:
+            # Files are stored by name, so these would overwrite each other.
+            raise click.ClickException(
+                f"{scanned[name][0]} and {relative} have the same filename."
+            )
+        scanned[name] = (relative, size, checksum)
+    return {
+        name: (os.path.join(directory, relative), size, checksum)
+        for name, (relative, size, checksum) in scanned.items()
+    }
+
+
+def category_checksums(session, category):
+    """
+    {filename: set of checksums} of the files in `category`, from one listing
+    per node (replicas included).
+    """
+    checksums = {}
+    for node in load_ring(session).nodes or [SERVER_URL]:
+        for row in node_metadata(session, node, category):
+            checksums.setdefault(row["filename"], set()).add(row["checksum"])
+    return checksums
+
+
+@cli.command()
+@click.option("--category", default="default", help="Category to sync into.")
+@click.option(
+    "--concurrency",
+    default=DEFAULT_CONCURRENCY,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Number of files hashed and batches uploaded in parallel.",
+)
+@click.option(
+    "--chunk-size",
+    default=CHUNK_SIZE // MB,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Chunk size in MB; smaller files are sent in batches.",
+)
+@click.option(
+    "--batch-files",
+    default=DEFAULT_BATCH_FILES,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Most small files sent together.",
+)
+@click.option(
+    "--batch-mb",
+    default=DEFAULT_BATCH_MB,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Most MB of small files sent together.",
+)
+@click.option(
+    "--delete",
+    is_flag=True,
+    help="Delete files of the category that are no longer in the folder.",
+)
+@click.option("--dry-run", is_flag=True, help="Only list what would change.")
+@click.argument("directory", type=click.Path(exists=True, file_okay=False))
+def sync(
+    directory, category, concurrency, chunk_size, batch_files, batch_mb, delete, dry_run
+):
+    """
+    Make a category match a folder, uploading only new and changed files.
+
+    Sizes, mtimes and checksums are kept in a manifest in the folder, so only
+    files that changed since the last sync are hashed. The server's files are
+    listed in one request per node.
+    """
+    session = make_session(concurrency)
+    started = time.perf_counter()
+    local = scan_directory(directory, concurrency)
+    remote = category_checksums(session, category)
+    changed = [
+        name
+        for name, (_, _, checksum) in sorted(local.items())
+        if remote.get(name) != {checksum}
+    ]
+    removed = sorted(set(remote) - set(local)) if delete else []
+    for name in changed:
+        click.echo(f"{'new' if name not in remote else 'changed'}: {name}")
+    for name in removed:
+        click.echo(f"deleted: {name}")
+    if dry_run:
+        click.echo(
+            f"Would upload {len(changed)} and delete {len(removed)} of "
+            f"{len(local)} files."
+        )
+        return
+
+    # Small files go in batches per owning node, sent in parallel; larger
+    # ones are sent one by one, their chunks in parallel.
+    batches = {}
+    large = []
+    for name in changed:
+        path, size, _ = local[name]
+        if size > chunk_size * MB:
+            large.append(path)
+            continue
+        node = node_for(session, name)
+        node_batches = batches.setdefault(node, [[[], 0]])
+        batch = node_batches[-1]
+        if len(batch[0]) >= batch_files or batch[1] + size > batch_mb * MB:
+            batch = [[], 0]
+            node_batches.append(batch)
+        batch[0].append(path)
+        batch[1] += size
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [
+            executor.submit(upload_batch, session, paths, category, node)
+            for node, node_batches in batches.items()
+            for paths, _ in node_batches
+            if paths
+        ]
+        total_bytes = sum(future.result() for future in futures)
+    for path in large:
+        options = {"chunk_size": chunk_size * MB, "concurrency": concurrency}
+        try:
+            total_bytes += upload_file(path, category, session=session, **options)
+        except Misdirected:
+            # The ring map was refreshed from the answer; the owner is known now.
+            total_bytes += upload_file(path, category, session=session, **options)
+
+    for name in removed:
+        response = session.delete(
+            f"{node_for(session, name)}delete",
+            params={"filename": name},
+            headers={"Authorization": AUTH_TOKEN},
+        )
+        if response.status_code != 200:
+            raise click.ClickException(
+                f"Deleting {name} failed with status {response.status_code}."
+            )
+
+    elapsed = time.perf_counter() - started
+    click.echo(
+        f"Synced {len(local)} files: {len(local) - len(changed)} unchanged, "
+        f"{len(changed)} uploaded ({format_throughput(total_bytes, elapsed)}), "
+        f"{len(removed)} deleted."
+    )
+
 
 def safe_filename(disposition, default="downloaded_file"):
     """Extract filename safely from Content-Disposition or use a default."""
@@ -114,67 +869,695 @@ def safe_filename(disposition, default="downloaded_file"):
     return default
 
 
-def assemble_chunks(file_name, total_chunks, temp_dir):
-    """Assemble chunks into the original file."""
-    with open(file_name, "wb") as assembled_file:
-        for i in range(total_chunks):
-            chunk_name = os.path.join(temp_dir, f"{file_name}.part{i}")
-            with open(chunk_name, "rb") as chunk_file:
-                assembled_file.write(chunk_file.read())
+def preallocate(f, size):
+    """Reserve `size` bytes for `f` up front so ranges can be written anywhere."""
+    try:
+        os.posix_fallocate(f.fileno(), 0, size)
+    except (AttributeError, OSError, ValueError):
+        f.truncate(size)
+
+
+def load_download_state(state_path, size, etag):
+    """
+    Pieces left to fetch by an interrupted download, or None if it cannot be
+    resumed because there is no state or the file changed on the server.
+    """
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if state.get("size") != size or state.get("etag") != etag:
+        return None
+    return state["pieces"]
+
+
+def save_download_state(state_path, size, etag, pieces):
+    temp_path = f"{state_path}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump({"size": size, "etag": etag, "pieces": pieces}, f)
+    os.replace(temp_path, state_path)
+
+
+def link_or_copy(source, target, link=True):
+    """
+    Hardlink `source` to `target`, or copy it when `link` is false or across
+    filesystems; replaces `target`.
+    """
+    temp_path = f"{target}.{os.getpid()}.tmp"
+    if link:
+        try:
+            os.link(source, temp_path)
+        except OSError:
+            link = False
+    if not link:
+        shutil.copyfile(source, temp_path)
+    os.replace(temp_path, target)
+
+
+def read_only_protects():
+    """Whether a read-only mode keeps this user from writing to a file (not root)."""
+    return not hasattr(os, "geteuid") or os.geteuid() != 0
+
+
+class DownloadCache:
+    """
+    Verified downloads kept under `directory` by checksum, up to `max_bytes`
+    in total, evicting the least recently used first. The index also records
+    the checksum and filename each download URL last had, so fetching it again
+    takes one conditional request.
+
+    Cached files are read-only, and are only hardlinked to downloads when
+    that stops them being edited in place; otherwise they are copied.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(directory, "index.json")
+        self.link = read_only_protects()
+
+    def load(self):
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"objects": {}, "urls": {}}
+
+    def save(self, index):
+        temp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(index, f)
+        os.replace(temp_path, self.index_path)
+
+    def object_path(self, checksum):
+        """Where the file with `checksum` is cached, or None for a non-checksum."""
+        if not re.fullmatch(r"[0-9a-f]{64}", checksum or ""):
+            return None
+        return os.path.join(self.directory, checksum)
+
+    def get(self, checksum):
+        """Path of the cached file with `checksum`, or None."""
+        path = self.object_path(checksum)
+        entry = self.load()["objects"].get(checksum)
+        if entry and path and os.path.exists(path):
+            stat = os.stat(path)
+            # Made writable again or resized, it may have been edited through
+            # a hardlinked download.
+            if stat.st_size == entry["size"] and not stat.st_mode & 0o222:
+                return path
+        return None
+
+    def lookup(self, url):
+        """The checksum and filename `url` last had, if that file is cached."""
+        entry = self.load()["urls"].get(url)
+        if entry and self.get(entry[0]):
+            return entry
+        return None
+
+    def copy_to(self, checksum, path):
+        """Link the cached file with `checksum` to `path`, marking it used."""
+        link_or_copy(self.get(checksum), path, self.link)
+        index = self.load()
+        if checksum in index["objects"]:
+            index["objects"][checksum]["used"] = time.time()
+            self.save(index)
+
+    def add(self, checksum, path, url, filename):
+        """Keep the verified download at `path`, evicting to fit `max_bytes`."""
+        cached = self.object_path(checksum)
+        size = os.path.getsize(path)
+        if cached is None or size > self.max_bytes:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        link_or_copy(path, cached, self.link)
+        os.chmod(cached, 0o444)
+        index = self.load()
+        index["objects"][checksum] = {"size": size, "used": time.time()}
+        index["urls"][url] = [checksum, filename]
+        self.evict(index)
+        self.save(index)
+
+    def evict(self, index):
+        objects = index["objects"]
+        total = sum(entry["size"] for entry in objects.values())
+        for checksum in sorted(objects, key=lambda checksum: objects[checksum]["used"]):
+            if total <= self.max_bytes:
+                break
+            total -= objects.pop(checksum)["size"]
+            try:
+                os.remove(self.object_path(checksum))
+            except FileNotFoundError:
+                pass
+        index["urls"] = {
+            url: entry for url, entry in index["urls"].items() if entry[0] in objects
+        }
+
+
+class ChunkMismatch(Exception):
+    """A downloaded chunk does not hash to the SHA-256 the server listed."""
+
+
+def fetch_manifest(session, url):
+    """
+    The chunk manifest served next to the `/get` URL `url`, or None if the
+    server has none for the file.
+    """
+    parts = urlsplit(url)
+    manifest_url = urlunsplit(
+        parts._replace(path=parts.path.rsplit("/", 1)[0] + "/manifest")
+    )
+    response = session.get(manifest_url)
+    if response.status_code != 200:
+        return None
+    return response.json()
+
+
+def fetch_piece(session, url, fd, piece, etag, on_progress):
+    """
+    Download the byte range `piece` ([next, stop)) and write it in place with
+    pwrite, advancing `piece[0]` as bytes land so progress can be saved.
+
+    A piece with a [start, sha256] tail is a whole chunk, hashed in the same
+    pass as it is written; on a mismatch it is reset to its start and
+    ChunkMismatch is raised.
+    """
+    verified = len(piece) == 4
+    if verified:
+        sha256 = hashlib.sha256()
+        # Bytes written before an interrupted download was resumed.
+        offset = piece[2]
+        while offset < piece[0]:
+            data = os.pread(fd, min(CHUNK_SIZE, piece[0] - offset), offset)
+            sha256.update(data)
+            offset += len(data)
+    headers = {
+        "Authorization": f"Bearer {AUTH_TOKEN}",
+        "Range": f"bytes={piece[0]}-{piece[1] - 1}",
+        "If-Range": etag,
+    }
+    with session.get(url, headers=headers, stream=True) as response:
+        if response.status_code != 206:
+            raise click.ClickException(
+                "File changed on the server during download, please retry."
+            )
+        for chunk in response.iter_content(chunk_size=1024 * 1024):
+            os.pwrite(fd, chunk, piece[0])
+            if verified:
+                sha256.update(chunk)
+            piece[0] += len(chunk)
+            on_progress(len(chunk))
+    if piece[0] != piece[1]:
+        raise click.ClickException("Connection closed before the range completed.")
+    if verified and sha256.hexdigest() != piece[3]:
+        on_progress(piece[2] - piece[1])
+        piece[0] = piece[2]
+        raise ChunkMismatch(f"Bytes {piece[2]}-{piece[1] - 1} failed verification.")
+
+
+def download_file(
+    session,
+    file_id=None,
+    output_dir=".",
+    concurrency=DEFAULT_CONCURRENCY,
+    piece_size=CHUNK_SIZE,
+    filename=None,
+):
+    """
+    Download a file into `output_dir` and return its path, or None if it was
+    not found. See `download_and_verify`.
+    """
+    path, _ = download_and_verify(
+        session, file_id, output_dir, concurrency, piece_size, filename
+    )
+    return path
+
+
+def download_and_verify(
+    session,
+    file_id=None,
+    output_dir=".",
+    concurrency=DEFAULT_CONCURRENCY,
+    piece_size=CHUNK_SIZE,
+    filename=None,
+    cache=None,
+):
+    """
+    Download a file into `output_dir`. Returns its path, or None if it was
+    not found, and whether it was verified against the server's checksums.
+    A file that fails verification raises a ClickException. A file given by
+    `filename` is fetched from the cluster node that owns it.
+
+    With a DownloadCache, a file the server still has the same checksum for
+    is linked from the cache instead of being transferred, and verified
+    downloads are added to it.
+
+    When the server supports ranges, the output is preallocated and up to
+    `concurrency` ranges are fetched in parallel. Progress is kept next to the
+    partial file, so running the download again resumes where it stopped.
+    When the server lists per-chunk checksums, each range is one chunk,
+    hashed as it is written; chunks that fail are fetched again, up to
+    CHUNK_RETRIES times, without touching the rest.
+    """
+    if filename is None:
+        urls = [f"{SERVER_URL}get?id={file_id}"]
+    else:
+        # The owner first, then the nodes that may hold a replica.
+        ring = load_ring(session)
+        nodes = [node_for(session, filename)]
+        nodes += [node for node in ring.nodes_for(filename, len(ring.nodes))]
+        urls = [
+            f"{node}get?filename={quote(filename)}" for node in dict.fromkeys(nodes)
+        ]
+    headers = {"Authorization": f"Bearer {AUTH_TOKEN}"}
+    cached = cache.lookup(urls[0]) if cache else None
+    if cached:
+        # Revalidate: a 304 means the cached copy is still current.
+        headers["If-None-Match"] = f'"{cached[0]}"'
+    for url in urls:
+        try:
+            head = session.head(url, headers=headers, allow_redirects=True)
+            if head.status_code == 421:
+                url = f"{reroute(session.get(url))}get?filename={quote(filename)}"
+                head = session.head(url, headers=headers, allow_redirects=True)
+        except requests.ConnectionError:
+            continue
+        break
+    else:
+        return None, False
+    if head.status_code == 304:
+        checksum, file_name = cached
+        path = os.path.join(output_dir, file_name)
+        cache.copy_to(checksum, path)
+        return path, True
+    if head.status_code != 200:
+        return None, False
+    url = head.url  # Where a failover redirect led.
+    content_disp = head.headers.get("Content-Disposition", "")
+    file_name = safe_filename(content_disp, f"downloaded_{file_id or filename}")
+    path = os.path.join(output_dir, file_name)
+    etag = head.headers.get("ETag")
+    # Compressed representations tag the checksum with their encoding.
+    tagged = etag and etag.strip('"').split("-")[0]
+    if cache and tagged and cache.get(tagged):
+        # The same content was downloaded under another id or name.
+        cache.copy_to(tagged, path)
+        return path, True
+    partial_path = f"{path}.tdpart"
+    state_path = f"{path}.tdstate"
+    size = int(head.headers.get("Content-Length", 0))
+    ranged = head.headers.get("Accept-Ranges") == "bytes" and etag is not None
+    manifest = fetch_manifest(session, url) or {}
+    checksum = manifest.get("checksum")
+    chunks = manifest.get("chunks") or []
+    by_chunk = (
+        ranged and bool(chunks) and sum(chunk["size"] for chunk in chunks) == size
+    )
+
+    pieces = None
+    if ranged and os.path.exists(partial_path):
+        pieces = load_download_state(state_path, size, etag)
+    if pieces is None:
+        if by_chunk:
+            pieces = [
+                [
+                    chunk["offset"],
+                    chunk["offset"] + chunk["size"],
+                    chunk["offset"],
+                    chunk["sha256"],
+                ]
+                for chunk in chunks
+            ]
+        else:
+            pieces = [
+                [offset, min(offset + piece_size, size)]
+                for offset in range(0, size, piece_size)
+            ]
+        with open(partial_path, "wb") as f:
+            preallocate(f, size)
+    remaining = sum(piece[1] - piece[0] for piece in pieces)
+    # Chunks finished before an interruption were checked when they landed.
+    chunk_verified = by_chunk and all(len(piece) == 4 for piece in pieces)
+
+    lock = threading.Lock()
+    sha256 = hashlib.sha256()
+    with open(partial_path, "r+b") as f, tqdm(
+        desc=f"Downloading {file_name}",
+        unit="B",
+        unit_scale=True,
+        total=size,
+        initial=size - remaining,
+    ) as bar:
+        if not ranged:
+            response = session.get(
+                url,
+                headers={
+                    "Authorization": f"Bearer {AUTH_TOKEN}",
+                    "Accept-Encoding": ", ".join(available_encodings()),
+                },
+                stream=True,
+            )
+            # An error page must not end up in the file.
+            response.raise_for_status()
+            encoding = response.headers.get("Content-Encoding")
+            if encoding in ENCODINGS:
+                # Decoded here: urllib3 can stop at a member boundary.
+                raw = iter(lambda: response.raw.read(1024 * 1024), b"")
+                chunks = iter_decoding(raw, encoding)
+            else:
+                chunks = response.iter_content(chunk_size=1024 * 1024)
+            for chunk in chunks:
+                f.write(chunk)
+                sha256.update(chunk)
+                bar.update(len(chunk))
+            # A compressed response decodes to a different size than it was sent.
+            f.truncate()
+        else:
+
+            def on_progress(num_bytes):
+                with lock:
+                    bar.update(num_bytes)
+
+            try:
+                pending = [piece for piece in pieces if piece[0] < piece[1]]
+                for attempt in range(CHUNK_RETRIES + 1):
+                    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                        futures = {
+                            executor.submit(
+                                fetch_piece,
+                                session,
+                                url,
+                                f.fileno(),
+                                piece,
+                                etag,
+                                on_progress,
+                            ): piece
+                            for piece in pending
+                        }
+                        failed = []
+                        for future, piece in futures.items():
+                            try:
+                                future.result()
+                            except ChunkMismatch:
+                                failed.append(piece)
+                    if not failed:
+                        break
+                    pending = failed
+                    click.echo(
+                        f"{len(failed)} chunks of {file_name} failed verification, "
+                        "fetching them again.",
+                        err=True,
+                    )
+                else:
+                    raise click.ClickException(
+                        f"{file_name}: {len(failed)} chunks still failed "
+                        f"verification after {CHUNK_RETRIES} retries."
+                    )
+            finally:
+                with lock:
+                    pieces = [piece for piece in pieces if piece[0] < piece[1]]
+                    if pieces:
+                        save_download_state(state_path, size, etag, pieces)
+
+    verified = chunk_verified
+    if not verified and checksum:
+        # Without chunk checksums only the whole file can be checked.
+        actual = sha256.hexdigest() if not ranged else calculate_checksum(partial_path)
+        if actual != checksum:
+            os.remove(partial_path)
+            if os.path.exists(state_path):
+                os.remove(state_path)
+            raise click.ClickException(f"{file_name} failed verification.")
+        verified = True
+
+    os.replace(partial_path, path)
+    if os.path.exists(state_path):
+        os.remove(state_path)
+    if cache and verified:
+        cache.add(checksum, path, urls[0], file_name)
+    return path, verified
+
+
+def download_archive(
+    session, file_ids=(), category=None, output_dir=".", server_url=None
+):
+    """
+    Download files as a single tar stream and unpack each member while it
+    arrives, checking it against the checksum the server sent in its header.
+    Returns the paths written and the names that failed verification.
+    """
+    params = [("format", "tar")] + [("id", file_id) for file_id in file_ids]
+    if category:
+        params.append(("category", category))
+    response = session.get(
+        f"{server_url or SERVER_URL}files",
+        params=params,
+        headers={"Authorization": AUTH_TOKEN},
+        stream=True,
+    )
+    if response.status_code != 200:
+        raise click.ClickException(
+            f"Archive download failed with status {response.status_code}: "
+            f"{response.text}"
+        )
+
+    written = []
+    corrupted = []
+    with tarfile.open(fileobj=response.raw, mode="r|") as archive:
+        for member in archive:
+            name = os.path.basename(member.name)
+            if not member.isfile() or name != member.name or name in ("", ".", ".."):
+                continue
+            path = os.path.join(output_dir, name)
+            sha256 = hashlib.sha256()
+            source = archive.extractfile(member)
+            with open(path, "wb") as f:
+                while chunk := source.read(1024 * 1024):
+                    sha256.update(chunk)
+                    f.write(chunk)
+            expected = member.pax_headers.get(CHECKSUM_PAX_HEADER)
+            if expected and sha256.hexdigest() != expected:
+                corrupted.append(name)
+            written.append(path)
+    return written, corrupted
+
+
+def file_params(file_id=None, filename=None):
+    """Query parameters selecting a file by id or by filename."""
+    return {"id": file_id} if file_id is not None else {"filename": filename}
+
+
+def list_arrays(session, file_id=None, filename=None):
+    """
+    Describes the arrays in a stored `.npz` or `.npy` without downloading it:
+    a list of dicts with name, dtype, shape, fortran_order and compressed.
+    """
+    response = session.get(f"{SERVER_URL}arrays", params=file_params(file_id, filename))
+    if response.status_code != 200:
+        raise click.ClickException(
+            f"Listing arrays failed with status {response.status_code}: "
+            f"{response.text}"
+        )
+    return response.json()["arrays"]
+
+
+def fetch_array(session, name=None, start=None, stop=None, file_id=None, filename=None):
+    """
+    Fetches one array of a stored `.npz` or `.npy`, or rows [start, stop) of
+    it, as a NumPy array. Only those rows are transferred.
+    """
+    params = file_params(file_id, filename)
+    params.update(
+        (key, value)
+        for key, value in (("name", name), ("start", start), ("stop", stop))
+        if value is not None
+    )
+    response = session.get(f"{SERVER_URL}array", params=params)
+    if response.status_code != 200:
+        raise click.ClickException(
+            f"Fetching array {name} failed with status {response.status_code}: "
+            f"{response.text}"
+        )
+    return np.load(io.BytesIO(response.content), allow_pickle=False)
+
+
+@cli.command()
+@click.argument("file_id")
+def arrays(file_id):
+    """List the arrays in a stored .npz or .npy file."""
+    for info in list_arrays(make_session(1), file_id=file_id):
+        click.echo(f"{info['name']}\t{info['dtype']}\t{tuple(info['shape'])}")
 
 
 @cli.command()
+@click.option(
+    "--concurrency",
+    default=DEFAULT_CONCURRENCY,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Number of byte ranges downloaded in parallel.",
+)
+@click.option(
+    "--archive",
+    is_flag=True,
+    help="Fetch all FILE_IDS as one tar stream, unpacked as it arrives.",
+)
+@click.option(
+    "--category",
+    default=None,
+    help="Fetch every file in this category as one tar stream.",
+)
+@click.option(
+    "--by-name",
+    is_flag=True,
+    help="FILE_IDS are filenames, fetched from the cluster node owning each.",
+)
+@click.option(
+    "--no-cache",
+    is_flag=True,
+    help=f"Neither read nor fill the local download cache ({CACHE_DIRECTORY}).",
+)
 @click.argument("file_ids", nargs=-1)
-def get(file_ids):
-    """Download files or chunks and reassemble if necessary."""
-    for file_id in file_ids:
-        response = requests.get(
-            f"{SERVER_URL}get?id={file_id}",
-            headers={"Authorization": f"Bearer {AUTH_TOKEN}"},
-            stream=True,
-        )
-        content_disp = response.headers.get("Content-Disposition", "")
-        file_name = safe_filename(content_disp, f"downloaded_{file_id}")
-
-        if "X-Chunked" in response.headers:
-            with tempfile.TemporaryDirectory() as temp_dir:
-                total_chunks = 0
-                with tqdm(
-                    desc=f"Downloading {file_name}",
-                    unit="B",
-                    unit_scale=True,
-                    total=int(response.headers.get("Content-Length", 0)),
-                ) as bar:
-                    for chunk in response.iter_content(chunk_size=8192):
-                        chunk_path = os.path.join(
-                            temp_dir, f"{file_name}.part{total_chunks}"
-                        )
-                        with open(chunk_path, "wb") as chunk_file:
-                            chunk_file.write(chunk)
-                        total_chunks += 1
-                        bar.update(len(chunk))
-                assemble_chunks(file_name, total_chunks, temp_dir)
+def get(file_ids, concurrency, archive, category, by_name, no_cache):
+    """
+    Download files, fetching byte ranges in parallel and resuming if possible.
+    Each chunk is checked against the server's checksums as it arrives, and
+    files that are unchanged since an earlier download come from the cache.
+    """
+    session = make_session(concurrency)
+    cache = None
+    if CACHE_MB and not no_cache:
+        cache = DownloadCache(CACHE_DIRECTORY, CACHE_MB * MB)
+    if archive or category:
+        started = time.perf_counter()
+        written, corrupted = download_archive(session, file_ids, category)
+        if category and not file_ids:
+            # A category is spread over every node of a cluster.
+            for node in load_ring(session).nodes:
+                if node != normalize_url(SERVER_URL):
+                    more = download_archive(session, (), category, server_url=node)
+                    written += more[0]
+                    corrupted += more[1]
+        elapsed = time.perf_counter() - started
+        total_bytes = sum(os.path.getsize(path) for path in written)
+        click.echo(
+            f"Downloaded {len(written)} files "
+            f"({format_throughput(total_bytes, elapsed)})."
+        )
+        for name in corrupted:
+            print(f"File download failed: {name}")
+        return
 
-        else:
-            with open(file_name, "wb") as f_out, tqdm(
-                desc=f"Downloading {file_name}",
-                unit="B",
-                unit_scale=True,
-                total=int(response.headers.get("Content-Length", 0)),
-            ) as bar:
-                for chunk in response.iter_content(chunk_size=8192):
-                    f_out.write(chunk)
-                    bar.update(len(chunk))
-        assembled_checksum = calculate_checksum(file_name)
-        response = requests.post(
-            f"{SERVER_URL}verify_get?filename={file_name}",
-            headers={"Authorization": f"Bearer {AUTH_TOKEN}"},
-            data={"filename": file_name, "checksum": assembled_checksum},
-        )
-        if response.status_code == 200:
+    for file_id in file_ids:
+        started = time.perf_counter()
+        try:
+            if by_name:
+                path, verified = download_and_verify(
+                    session, filename=file_id, concurrency=concurrency, cache=cache
+                )
+            else:
+                path, verified = download_and_verify(
+                    session, file_id, concurrency=concurrency, cache=cache
+                )
+        except click.ClickException as e:
+            print(f"File download failed: {file_id} ({e.message})")
+            continue
+        if path is None:
+            print(f"File not found: {file_id}")
+            continue
+        elapsed = time.perf_counter() - started
+        file_name = os.path.basename(path)
+        click.echo(
+            f"{file_name} downloaded "
+            f"({format_throughput(os.path.getsize(path), elapsed)})."
+        )
+        if verified:
             print(f"File downloaded and verified successfully: {file_name}")
         else:
-            print(f"File download failed: {file_name}")
+            print(f"File downloaded, but the server has no checksum: {file_name}")
+
+
+def node_metadata(session, node, category=None):
+    """Filename, category and checksum of every file stored on `node`."""
+    params = {"format": "ndjson", "fields": "filename,category,checksum"}
+    if category:
+        params["category"] = category
+    response = session.get(
+        f"{node}metadata",
+        params=params,
+        headers={"Authorization": AUTH_TOKEN},
+    )
+    if response.status_code != 200:
+        raise click.ClickException(
+            f"Listing {node} failed with status {response.status_code}."
+        )
+    return [json.loads(line) for line in response.text.splitlines() if line]
+
+
+def move_file(session, row, source, target):
+    """Streams a file from `source` to `target`, then deletes it on `source`."""
+    filename = row["filename"]
+    with session.get(
+        f"{source}get", params={"filename": filename}, stream=True
+    ) as response:
+        if response.status_code != 200:
+            raise click.ClickException(
+                f"Reading {filename} from {source} failed with status "
+                f"{response.status_code}."
+            )
+        put_file(
+            session,
+            response.iter_content(CHUNK_SIZE),
+            filename,
+            row["category"],
+            row["checksum"],
+            target,
+        )
+    # Marked as a replica delete so `source` does not pass it on to the
+    # file's other replicas, among them `target`, and as a move so it does
+    # not leave a tombstone that would delete them on anti-entropy.
+    session.delete(
+        f"{source}delete",
+        params={"filename": filename, "moved": "1"},
+        headers={"Authorization": AUTH_TOKEN, REPLICA_HEADER: "1"},
+    )
+
+
+@cli.command()
+@click.option(
+    "--drain",
+    multiple=True,
+    help="URL of a node leaving the cluster; all of its files are moved off.",
+)
+@click.option("--dry-run", is_flag=True, help="Only list the files that would move.")
+def rebalance(drain, dry_run):
+    """
+    Move every file to the node that owns it under the cluster's current ring
+    map, after nodes joined or left. Copies on the file's other replicas stay
+    where they are. The ring map cache is refreshed first.
+    """
+    session = make_session()
+    response = session.get(f"{SERVER_URL}ring")
+    response.raise_for_status()
+    data = response.json()
+    ring = HashRing.from_dict(data)
+    save_ring(ring)
+    if not ring:
+        raise click.ClickException(f"{SERVER_URL} is not part of a cluster.")
+    category_replicas = data.get("category_replicas", {})
+    moved = 0
+    for node in ring.nodes + [normalize_url(url) for url in drain]:
+        for row in node_metadata(session, node):
+            count = category_replicas.get(row["category"], data.get("replicas", 1))
+            replicas = ring.nodes_for(row["filename"], count)
+            if node in replicas:
+                continue
+            owner = replicas[0]
+            click.echo(f"{row['filename']}: {node} -> {owner}")
+            if not dry_run:
+                move_file(session, row, node, owner)
+            moved += 1
+    click.echo(f"{'Would move' if dry_run else 'Moved'} {moved} files.")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,176 @@
+"""
+Read a category's files straight into memory, for training loops.
+
+    reader = DatasetReader("targets", prefetch=8, shuffle=True, rank=rank,
+                           world_size=world_size)
+    for epoch in range(epochs):
+        reader.set_epoch(epoch)
+        for filename, data in reader:
+            ...
+
+Files are fetched on background threads while the previous ones are being
+used, so network transfers overlap with compute and nothing is written to disk.
+"""
+
+import hashlib
+import io
+import json
+import os
+import random
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+import dotenv
+
+from tinydist.cli import make_session
+from tinydist.ring import HashRing, normalize_url
+
+dotenv.load_dotenv()
+
+MB = 1024 * 1024
+DEFAULT_PREFETCH = 4
+DEFAULT_MEMORY_BUDGET_MB = 512
+
+
+class ChecksumMismatch(Exception):
+    """A fetched file does not hash to the checksum the server listed."""
+
+
+class DatasetReader:
+    """
+    Iterates over the files of `category` as (filename, bytes) pairs.
+
+    Up to `prefetch` files are downloaded ahead on a pooled session, as long
+    as the bytes fetched ahead of the consumer stay within `memory_budget_mb`
+    (a single larger file is still fetched, alone). Files are read in
+    filename order, or shuffled with `seed` and the epoch; with `world_size`
+    ranks, each one reads a disjoint share. Every file with a checksum is
+    verified.
+    """
+
+    def __init__(
+        self,
+        category,
+        server_url=None,
+        auth_token=None,
+        prefetch=DEFAULT_PREFETCH,
+        memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB,
+        shuffle=False,
+        seed=0,
+        rank=0,
+        world_size=1,
+        session=None,
+    ):
+        if not 0 <= rank < world_size:
+            raise ValueError(f"rank {rank} is not in [0, {world_size}).")
+        self.category = category
+        server_url = server_url or os.getenv("SERVER_URL")
+        if not server_url:
+            raise ValueError("No server_url given and SERVER_URL is not set.")
+        self.server_url = normalize_url(server_url)
+        self.auth_token = auth_token or os.getenv("AUTH_TOKEN")
+        self.prefetch = max(prefetch, 1)
+        self.memory_budget = memory_budget_mb * MB
+        self.shuffle = shuffle
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+        self.session = session or make_session(self.prefetch)
+        self._files = None
+
+    def set_epoch(self, epoch):
+        """Reshuffle for `epoch`; all ranks must use the same one."""
+        self.epoch = epoch
+
+    def list_files(self):
+        """
+        Id, filename, size and checksum of every file in the category, with
+        the node to read it from, sorted by filename. Listed once and kept.
+        """
+        if self._files is not None:
+            return self._files
+        response = self.session.get(f"{self.server_url}ring")
+        ring = HashRing.from_dict(response.json() if response.ok else {})
+        files = {}
+        for node in ring.nodes or [self.server_url]:
+            response = self.session.get(
+                f"{node}metadata",
+                params={
+                    "format": "ndjson",
+                    "category": self.category,
+                    "fields": "id,filename,size,checksum",
+                },
+                headers={"Authorization": self.auth_token},
+            )
+            response.raise_for_status()
+            for line in response.text.splitlines():
+                row = dict(json.loads(line), node=node)
+                # Replicas are listed by several nodes; read from the owner.
+                if row["filename"] not in files or node == ring.node_for(
+                    row["filename"]
+                ):
+                    files[row["filename"]] = row
+        self._files = sorted(files.values(), key=lambda row: row["filename"])
+        return self._files
+
+    def shard(self):
+        """The files this rank reads in the current epoch, in order."""
+        files = list(self.list_files())
+        if self.shuffle:
+            random.Random(self.seed + self.epoch).shuffle(files)
+        return files[self.rank :: self.world_size]
+
+    def __len__(self):
+        return len(self.shard())
+
+    def fetch(self, row):
+        """The content of one listed file."""
+        response = self.session.get(
+            f"{row['node']}get?filename={quote(row['filename'])}"
+        )
+        response.raise_for_status()
+        data = response.content
+        if row.get("checksum") and hashlib.sha256(data).hexdigest() != row["checksum"]:
+            raise ChecksumMismatch(f"{row['filename']} failed verification.")
+        return data
+
+    def __iter__(self):
+        files = self.shard()
+        # Files being fetched or fetched but not yet handed out, in order.
+        pending = deque()
+        ahead = 0
+        position = 0
+        executor = ThreadPoolExecutor(
+            max_workers=self.prefetch, thread_name_prefix="tinydist-prefetch"
+        )
+        try:
+            while position < len(files) or pending:
+                while (
+                    position < len(files)
+                    and len(pending) < self.prefetch
+                    and (
+                        not pending
+                        or ahead + (files[position]["size"] or 0) <= self.memory_budget
+                    )
+                ):
+                    row = files[position]
+                    position += 1
+                    ahead += row["size"] or 0
+                    pending.append((row, executor.submit(self.fetch, row)))
+                row, future = pending.popleft()
+                data = future.result()
+                ahead -= row["size"] or 0
+                yield row["filename"], data
+        finally:
+            # Stopping early drops the files fetched ahead. (cancel_futures
+            # needs Python 3.9.)
+            for _, future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def streams(self):
+        """Like iterating the reader, with each file as a binary stream."""
+        for filename, data in self:
+            yield filename, io.BytesIO(data)
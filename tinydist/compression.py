@@ -0,0 +1,152 @@
+"""
+Per-chunk compression of uploads.
+
+Each chunk of a compressed upload is one gzip member or zstd frame, stored as
+it was sent. Concatenated they form a valid gzip or zstd stream, so a file can
+be served with `Content-Encoding` by sending its parts as they are, or be
+decompressed one part at a time.
+
+zstd needs the optional `zstandard` package; gzip always works.
+"""
+
+import gzip
+import hashlib
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP = "gzip"
+ZSTD = "zstd"
+ENCODINGS = (GZIP, ZSTD)
+IDENTITY = "identity"
+
+DECODE_ERRORS = (OSError, EOFError, zlib.error)
+if zstandard:
+    DECODE_ERRORS += (zstandard.ZstdError,)
+
+READ_SIZE = 1024 * 1024
+# Bytes of a file compressed to decide whether compressing it is worth it.
+SAMPLE_SIZE = 256 * 1024
+# Compressing is skipped unless the sample shrinks below this ratio.
+MIN_RATIO = 0.9
+# Formats that are compressed already.
+COMPRESSED_EXTENSIONS = (
+    ".npz",
+    ".gz",
+    ".tgz",
+    ".zst",
+    ".bz2",
+    ".xz",
+    ".zip",
+    ".7z",
+    ".jpg",
+    ".jpeg",
+    ".png",
+    ".webp",
+    ".mp3",
+    ".mp4",
+    ".parquet",
+)
+
+
+def available_encodings():
+    """The encodings this installation can compress and decompress."""
+    return ENCODINGS if zstandard else (GZIP,)
+
+
+def check_encoding(encoding):
+    if encoding not in available_encodings():
+        raise ValueError(f"Unsupported encoding {encoding}")
+
+
+def compress(data, encoding):
+    """`data` as one gzip member or zstd frame."""
+    check_encoding(encoding)
+    if encoding == GZIP:
+        return gzip.compress(data, compresslevel=6, mtime=0)
+    return zstandard.ZstdCompressor(level=3).compress(data)
+
+
+def worth_compressing(file_path):
+    """
+    Whether a file is likely to compress: not a known compressed format, and
+    its first SAMPLE_SIZE bytes shrink below MIN_RATIO.
+    """
+    if file_path.lower().endswith(COMPRESSED_EXTENSIONS):
+        return False
+    with open(file_path, "rb") as f:
+        sample = f.read(SAMPLE_SIZE)
+    return bool(sample) and len(zlib.compress(sample, 1)) < MIN_RATIO * len(sample)
+
+
+def open_decoded(path, encoding):
+    """A binary file object reading the decompressed content of `path`."""
+    check_encoding(encoding)
+    if encoding == GZIP:
+        return gzip.open(path, "rb")
+    f = open(path, "rb")
+    return zstandard.ZstdDecompressor().stream_reader(
+        f, read_across_frames=True, closefd=True
+    )
+
+
+def iter_decoded(segments, encoding, read_size=READ_SIZE):
+    """Yield the decompressed content of the parts in `segments`, in order."""
+    for segment in segments:
+        with open_decoded(segment.path, encoding) as f:
+            while data := f.read(read_size):
+                yield data
+
+
+def new_decompressor(encoding):
+    check_encoding(encoding)
+    if encoding == GZIP:
+        return zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+def iter_decoding(pieces, encoding):
+    """
+    Decompress a body of concatenated gzip members or zstd frames as its
+    `pieces` arrive, wherever the member boundaries fall.
+    """
+    decompressor = new_decompressor(encoding)
+    for data in pieces:
+        while data:
+            if decompressor.eof:
+                decompressor = new_decompressor(encoding)
+            yield decompressor.decompress(data)
+            data = decompressor.unused_data if decompressor.eof else b""
+
+
+def decoded_digest(path, encoding, limit=None):
+    """
+    (size, sha256) of the decompressed content of `path`. Stops with a
+    ValueError once more than `limit` bytes come out.
+    """
+    sha256 = hashlib.sha256()
+    size = 0
+    try:
+        with open_decoded(path, encoding) as f:
+            while data := f.read(READ_SIZE):
+                size += len(data)
+                if limit is not None and size > limit:
+                    raise ValueError(f"Decompresses to more than {limit} bytes")
+                sha256.update(data)
+    except DECODE_ERRORS as e:
+        raise ValueError(f"Not valid {encoding} data: {e}") from e
+    return size, sha256.hexdigest()
+
+
+def parse_category_encodings(overrides):
+    """Encoding per category from a `category=gzip|zstd,...` list."""
+    encodings = {}
+    for item in filter(str.strip, overrides.split(",")):
+        category, encoding = (part.strip() for part in item.split("="))
+        if encoding not in ENCODINGS:
+            raise ValueError(f"Unknown encoding {encoding} for {category}")
+        encodings[category] = encoding
+    return encodings
@@ -0,0 +1,354 @@
+"""
+Prometheus metrics kept cheap enough to leave on.
+
+Every thread updates its own dict of samples without taking a lock; a scrape
+merges the dicts of all threads. Threads that have exited are folded into a
+retired total, so the werkzeug thread-per-request server does not make the
+registry grow.
+"""
+
+import bisect
+import functools
+import os
+import threading
+import time
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+QUERY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+# name: (type, help, buckets)
+METRICS = {
+    "tinydist_request_duration_seconds": (
+        "histogram",
+        "Time from receiving a request to sending the last byte of its response.",
+        LATENCY_BUCKETS,
+    ),
+    "tinydist_request_bytes_total": (
+        "counter",
+        "Bytes of request bodies received.",
+        None,
+    ),
+    "tinydist_response_bytes_total": (
+        "counter",
+        "Bytes of response bodies sent.",
+        None,
+    ),
+    "tinydist_sqlite_query_seconds": (
+        "histogram",
+        "Time spent executing SQLite statements, by statement type.",
+        QUERY_BUCKETS,
+    ),
+    "tinydist_chunk_uploads_in_flight": (
+        "gauge",
+        "Chunk uploads currently being received.",
+        None,
+    ),
+}
+
+_local = threading.local()
+# (thread, samples) for every thread that recorded something.
+_threads = []
+_threads_lock = threading.Lock()
+_retired = {}
+
+
+def _samples():
+    samples = getattr(_local, "samples", None)
+    if samples is None:
+        samples = _local.samples = {}
+        with _threads_lock:
+            # Pruned here too, so the registry stays bounded without scrapes.
+            _retire_exited()
+            _threads.append((threading.current_thread(), samples))
+    return samples
+
+
+def inc(name, labels=(), amount=1):
+    """Add `amount` to a counter or gauge. `labels` is a tuple of pairs."""
+    samples = _samples()
+    key = (name, labels)
+    samples[key] = samples.get(key, 0) + amount
+
+
+def observe(name, value, labels=()):
+    """Record `value` in a histogram."""
+    samples = _samples()
+    key = (name, labels)
+    histogram = samples.get(key)
+    if histogram is None:
+        histogram = samples[key] = [0] * (len(METRICS[name][2]) + 1) + [0.0]
+    histogram[bisect.bisect_left(METRICS[name][2], value)] += 1
+    histogram[-1] += value
+
+
+def _add(total, samples):
+    for key, value in samples.items():
+        if isinstance(value, list):
+            merged = total.setdefault(key, [0] * len(value))
+            for i, count in enumerate(value):
+                merged[i] += count
+        else:
+            total[key] = total.get(key, 0) + value
+
+
+def _retire_exited():
+    """Fold the samples of exited threads into the retired total. Needs the lock."""
+    alive = []
+    for thread, samples in _threads:
+        if thread.is_alive():
+            alive.append((thread, samples))
+        else:
+            # Exited threads no longer write to their samples.
+            _add(_retired, samples)
+    _threads[:] = alive
+
+
+def collect():
+    """Merged samples of all threads, folding exited threads into the retired total."""
+    with _threads_lock:
+        _retire_exited()
+        total = {}
+        _add(total, _retired)
+        for _, samples in _threads:
+            # dict.copy() is atomic under the GIL, so no lock is needed
+            # against the owning thread adding a key meanwhile.
+            _add(total, samples.copy())
+    return total
+
+
+def tracks_in_flight(name):
+    """Decorate a view to count the requests it is serving in gauge `name`."""
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            inc(name)
+            try:
+                return view(*args, **kwargs)
+            finally:
+                inc(name, amount=-1)
+
+        return wrapper
+
+    return decorator
+
+
+class DiskUsage:
+    """
+    Size of the files under a directory, from a scan done at most every `ttl`
+    seconds on a background thread so a scrape never walks the tree.
+    """
+
+    def __init__(self, directory, ttl):
+        self.directory = directory
+        self.ttl = ttl
+        self.value = None
+        self.scanned_at = 0
+        self._scanning = threading.Lock()
+
+    def scan(self):
+        total = 0
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                try:
+                    total += os.lstat(os.path.join(root, name)).st_size
+                except FileNotFoundError:
+                    pass
+        self.value = total
+        self.scanned_at = time.monotonic()
+        return total
+
+    def _scan_in_background(self):
+        try:
+            self.scan()
+        finally:
+            self._scanning.release()
+
+    def get(self):
+        """The last scanned size, refreshed in the background when stale."""
+        if self.value is None:
+            return self.scan()
+        stale = time.monotonic() - self.scanned_at > self.ttl
+        if stale and self._scanning.acquire(blocking=False):
+            threading.Thread(target=self._scan_in_background, daemon=True).start()
+        return self.value
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(gauges=()):
+    """
+    The text exposition of all metrics, followed by `gauges`, a list of
+    (name, help, [(labels, value)]) computed at scrape time.
+    """
+    samples = collect()
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+        series = sorted(
+            (labels, value) for (key, labels), value in samples.items() if key == name
+        )
+        if kind == "gauge" and not series:
+            series = [((), 0)]
+        for labels, value in series:
+            if kind != "histogram":
+                lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets + ("+Inf",), value):
+                cumulative += count
+                bucket_labels = format_labels(labels + (("le", str(bound)),))
+                lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {value[-1]!r}")
+            lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+    for name, help_text, series in gauges:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+        for labels, value in series:
+            lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+class CountingInput:
+    """A WSGI input stream that counts the bytes read from it."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.count = 0
+
+    def read(self, *args):
+        data = self.stream.read(*args)
+        self.count += len(data)
+        return data
+
+    def readinto(self, buffer):
+        if hasattr(self.stream, "readinto"):
+            size = self.stream.readinto(buffer)
+        else:
+            data = self.stream.read(len(buffer))
+            size = len(data)
+            buffer[:size] = data
+        self.count += size or 0
+        return size
+
+    def readline(self, *args):
+        data = self.stream.readline(*args)
+        self.count += len(data)
+        return data
+
+    def readlines(self, *args):
+        lines = self.stream.readlines(*args)
+        self.count += sum(map(len, lines))
+        return lines
+
+    def __iter__(self):
+        for line in self.stream:
+            self.count += len(line)
+            yield line
+
+
+# Set in the WSGI environ by the app to the rule that matched the request.
+ROUTE_KEY = "tinydist.route"
+
+
+class ObservedResponse:
+    """
+    A WSGI response iterable that records the request's metrics once its body
+    is fully sent, or when the server closes it early because the client went
+    away.
+    """
+
+    def __init__(self, result, labels, counting, started):
+        self.result = result
+        self.labels = labels
+        self.counting = counting
+        self.started = started
+        self.sent = 0
+        self.recorded = False
+
+    def __iter__(self):
+        for data in self.result:
+            self.sent += len(data)
+            yield data
+        self.record()
+
+    def close(self):
+        try:
+            if hasattr(self.result, "close"):
+                self.result.close()
+        finally:
+            self.record()
+
+    def record(self):
+        if self.recorded:
+            return
+        self.recorded = True
+        labels = self.labels()
+        observe(
+            "tinydist_request_duration_seconds",
+            time.perf_counter() - self.started,
+            labels,
+        )
+        inc("tinydist_request_bytes_total", labels, self.counting.count)
+        inc("tinydist_response_bytes_total", labels, self.sent)
+
+
+class MetricsMiddleware:
+    """
+    WSGI middleware timing each request until its response is fully sent and
+    counting the bytes that go in and out, per route and method. Responses
+    that are the server's `wsgi.file_wrapper` are returned as they are.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        started = time.perf_counter()
+        environ["wsgi.input"] = counting = CountingInput(environ["wsgi.input"])
+        content_length = []
+
+        def observed_start_response(status, headers, exc_info=None):
+            content_length[:] = [
+                value for name, value in headers if name.lower() == "content-length"
+            ]
+            return start_response(status, headers, exc_info)
+
+        result = self.app(environ, observed_start_response)
+
+        def labels():
+            return (
+                ("route", environ.get(ROUTE_KEY, "unmatched")),
+                ("method", environ.get("REQUEST_METHOD", "")),
+            )
+
+        observed = ObservedResponse(result, labels, counting, started)
+        file_wrapper = environ.get("wsgi.file_wrapper")
+        if isinstance(file_wrapper, type) and isinstance(result, file_wrapper):
+            # Wrapping it would hide it from the server, which sends such files
+            # with sendfile; the metrics are recorded when it is closed, with
+            # the body size it was announced with.
+            observed.sent = int(content_length[0]) if content_length else 0
+            close = getattr(result, "close", None)
+
+            def close_observed():
+                try:
+                    if close is not None:
+                        close()
+                finally:
+                    observed.record()
+
+            result.close = close_observed
+            return result
+        return observed
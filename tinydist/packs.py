@@ -0,0 +1,169 @@
+"""
+Pack segments for small files.
+
+Instead of getting a file of its own, an upload of at most PACK_MAX_KB is
+appended to the current segment under files/.packs/; its metadata row records
+the segment as `path`, where it starts as `pack_offset` and its length as
+`size`. Segments are sealed once they reach PACK_SEGMENT_MB.
+
+Deleting or replacing a packed file leaves its bytes behind. Compaction
+copies the files still in a mostly dead sealed segment to the current one and
+removes it, every PACK_COMPACT_INTERVAL seconds or on POST /packs/compact.
+"""
+
+import fcntl
+import hashlib
+import logging
+import os
+import re
+import threading
+
+import dotenv
+
+from tinydist.store import move_packed, packed_files, packed_usage
+from tinydist.utils import ChecksumMismatch, file_directory
+
+dotenv.load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+# Dot-prefixed, so no secure_filename of an upload can collide with it.
+pack_directory = os.path.join(file_directory, ".packs")
+SEGMENT_SIZE = int(float(os.getenv("PACK_SEGMENT_MB", "256")) * MB)
+# A sealed segment is compacted once this share of it is no longer used.
+COMPACT_RATIO = float(os.getenv("PACK_COMPACT_RATIO", "0.5"))
+SEGMENT_PATTERN = re.compile(r"(\d+)\.pack")
+
+
+class PackWriter:
+    """
+    Appends files to the segments in `directory`, starting a new one when the
+    next file would take the current one past `segment_size`. Appends are
+    serialised by a lock within the process and by flock across processes.
+    """
+
+    def __init__(self, directory, segment_size):
+        self.directory = directory
+        self.segment_size = segment_size
+        self._lock = threading.Lock()
+        self._number = None
+
+    def segment_path(self, number):
+        return os.path.join(self.directory, f"{number:06d}.pack")
+
+    def segments(self):
+        """Paths of the existing segments, oldest first."""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return [
+            os.path.join(self.directory, name)
+            for name in sorted(names)
+            if SEGMENT_PATTERN.fullmatch(name)
+        ]
+
+    def current(self):
+        """The segment being appended to."""
+        with self._lock:
+            return self.segment_path(self._current_number())
+
+    def _current_number(self):
+        if self._number is None:
+            segments = self.segments()
+            self._number = (
+                int(os.path.basename(segments[-1]).split(".")[0]) if segments else 1
+            )
+        return self._number
+
+    def append(self, data, expected_checksum=None):
+        """
+        Append `data` to the current segment and return its (segment, offset,
+        sha256). Nothing is written if it does not match `expected_checksum`.
+        """
+        checksum = hashlib.sha256(data).hexdigest()
+        if expected_checksum and expected_checksum.lower() != checksum:
+            raise ChecksumMismatch(
+                f"Received data has checksum {checksum}, expected {expected_checksum}"
+            )
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock:
+            while True:
+                path = self.segment_path(self._current_number())
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                    offset = os.fstat(fd).st_size
+                    if offset and offset + len(data) > self.segment_size:
+                        self._number += 1
+                        continue
+                    view = memoryview(data)
+                    written = 0
+                    while written < len(view):
+                        written += os.pwrite(fd, view[written:], offset + written)
+                    return path, offset, checksum
+                finally:
+                    os.close(fd)
+
+
+packer = PackWriter(pack_directory, SEGMENT_SIZE)
+
+
+def pack_stats(writer=packer):
+    """Segment count, bytes on disk and bytes still used by packed files."""
+    live = packed_usage()
+    segments = writer.segments()
+    return {
+        "segments": len(segments),
+        "size": sum(os.path.getsize(segment) for segment in segments),
+        "used": sum(live.get(segment, 0) for segment in segments),
+    }
+
+
+def compact(writer=packer, ratio=COMPACT_RATIO):
+    """
+    Rewrite the sealed segments of which at least `ratio` is no longer used:
+    copy the files still in them to the current segment and remove them.
+    A file replaced while it is being copied keeps its new version, and the
+    copy is left as garbage for a later pass. Returns what was reclaimed.
+    """
+    live = packed_usage()
+    current = writer.current()
+    summary = {"segments": 0, "moved": 0, "reclaimed": 0}
+    for segment in writer.segments():
+        size = os.path.getsize(segment)
+        if segment == current or live.get(segment, 0) > (1 - ratio) * size:
+            continue
+        with open(segment, "rb") as f:
+            for file_id, filename, offset, length in packed_files(segment):
+                data = os.pread(f.fileno(), length, offset)
+                new_segment, new_offset, _ = writer.append(data)
+                if move_packed(
+                    file_id, filename, segment, offset, new_segment, new_offset
+                ):
+                    summary["moved"] += 1
+        if packed_files(segment):
+            continue  # Still referenced; left for the next pass.
+        os.remove(segment)
+        summary["segments"] += 1
+        summary["reclaimed"] += size - live.get(segment, 0)
+        logger.info("Compacted pack segment %s", segment)
+    return summary
+
+
+def start_compactor(interval, writer=packer):
+    """Compact every `interval` seconds on a daemon thread; 0 disables it."""
+    if interval <= 0:
+        return None
+
+    def loop():
+        while not stop.wait(interval):
+            try:
+                compact(writer)
+            except Exception:
+                logger.exception("Compacting pack segments failed")
+
+    stop = threading.Event()
+    threading.Thread(target=loop, name="pack-compactor", daemon=True).start()
+    return stop
@@ -0,0 +1,265 @@
+import hashlib
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+import requests
+
+from tinydist.ring import normalize_url, ring_hash
+from tinydist.store import (
+    get_metadata,
+    get_tombstone,
+    iter_metadata,
+    iter_tombstones,
+    lookup_file,
+)
+from tinydist.tiering import iter_stored
+
+logger = logging.getLogger(__name__)
+
+# Marks writes made by a peer rather than a client, so they are not fanned out
+# again. On uploads it carries the timestamp of the original upload.
+REPLICA_HEADER = "X-Replica"
+DIGEST_BUCKETS = 64
+
+
+def parse_replicas(default, overrides):
+    """
+    Replica counts per category from a default and a `category=count,...`
+    list of overrides.
+    """
+    counts = {}
+    for item in filter(str.strip, overrides.split(",")):
+        category, count = item.split("=")
+        counts[category.strip()] = int(count)
+    return max(int(default), 1), counts
+
+
+def digest_bucket(filename):
+    return ring_hash(filename) % DIGEST_BUCKETS
+
+
+def version_key(version):
+    """
+    Orders the (checksum, timestamp) versions of a file; a deleted file has
+    None as its checksum, and a delete wins over an upload at the same time.
+    """
+    checksum, timestamp = version
+    return timestamp, checksum is None, checksum or ""
+
+
+class Replicator:
+    """
+    Keeps each file on the first R nodes of the ring for its category. New
+    uploads and deletes are pushed to the other replicas in the background
+    once done locally, and anti-entropy passes repair whatever those pushes
+    missed by comparing per-bucket digests of the metadata two replicas
+    share. Deletes are remembered as tombstones for that comparison.
+    """
+
+    def __init__(self, ring, node_url, auth_token, replicas=1, category_replicas=None):
+        self.ring = ring
+        self.node_url = node_url
+        self.auth_token = auth_token
+        self.replicas = replicas
+        self.category_replicas = category_replicas or {}
+        self.session = requests.Session()
+        self.executor = ThreadPoolExecutor(max_workers=4)
+
+    @property
+    def enabled(self):
+        return bool(self.ring and self.node_url)
+
+    @property
+    def max_replicas(self):
+        return max([self.replicas, *self.category_replicas.values()])
+
+    def replica_nodes(self, filename, category=None):
+        """Nodes that keep a copy of `filename`, its owner first."""
+        count = self.category_replicas.get(category, self.replicas)
+        return self.ring.nodes_for(filename, count)
+
+    def holds(self, filename, category=None):
+        """Whether this node is one of the replicas of `filename`."""
+        return self.node_url in self.replica_nodes(filename, category)
+
+    def peers(self, filename, category=None):
+        return [
+            node
+            for node in self.replica_nodes(filename, category)
+            if node != self.node_url
+        ]
+
+    def replicate(self, filename, category):
+        """Push a file that was just stored here to its other replicas."""
+        if self.enabled:
+            for peer in self.peers(filename, category):
+                self.executor.submit(self._push_logged, filename, peer)
+
+    def replicate_delete(self, filename, category, deleted_at):
+        """Delete a file that was just deleted here from its other replicas."""
+        if self.enabled:
+            for peer in self.peers(filename, category):
+                self.executor.submit(
+                    self._delete_logged, filename, category, deleted_at, peer
+                )
+
+    def push(self, filename, peer):
+        """Stream the local copy of `filename` to `peer`."""
+        row = get_metadata(filename)
+        record = lookup_file(filename, False)
+        if not row or not record:
+            return False
+        response = self.session.put(
+            f"{peer}upload/{quote(filename)}",
+            params={"category": row["category"]},
+            headers={
+                "Authorization": self.auth_token,
+                "X-Checksum": row["checksum"],
+                REPLICA_HEADER: row["upload_timestamp"],
+            },
+            data=iter_stored(record),
+        )
+        # 409: the peer already holds a newer version.
+        if response.status_code not in (200, 409):
+            raise OSError(
+                f"Replicating {filename} to {peer} failed with status "
+                f"{response.status_code}"
+            )
+        return response.status_code == 200
+
+    def _push_logged(self, filename, peer):
+        try:
+            self.push(filename, peer)
+        except (OSError, requests.RequestException):
+            logger.exception("Replicating %s to %s failed", filename, peer)
+
+    def delete(self, filename, category, deleted_at, peer):
+        """
+        Delete `filename` on `peer`, which records a tombstone for it even if
+        it holds no copy. A copy uploaded after `deleted_at` is kept.
+        """
+        response = self.session.delete(
+            f"{peer}delete",
+            params={"filename": filename, "category": category},
+            headers={"Authorization": self.auth_token, REPLICA_HEADER: deleted_at},
+        )
+        # 409: the peer holds a version uploaded after the delete.
+        if response.status_code not in (200, 409):
+            raise OSError(
+                f"Deleting {filename} on {peer} failed with status "
+                f"{response.status_code}"
+            )
+        return response.status_code == 200
+
+    def _delete_logged(self, filename, category, deleted_at, peer):
+        try:
+            self.delete(filename, category, deleted_at, peer)
+        except (OSError, requests.RequestException):
+            logger.exception("Deleting %s on %s failed", filename, peer)
+
+    def shared_files(self, peer, bucket=None):
+        """
+        {filename: (checksum, timestamp)} of the local files that both this
+        node and `peer` should hold, optionally from one digest bucket. Files
+        deleted since they were last uploaded have None as their checksum and
+        the time of the delete.
+        """
+        peer = normalize_url(peer)
+        files = {}
+        for row in iter_metadata():
+            filename = row["filename"]
+            if bucket is not None and digest_bucket(filename) != bucket:
+                continue
+            if peer in self.replica_nodes(filename, row["category"]):
+                files[filename] = (row["checksum"] or "", row["upload_timestamp"])
+        for filename, category, deleted_at in iter_tombstones():
+            if bucket is not None and digest_bucket(filename) != bucket:
+                continue
+            if peer not in self.replica_nodes(filename, category):
+                continue
+            tombstone = (None, deleted_at)
+            current = files.get(filename)
+            if current is None or version_key(tombstone) > version_key(current):
+                files[filename] = tombstone
+        return files
+
+    def digest(self, peer):
+        """SHA-256 per digest bucket of the files shared with `peer`."""
+        buckets = {}
+        for filename, (checksum, _) in sorted(self.shared_files(peer).items()):
+            bucket = buckets.setdefault(digest_bucket(filename), hashlib.sha256())
+            # "-" is no SHA-256, so deleted files cannot match stored ones.
+            bucket.update(f"{filename}\0{checksum or '-'}\n".encode())
+        return {str(bucket): sha256.hexdigest() for bucket, sha256 in buckets.items()}
+
+    def anti_entropy(self):
+        """
+        One repair pass: compare digests with every other node, push the
+        shared files the peer lacks or holds an older version of, and delete
+        the ones the peer still holds that were deleted here later. Returns
+        the number of files pushed or deleted.
+        """
+        if not self.enabled:
+            return 0
+        headers = {"Authorization": self.auth_token}
+        params = {"peer": self.node_url}
+        pushed = 0
+        for peer in self.ring.nodes:
+            if peer == self.node_url:
+                continue
+            try:
+                response = self.session.get(
+                    f"{peer}sync/digest", params=params, headers=headers
+                )
+                response.raise_for_status()
+                theirs = response.json()["buckets"]
+                for bucket, value in self.digest(peer).items():
+                    if theirs.get(bucket) == value:
+                        continue
+                    response = self.session.get(
+                        f"{peer}sync/files",
+                        params=dict(params, bucket=bucket),
+                        headers=headers,
+                    )
+                    response.raise_for_status()
+                    remote = response.json()["files"]
+                    local = self.shared_files(peer, int(bucket))
+                    for filename, version in local.items():
+                        other = remote.get(filename)
+                        if other is not None and (
+                            other[0] == version[0]
+                            or version_key(other) > version_key(version)
+                        ):
+                            continue
+                        if version[0] is None:
+                            category, deleted_at = get_tombstone(filename)
+                            pushed += self.delete(filename, category, deleted_at, peer)
+                        else:
+                            pushed += self.push(filename, peer)
+            except (OSError, requests.RequestException):
+                logger.exception("Anti-entropy with %s failed", peer)
+        return pushed
+
+    def start(self, interval):
+        """Run anti-entropy passes every `interval` seconds on a daemon thread."""
+        if not self.enabled or interval <= 0:
+            return None
+
+        def loop():
+            while not stop.wait(interval):
+                self.anti_entropy()
+
+        stop = threading.Event()
+        threading.Thread(target=loop, name="anti-entropy", daemon=True).start()
+        return stop
+
+
+def from_environment(ring, node_url, auth_token):
+    """A Replicator configured from REPLICAS and CATEGORY_REPLICAS."""
+    replicas, category_replicas = parse_replicas(
+        os.getenv("REPLICAS", "1"), os.getenv("CATEGORY_REPLICAS", "")
+    )
+    return Replicator(ring, node_url, auth_token, replicas, category_replicas)
@@ -0,0 +1,68 @@
+import bisect
+import hashlib
+
+DEFAULT_VNODES = 64
+
+
+def normalize_url(url):
+    """Node URLs are compared as written, always with a trailing slash."""
+    url = url.strip()
+    return url if url.endswith("/") else url + "/"
+
+
+def ring_hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    Consistent hash ring assigning keys (filenames) to node URLs. Each node
+    owns `vnodes` points on the ring, so adding or removing a node only moves
+    the keys of the ranges it gains or loses.
+    """
+
+    def __init__(self, nodes=(), vnodes=DEFAULT_VNODES):
+        self.nodes = sorted({normalize_url(node) for node in nodes})
+        self.vnodes = vnodes
+        points = sorted(
+            (ring_hash(f"{node}#{i}"), node)
+            for node in self.nodes
+            for i in range(vnodes)
+        )
+        self._hashes = [point[0] for point in points]
+        self._owners = [point[1] for point in points]
+
+    def __bool__(self):
+        return bool(self.nodes)
+
+    @property
+    def version(self):
+        """Identifies the membership, so stale copies of the map can be spotted."""
+        return hashlib.sha256(
+            f"{self.vnodes}|{'|'.join(self.nodes)}".encode()
+        ).hexdigest()[:16]
+
+    def nodes_for(self, key, count=1):
+        """The first `count` distinct nodes clockwise from `key`'s position."""
+        count = min(count, len(self.nodes))
+        found = []
+        start = bisect.bisect(self._hashes, ring_hash(key))
+        for i in range(len(self._owners)):
+            node = self._owners[(start + i) % len(self._owners)]
+            if node not in found:
+                found.append(node)
+                if len(found) == count:
+                    break
+        return found
+
+    def node_for(self, key):
+        """The node owning `key`, or None for an empty ring."""
+        nodes = self.nodes_for(key)
+        return nodes[0] if nodes else None
+
+    def to_dict(self):
+        return {"nodes": self.nodes, "vnodes": self.vnodes, "version": self.version}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data.get("nodes", ()), data.get("vnodes", DEFAULT_VNODES))
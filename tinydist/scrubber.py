@@ -0,0 +1,290 @@
+"""
+Integrity scrubber: re-hashes stored files against metadata.checksum.
+
+Run it on the server host, from the server's working directory:
+
+    python -m tinydist.scrubber --days 7 --workers 4 --max-mbps 100
+
+or let the server run it every SCRUB_INTERVAL seconds.
+"""
+
+import gzip
+import hashlib
+import json
+import logging
+import mmap
+import multiprocessing
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime, timedelta
+
+import click
+import dotenv
+
+from tinydist.compression import DECODE_ERRORS, ENCODINGS, iter_decoded
+from tinydist.store import (
+    CAS_STORAGE,
+    COLD_STORAGE,
+    PACK_STORAGE,
+    invalidate_file,
+    record_verification,
+    scrub_candidates,
+    stored_segments,
+)
+from tinydist.utils import quarantine_directory
+
+dotenv.load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+READ_SIZE = 8 * MB
+DEFAULT_WORKERS = 2
+DEFAULT_MAX_MBPS = 50
+
+# Files kept in files shared with others, which are never moved as a whole
+# and change while a file in them stays the same.
+SHARED_STORAGE = (CAS_STORAGE, PACK_STORAGE)
+
+OK = "ok"
+MISMATCH = "mismatch"
+MISSING = "missing"
+
+
+class Throttle:
+    """Sleeps as needed to keep reads under `rate` bytes per second."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.started = time.monotonic()
+        self.done = 0
+
+    def __call__(self, num_bytes):
+        if not self.rate:
+            return
+        self.done += num_bytes
+        ahead = self.done / self.rate - (time.monotonic() - self.started)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+def hash_segments(segments, rate=None):
+    """SHA-256 of the concatenation of `segments`, reading them memory-mapped."""
+    sha256 = hashlib.sha256()
+    throttle = Throttle(rate)
+    for segment in segments:
+        if not segment.length:
+            continue
+        with open(segment.path, "rb") as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ
+        ) as mapped:
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+            stop = segment.offset + segment.length
+            for start in range(segment.offset, stop, READ_SIZE):
+                end = min(start + READ_SIZE, stop)
+                sha256.update(memoryview(mapped)[start:end])
+                throttle(end - start)
+    return sha256.hexdigest()
+
+
+def hash_compressed(path, rate=None):
+    """SHA-256 of the decompressed content of a cold-tier gzip copy."""
+    sha256 = hashlib.sha256()
+    throttle = Throttle(rate)
+    with gzip.open(path, "rb") as f:
+        while data := f.read(READ_SIZE):
+            sha256.update(data)
+            throttle(len(data))
+    return sha256.hexdigest()
+
+
+def hash_decoded(segments, encoding, rate=None):
+    """SHA-256 of the decompressed content of compressed parts."""
+    sha256 = hashlib.sha256()
+    throttle = Throttle(rate)
+    for data in iter_decoded(segments, encoding, READ_SIZE):
+        sha256.update(data)
+        throttle(len(data))
+    return sha256.hexdigest()
+
+
+def hash_stored(path, segments, storage=None, rate=None):
+    """
+    SHA-256 of a stored file: its `segments`, or the cold copy at `path` when
+    there are none. None if the data is missing. Runs in the worker processes.
+    """
+    try:
+        if segments is None:
+            return hash_compressed(path, rate)
+        if storage in ENCODINGS:
+            return hash_decoded(segments, storage, rate)
+        return hash_segments(segments, rate)
+    except FileNotFoundError:
+        return None
+    except DECODE_ERRORS:
+        return ""  # Not decodable, so it cannot match.
+
+
+def segments_to_hash(record):
+    """What `hash_stored` reads for a record, or False if it is already gone."""
+    if record[4] == COLD_STORAGE:
+        return None
+    try:
+        return stored_segments(record)
+    except FileNotFoundError:
+        return False
+
+
+def stored_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except (FileNotFoundError, TypeError):
+        return None
+
+
+def quarantine(record):
+    """Move the data of a file that failed verification out of the way."""
+    file_id, filename, path = record[:3]
+    os.makedirs(quarantine_directory, exist_ok=True)
+    stamp = datetime.now().strftime("%Y%m%dT%H%M%S")
+    target = os.path.join(quarantine_directory, f"{os.path.basename(path)}.{stamp}")
+    shutil.move(path, target)
+    invalidate_file(filename, file_id)
+    logger.warning("Quarantined %s at %s", filename, target)
+    return target
+
+
+def scrub(
+    days=None,
+    workers=DEFAULT_WORKERS,
+    max_mbps=DEFAULT_MAX_MBPS,
+    quarantine_mismatches=False,
+):
+    """
+    Re-hash stored files in a process pool and record when each was verified
+    and whether it matched. With `days`, files verified within that many days
+    are skipped. `max_mbps` caps the combined read rate of the workers.
+    Content-addressed and packed files share their data files with others,
+    so they are reported but never quarantined. Returns a summary.
+    """
+    verified_before = None
+    if days is not None:
+        verified_before = (datetime.now() - timedelta(days=days)).isoformat(" ")
+    rate = max_mbps * MB / workers if max_mbps else None
+    summary = {"checked": 0, "ok": 0, "mismatch": [], "missing": [], "quarantined": []}
+
+    def finish(future, record, mtime):
+        file_id, filename, path, checksum, storage = record
+        digest = future.result() if future else None
+        if digest is None:
+            result = MISSING
+        elif digest == checksum:
+            result = OK
+        elif storage not in SHARED_STORAGE and stored_mtime(path) != mtime:
+            return  # Replaced while it was being read.
+        else:
+            result = MISMATCH
+        if not record_verification(file_id, path, checksum, result):
+            return
+        summary["checked"] += 1
+        if result == OK:
+            summary["ok"] += 1
+            return
+        summary[result].append(filename)
+        logger.warning("Integrity check of %s: %s", filename, result)
+        if (
+            result == MISMATCH
+            and quarantine_mismatches
+            and storage not in SHARED_STORAGE
+        ):
+            quarantine(record)
+            summary["quarantined"].append(filename)
+
+    # Spawned rather than forked: the server process runs other threads.
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        pending = {}
+
+        def drain(limit):
+            while len(pending) > limit:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    finish(future, *pending.pop(future))
+
+        for record in scrub_candidates(verified_before):
+            drain(workers * 2)
+            mtime = stored_mtime(record[2])
+            segments = segments_to_hash(record)
+            if segments is False:
+                finish(None, record, mtime)
+                continue
+            future = pool.submit(hash_stored, record[2], segments, record[4], rate)
+            pending[future] = (record, mtime)
+        drain(0)
+    return summary
+
+
+def start(interval, **settings):
+    """Scrub every `interval` seconds on a daemon thread; 0 disables it."""
+    if interval <= 0:
+        return None
+
+    def loop():
+        while not stop.wait(interval):
+            try:
+                scrub(**settings)
+            except Exception:
+                logger.exception("Scrubbing failed")
+
+    stop = threading.Event()
+    threading.Thread(target=loop, name="scrubber", daemon=True).start()
+    return stop
+
+
+def start_from_environment():
+    """
+    Start the scrubber configured by SCRUB_INTERVAL, SCRUB_DAYS,
+    SCRUB_WORKERS, SCRUB_MAX_MBPS and QUARANTINE_MISMATCHES.
+    """
+    return start(
+        float(os.getenv("SCRUB_INTERVAL", "0")),
+        days=float(os.getenv("SCRUB_DAYS", "7")),
+        workers=int(os.getenv("SCRUB_WORKERS", str(DEFAULT_WORKERS))),
+        max_mbps=float(os.getenv("SCRUB_MAX_MBPS", str(DEFAULT_MAX_MBPS))),
+        quarantine_mismatches=os.getenv("QUARANTINE_MISMATCHES", "").lower()
+        in ("1", "true", "yes"),
+    )
+
+
+@click.command()
+@click.option(
+    "--days",
+    type=float,
+    default=None,
+    help="Only check files not verified within this many days.",
+)
+@click.option("--workers", default=DEFAULT_WORKERS, help="Hashing processes.")
+@click.option(
+    "--max-mbps",
+    type=float,
+    default=DEFAULT_MAX_MBPS,
+    help="Combined read rate cap in MB/s, 0 for none.",
+)
+@click.option(
+    "--quarantine",
+    is_flag=True,
+    help=f"Move files that fail to {quarantine_directory}.",
+)
+def main(days, workers, max_mbps, quarantine):
+    """Verify stored files against their recorded SHA-256."""
+    summary = scrub(days, workers, max_mbps, quarantine)
+    click.echo(json.dumps(summary, indent=2))
+    if summary["mismatch"] or summary["missing"]:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
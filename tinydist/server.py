@@ -1,22 +1,172 @@
+import base64
+import hashlib
+import json
 import os
+import re
 import shutil
-import sqlite3
-from datetime import datetime
+import tarfile
+import threading
+import time
+import uuid
+from urllib.parse import quote
 
 import dotenv
-from flask import Flask, Response, jsonify, request, send_file, stream_with_context
+import requests
+from flask import (
+    Flask,
+    Response,
+    jsonify,
+    redirect,
+    request,
+    send_file,
+    stream_with_context,
+)
 from send2trash import send2trash
 from werkzeug.utils import secure_filename
 
-from tinydist.utils import file_directory, generate_file_stream, get_path_sync
+from tinydist.archive import CHECKSUM_PAX_HEADER, ArchiveEntry, iter_tar, iter_zip
+from tinydist.arrays import describe, iter_array, list_arrays
+from tinydist.compression import (
+    ENCODINGS,
+    IDENTITY,
+    available_encodings,
+    decoded_digest,
+    iter_decoded,
+    parse_category_encodings,
+)
+from tinydist.metrics import (
+    ROUTE_KEY,
+    DiskUsage,
+    MetricsMiddleware,
+    render,
+    tracks_in_flight,
+)
+from tinydist.packs import compact, pack_stats, packer, start_compactor
+from tinydist.replication import REPLICA_HEADER, from_environment
+from tinydist.ring import HashRing, normalize_url
+from tinydist.scrubber import hash_decoded, hash_segments
+from tinydist.scrubber import start_from_environment as start_scrubber
+from tinydist.store import (
+    CAS_STORAGE,
+    COLD_STORAGE,
+    METADATA_COLUMNS,
+    PACK_STORAGE,
+    add_chunk,
+    chunk_checksums,
+    cold_usage,
+    commit_manifest,
+    connection,
+    file_cache,
+    get_checksum,
+    get_metadata,
+    get_tombstone,
+    hot_usage,
+    init_db,
+    invalidate_file,
+    iter_metadata,
+    lookup_file,
+    missing_chunk_hashes,
+    now,
+    record_access,
+    record_tombstone,
+    release_manifest,
+    remove_unreferenced_chunks,
+    replace_chunk_checksums,
+    start_access_flusher,
+    stored_segments,
+    upsert_metadata,
+    upsert_metadata_many,
+)
+from tinydist.tiering import DISK_QUOTA, LOW_WATERMARK, promote, tierer
+from tinydist.utils import (
+    ChecksumMismatch,
+    ChunkHasher,
+    PrefixedStream,
+    Segment,
+    assemble_parts,
+    calculate_checksum,
+    close_files,
+    file_directory,
+    file_segments,
+    hash_parts,
+    iter_segments,
+    list_chunk_parts,
+    object_path,
+    open_segments,
+    read_at_most,
+    save_stream,
+)
 
 app = Flask(__name__)
+app.wsgi_app = MetricsMiddleware(app.wsgi_app)
 dotenv.load_dotenv()
 
+AUTH_TOKEN = os.getenv("AUTH_TOKEN")
+MAX_METADATA_PAGE = 10000
+SHA256_PATTERN = re.compile(r"[0-9a-f]{64}")
 
-DB_NAME = os.getenv("DATABASE_NAME", "metadata.db")
+# Cluster mode: every node lists all members in CLUSTER_NODES and its own URL,
+# as it appears there, in NODE_URL. Each filename is owned by one node.
+ring = HashRing(filter(str.strip, os.getenv("CLUSTER_NODES", "").split(",")))
+NODE_URL = normalize_url(os.getenv("NODE_URL")) if os.getenv("NODE_URL") else None
+
+# Per-category replication to the next nodes on the ring (REPLICAS and
+# CATEGORY_REPLICAS), repaired by anti-entropy every ANTI_ENTROPY_INTERVAL s.
+replicator = from_environment(ring, NODE_URL, AUTH_TOKEN)
+
+# Chunked uploads of these categories are compressed unless the client opts out.
+CATEGORY_COMPRESSION = parse_category_encodings(os.getenv("CATEGORY_COMPRESSION", ""))
+
+# Uploads of at most PACK_MAX_KB are appended to pack segments (off by default),
+# which are compacted every PACK_COMPACT_INTERVAL s.
+PACK_MAX_SIZE = int(float(os.getenv("PACK_MAX_KB", "0")) * 1024)
+
+
+def create_app():
+    """
+    Prepare the database and start this node's background work, then return
+    the app to serve. Importing this module starts nothing, so that the
+    scrubber's spawned workers, which import `__main__` again, do not.
+    """
+    init_db()
+    # Anti-entropy repair every ANTI_ENTROPY_INTERVAL s.
+    replicator.start(float(os.getenv("ANTI_ENTROPY_INTERVAL", "300")))
+    # Download counts are buffered in memory and written every
+    # ACCESS_FLUSH_INTERVAL s.
+    start_access_flusher(float(os.getenv("ACCESS_FLUSH_INTERVAL", "5")))
+    # Stored files are re-hashed every SCRUB_INTERVAL s (off by default).
+    start_scrubber()
+    start_compactor(float(os.getenv("PACK_COMPACT_INTERVAL", "3600")))
+    return app
+
+
+# Serialises publishing chunk objects with collecting unreferenced ones, so a
+# chunk re-uploaded while it is being collected is not unlinked under it.
+cas_lock = threading.Lock()
 
-AUTH_TOKEN = os.getenv("AUTH_TOKEN")
+
+# Size of file_directory for /metrics, rescanned at most every DISK_USAGE_TTL s.
+disk_usage = DiskUsage(file_directory, float(os.getenv("DISK_USAGE_TTL", "60")))
+
+
+@app.before_request
+def label_route():
+    """Let the metrics middleware label the request by its route."""
+    if request.url_rule is not None:
+        request.environ[ROUTE_KEY] = request.url_rule.rule
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Prometheus metrics of this node."""
+    gauges = [
+        (
+            "tinydist_disk_usage_bytes",
+            "Size of the stored files, from a periodic scan.",
+            [((("directory", file_directory),), disk_usage.get())],
+        ),
+    ]
+    return Response(render(gauges), mimetype="text/plain; version=0.0.4")
 
 
 def check_auth(token):
@@ -24,6 +174,70 @@ def check_auth(token):
     return token == AUTH_TOKEN
 
 
+def misdirected(filename):
+    """
+    A 421 response naming the owner when `filename` belongs to another node
+    of the cluster, so clients with a stale ring map can refresh it.
+    """
+    owner = ring.node_for(filename) if NODE_URL else None
+    if owner and owner != NODE_URL:
+        return (
+            jsonify(
+                {
+                    "message": f"{filename} belongs to {owner}",
+                    "owner": owner,
+                    "ring": ring.to_dict(),
+                }
+            ),
+            421,
+        )
+    return None
+
+
+@app.route("/ring", methods=["GET"])
+def get_ring():
+    """
+    The cluster's ring map, empty when running as a single node, with the
+    replica counts per category.
+    """
+    return jsonify(
+        dict(
+            ring.to_dict(),
+            replicas=replicator.replicas,
+            category_replicas=replicator.category_replicas,
+        )
+    )
+
+
+def save_upload(stream, filename, expected_checksum, chunk_hasher):
+    """
+    Store an upload of `filename` and return its (path, size, checksum,
+    storage, pack_offset). Uploads of at most PACK_MAX_SIZE bytes are appended
+    to a pack segment; larger ones are streamed to a file of their own.
+    """
+    head = read_at_most(stream, PACK_MAX_SIZE + 1) if PACK_MAX_SIZE else b""
+    if PACK_MAX_SIZE and len(head) <= PACK_MAX_SIZE:
+        segment, offset, checksum = packer.append(head, expected_checksum)
+        chunk_hasher.update(head)
+        return segment, len(head), checksum, PACK_STORAGE, offset
+    path = os.path.join(file_directory, filename)
+    size, checksum = save_stream(
+        PrefixedStream(head, stream), path, expected_checksum, chunk_hasher=chunk_hasher
+    )
+    return path, size, checksum, None, None
+
+
+def unpacked_path(filename, storage):
+    """
+    The plain file or `_chunks` directory of `filename` that a packed upload
+    replaces, to remove once the new metadata is written.
+    """
+    record = lookup_file(filename, False)
+    if storage == PACK_STORAGE and record and record[4] in (None, *ENCODINGS):
+        return record[2]
+    return None
+
+
 @app.route("/upload", methods=["POST"])
 def upload_file():
     auth_token = request.headers.get("Authorization")
@@ -35,17 +249,160 @@ def upload_file():
 
     if file and file.filename:
         filename = secure_filename(file.filename)
-        path = os.path.join(file_directory, filename)
-        file.save(path)
-        upload_metadata(filename, path, category)
+        if response := misdirected(filename):
+            return response
+        hasher = ChunkHasher()
+        try:
+            path, size, checksum, storage, offset = save_upload(
+                file.stream, filename, request.form.get("checksum"), hasher
+            )
+        except ChecksumMismatch as e:
+            return jsonify({"message": str(e)}), 400
+        replaced = unpacked_path(filename, storage)
+        upsert_metadata(
+            filename,
+            path,
+            category,
+            checksum,
+            size,
+            chunks=hasher.digests(),
+            storage=storage,
+            pack_offset=offset,
+        )
+        remove_stored_file(replaced)
+        replicator.replicate(filename, category)
+        tierer.schedule()
         return jsonify({"message": "File uploaded successfully", "filename": filename})
     return jsonify({"message": "Invalid file format"}), 400
 
 
+@app.route("/upload/<filename>", methods=["PUT"])
+def put_file(filename):
+    """
+    Store the raw request body as `filename`, streaming it to disk and hashing
+    it in one pass. The server-computed SHA-256 is what gets recorded; an
+    `X-Checksum` header that disagrees with it rejects the upload.
+    """
+    auth_token = request.headers.get("Authorization")
+    if not check_auth(auth_token):
+        return jsonify({"message": "Unauthorized"}), 401
+
+    filename = secure_filename(filename)
+    if not filename:
+        return jsonify({"message": "Invalid filename"}), 400
+    category = request.args.get("category", "default")
+    # A copy pushed by a peer keeps the timestamp of the original upload.
+    replica_timestamp = request.headers.get(REPLICA_HEADER)
+    if not (replica_timestamp and replicator.holds(filename, category)):
+        if response := misdirected(filename):
+            return response
+    if replica_timestamp:
+        current = get_metadata(filename)
+        if current and current["upload_timestamp"] > replica_timestamp:
+            return jsonify({"message": "A newer version is stored"}), 409
+        tombstone = get_tombstone(filename)
+        if tombstone and tombstone[1] >= replica_timestamp:
+            return jsonify({"message": "The file was deleted since"}), 409
+    hasher = ChunkHasher()
+    try:
+        path, size, checksum, storage, offset = save_upload(
+            request.stream, filename, request.headers.get("X-Checksum"), hasher
+        )
+    except ChecksumMismatch as e:
+        return jsonify({"message": str(e)}), 400
+    replaced = unpacked_path(filename, storage)
+    upsert_metadata(
+        filename,
+        path,
+        category,
+        checksum,
+        size,
+        replica_timestamp,
+        chunks=hasher.digests(),
+        storage=storage,
+        pack_offset=offset,
+    )
+    remove_stored_file(replaced)
+    tierer.schedule()
+    if not replica_timestamp:
+        replicator.replicate(filename, category)
+    return jsonify(
+        {
+            "message": "File uploaded successfully",
+            "filename": filename,
+            "checksum": checksum,
+        }
+    )
+
+
+@app.route("/upload_batch", methods=["POST"])
+def upload_batch():
+    """
+    Store every regular file in a tar stream sent as the request body and
+    record all their metadata in one transaction. Members are hashed as they
+    are written; those whose PAX header declares a different checksum, or
+    that another cluster node owns, are rejected and listed in the response.
+    """
+    auth_token = request.headers.get("Authorization")
+    if not check_auth(auth_token):
+        return jsonify({"message": "Unauthorized"}), 401
+
+    category = request.args.get("category", "default")
+    records = {}
+    rejected = []
+    replaced = []
+    try:
+        with tarfile.open(fileobj=request.stream, mode="r|") as archive:
+            for member in archive:
+                filename = secure_filename(os.path.basename(member.name))
+                if not member.isfile() or not filename:
+                    continue
+                if misdirected(filename):
+                    rejected.append(filename)
+                    continue
+                hasher = ChunkHasher()
+                try:
+                    path, size, checksum, storage, offset = save_upload(
+                        archive.extractfile(member),
+                        filename,
+                        member.pax_headers.get(CHECKSUM_PAX_HEADER),
+                        hasher,
+                    )
+                except ChecksumMismatch:
+                    rejected.append(filename)
+                    continue
+                replaced.append(unpacked_path(filename, storage))
+                records[filename] = (
+                    filename,
+                    path,
+                    category,
+                    checksum,
+                    size,
+                    hasher.digests(),
+                    storage,
+                    offset,
+                )
+    except tarfile.TarError as e:
+        return jsonify({"message": f"Invalid tar stream: {e}"}), 400
+
+    upsert_metadata_many(list(records.values()))
+    for path in replaced:
+        remove_stored_file(path)
+    tierer.schedule()
+    for filename in records:
+        replicator.replicate(filename, category)
+    return jsonify(
+        {
+            "message": f"{len(records)} files uploaded successfully",
+            "filenames": list(records),
+            "rejected": rejected,
+        }
+    )
+
+
 def ensure_directory_exists(path):
-    print("path", path)
-    if not os.path.isdir(path):
-        os.makedirs(path)
+    # Chunks of one file may arrive concurrently, so creation can race.
+    os.makedirs(path, exist_ok=True)
 
 
 def cleanup_failed_upload(filename, chunks_dir_path):
@@ -62,6 +419,7 @@ def cleanup_failed_upload(filename, chunks_dir_path):
 
 
 @app.route("/upload_chunk", methods=["POST"])
+@tracks_in_flight("tinydist_chunk_uploads_in_flight")
 def upload_chunk():
     auth_token = request.headers.get("Authorization")
     if not check_auth(auth_token):
@@ -82,107 +440,1032 @@ def upload_chunk():
     chunk_path = os.path.join(chunks_dir_path, chunk_filename)
     file.save(chunk_path)
     if chunk_index == total_chunks - 1:
-        upload_metadata(filename, chunks_dir_path, category, checksum)
+        received = hash_segments(file_segments(chunks_dir_path))
+        if checksum and checksum.lower() != received:
+            return (
+                jsonify(
+                    {
+                        "message": f"Uploaded file has checksum {received}, "
+                        f"expected {checksum}"
+                    }
+                ),
+                400,
+            )
+        upload_metadata(
+            filename, chunks_dir_path, category, received, hash_parts(chunks_dir_path)
+        )
 
     return jsonify({"message": f"Chunk {chunk_index} uploaded successfully"})
 
 
-def upload_metadata(filename, path, category, checksum=None):
+def upload_metadata(
+    filename, path, category, checksum=None, chunks=None, size=None, storage=None
+):
     """Insert file metadata into the database."""
-    with sqlite3.connect(DB_NAME) as conn:
+    if size is None:
+        size = sum(segment.length for segment in file_segments(path))
+    upsert_metadata(
+        filename, path, category, checksum, size, chunks=chunks, storage=storage
+    )
+    replicator.replicate(filename, category)
+    tierer.schedule()
+
+
+def session_staging_path(session_id):
+    """Directory where the parts of an unfinished upload session are kept."""
+    return os.path.join(file_directory, ".sessions", session_id)
+
+
+def expected_chunk_size(upload_session, chunk_index):
+    """Size the chunk at `chunk_index` must have for this session."""
+    if chunk_index < upload_session["total_chunks"] - 1:
+        return upload_session["chunk_size"]
+    return upload_session["file_size"] - upload_session["chunk_size"] * chunk_index
+
+
+def get_upload_session(cursor, session_id):
+    cursor.execute(
+        """SELECT id, filename, category, file_size, chunk_size, total_chunks,
+        encoding FROM upload_sessions WHERE id = ?""",
+        (session_id,),
+    )
+    record = cursor.fetchone()
+    if not record:
+        return None
+    keys = (
+        "id",
+        "filename",
+        "category",
+        "file_size",
+        "chunk_size",
+        "total_chunks",
+        "encoding",
+    )
+    return dict(zip(keys, record))
+
+
+def missing_chunks(cursor, upload_session):
+    cursor.execute(
+        "SELECT chunk_index FROM upload_chunks WHERE session_id = ?",
+        (upload_session["id"],),
+    )
+    received = {row[0] for row in cursor.fetchall()}
+    return [i for i in range(upload_session["total_chunks"]) if i not in received]
+
+
+def session_status(cursor, upload_session):
+    """
+    What the session holds. `hashes` has the SHA-256 of each received chunk
+    (decompressed) and None for the others, so a resuming client can tell
+    which of the held chunks no longer match its file and send them again.
+    """
+    cursor.execute(
+        "SELECT chunk_index, hash FROM upload_chunks WHERE session_id = ?",
+        (upload_session["id"],),
+    )
+    received = dict(cursor.fetchall())
+    total_chunks = upload_session["total_chunks"]
+    missing = [i for i in range(total_chunks) if i not in received]
+    return {
+        "session_id": upload_session["id"],
+        "filename": upload_session["filename"],
+        "total_chunks": total_chunks,
+        "chunk_size": upload_session["chunk_size"],
+        "missing": missing,
+        "received": total_chunks - len(missing),
+        "hashes": [received.get(i) for i in range(total_chunks)],
+        "encoding": upload_session["encoding"],
+    }
+
+
+def session_encoding(params, category):
+    """
+    How the chunks of a new session are compressed: the `encoding` the client
+    asked for, else the category's CATEGORY_COMPRESSION if the client lists
+    it among its `encodings`. None means uncompressed.
+    """
+    encoding = params.get("encoding")
+    if encoding is None:
+        encoding = CATEGORY_COMPRESSION.get(category)
+        if encoding not in params.get("encodings", available_encodings()):
+            return None
+    if encoding == IDENTITY:
+        return None
+    if encoding not in available_encodings():
+        raise ValueError(f"Unsupported encoding {encoding}")
+    return encoding
+
+
+@app.route("/upload_session", methods=["POST"])
+def create_upload_session():
+    """
+    Start a chunked upload. With `resume`, an unfinished session for the same
+    file layout is returned instead, so the client only sends what is missing
+    or, going by `hashes`, has changed since.
+    The response says which `encoding` the chunks must be compressed with.
+    """
+    auth_token = request.headers.get("Authorization")
+    if not check_auth(auth_token):
+        return jsonify({"message": "Unauthorized"}), 401
+
+    params = request.get_json(silent=True) or request.form
+    filename = secure_filename(params.get("filename") or "")
+    category = params.get("category") or "default"
+    try:
+        file_size = int(params.get("file_size"))
+        chunk_size = int(params.get("chunk_size"))
+    except (TypeError, ValueError):
+        return jsonify({"message": "file_size and chunk_size are required"}), 400
+    if filename and (response := misdirected(filename)):
+        return response
+    if not filename or file_size < 0 or chunk_size <= 0:
+        return jsonify({"message": "Invalid upload session parameters"}), 400
+    total_chunks = max(-(-file_size // chunk_size), 1)
+    resume = str(params.get("resume", "")).lower() in ("1", "true", "yes")
+    try:
+        encoding = session_encoding(params, category)
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 415
+
+    with connection() as conn:
         cursor = conn.cursor()
+        if resume:
+            cursor.execute(
+                """SELECT id FROM upload_sessions
+                WHERE filename = ? AND file_size = ? AND chunk_size = ?
+                AND encoding IS ?
+                ORDER BY created_timestamp DESC LIMIT 1""",
+                (filename, file_size, chunk_size, encoding),
+            )
+            record = cursor.fetchone()
+            if record:
+                upload_session = get_upload_session(cursor, record[0])
+                return jsonify(session_status(cursor, upload_session))
+
+        session_id = uuid.uuid4().hex
         cursor.execute(
-            """CREATE TABLE IF NOT EXISTS metadata (
-                            id INTEGER PRIMARY KEY AUTOINCREMENT,
-                            filename TEXT UNIQUE,
-                            path TEXT,
-                            checksum TEXT,
-                            upload_timestamp DATETIME,
-                            last_accessed DATETIME,
-                            access_count INTEGER DEFAULT 0,
-                            category TEXT)"""
+            """INSERT INTO upload_sessions (id, filename, category, file_size,
+                chunk_size, total_chunks, created_timestamp, encoding)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+            (
+                session_id,
+                filename,
+                category,
+                file_size,
+                chunk_size,
+                total_chunks,
+                now(),
+                encoding,
+            ),
         )
-        cursor.execute(
-            """INSERT INTO metadata \
-                (filename, path, upload_timestamp, category, checksum)
-                              VALUES (?, ?, ?, ?, ?)
-                              ON CONFLICT(filename) DO UPDATE SET
-                              path=excluded.path,
-                              upload_timestamp=excluded.upload_timestamp,
-                              category=excluded.category,
-                              checksum=excluded.checksum""",
-            (filename, path, datetime.now(), category, checksum),
+        ensure_directory_exists(session_staging_path(session_id))
+        upload_session = get_upload_session(cursor, session_id)
+        return jsonify(session_status(cursor, upload_session)), 201
+
+
+@app.route("/upload_session/<session_id>", methods=["GET"])
+def get_upload_session_status(session_id):
+    auth_token = request.headers.get("Authorization")
+    if not check_auth(auth_token):
+        return jsonify({"message": "Unauthorized"}), 401
+
+    with connection() as conn:
+        cursor = conn.cursor()
+        upload_session = get_upload_session(cursor, session_id)
+        if not upload_session:
+            return jsonify({"message": "Upload session not found"}), 404
+        return jsonify(session_status(cursor, upload_session))
+
+
+@app.route("/upload_session/<session_id>/<int:chunk_index>", methods=["PUT"])
+@tracks_in_flight("tinydist_chunk_uploads_in_flight")
+def put_session_chunk(session_id, chunk_index):
+    """
+    Store the raw request body as chunk `chunk_index` of the session. Chunks of
+    a compressed session are kept compressed, and are checked and hashed by
+    decompressing them.
+    """
+    auth_token = request.headers.get("Authorization")
+    if not check_auth(auth_token):
+        return jsonify({"message": "Unauthorized"}), 401
+
+    with connection() as conn:
+        cursor = conn.cursor()
+        upload_session = get_upload_session(cursor, session_id)
+    if not upload_session:
+        return jsonify({"message": "Upload session not found"}), 404
+    if not 0 <= chunk_index < upload_session["total_chunks"]:
+        return jsonify({"message": f"Chunk index {chunk_index} out of range"}), 400
+
+    encoding = upload_session["encoding"]
+    if request.headers.get("Content-Encoding", IDENTITY) != (encoding or IDENTITY):
+        return (
+            jsonify({"message": f"Chunks must have Content-Encoding {encoding}"}),
+            415,
         )
 
+    chunk_path = os.path.join(
+        session_staging_path(session_id),
+        f"{upload_session['filename']}.part{chunk_index}",
+    )
+    size, chunk_hash = save_stream(request.stream, chunk_path)
+    expected = expected_chunk_size(upload_session, chunk_index)
+    if encoding:
+        try:
+            size, chunk_hash = decoded_digest(chunk_path, encoding, expected)
+        except ValueError as e:
+            os.remove(chunk_path)
+            return jsonify({"message": f"Chunk {chunk_index}: {e}"}), 400
+    if size != expected:
+        os.remove(chunk_path)
+        return (
+            jsonify(
+                {
+                    "message": f"Chunk {chunk_index} has {size} bytes, expected {expected}"
+                }
+            ),
+            400,
+        )
+
+    with connection() as conn:
+        conn.execute(
+            """INSERT OR REPLACE INTO upload_chunks
+            (session_id, chunk_index, size, hash) VALUES (?, ?, ?, ?)""",
+            (session_id, chunk_index, size, chunk_hash),
+        )
+    return jsonify({"message": f"Chunk {chunk_index} uploaded successfully"})
+
+
+@app.route("/upload_session/<session_id>/finalize", methods=["POST"])
+def finalize_upload_session(session_id):
+    """Publish a session whose chunks have all arrived as a regular upload."""
+    auth_token = request.headers.get("Authorization")
+    if not check_auth(auth_token):
+        return jsonify({"message": "Unauthorized"}), 401
+
+    params = request.get_json(silent=True) or request.form
+    checksum = params.get("checksum")
+    assemble = str(params.get("assemble", "")).lower() in ("1", "true", "yes")
+
+    with connection() as conn:
+        cursor = conn.cursor()
+        upload_session = get_upload_session(cursor, session_id)
+        if not upload_session:
+            return jsonify({"message": "Upload session not found"}), 404
+        missing = missing_chunks(cursor, upload_session)
+        if missing:
+            return (
+                jsonify({"message": "Upload is incomplete", "missing": missing}),
+                409,
+            )
+
+        filename = upload_session["filename"]
+        encoding = upload_session["encoding"]
+        # Compressed parts are served as they are, never joined.
+        assemble = assemble and not encoding
+        # Each chunk was hashed as it was received.
+        chunks = cursor.execute(
+            """SELECT size, hash FROM upload_chunks
+            WHERE session_id = ? ORDER BY chunk_index""",
+            (session_id,),
+        ).fetchall()
+        staging_path = session_staging_path(session_id)
+        chunks_dir_path = os.path.join(file_directory, filename + "_chunks")
+        if assemble:
+            # Join the parts into one plain file so downloads can use send_file.
+            # It is verified before it replaces the stored version.
+            path = os.path.join(file_directory, filename)
+            assembled_path = os.path.join(staging_path, "assembled")
+            assemble_parts(list_chunk_parts(staging_path), assembled_path)
+            received = calculate_checksum(assembled_path)
+        else:
+            received = staged_checksum(staging_path, encoding)
+        # The parts may come from different runs of a resumed upload, so the
+        # whole file is hashed here rather than trusting the client.
+        if checksum and checksum.lower() != received:
+            # Dropped, so that resuming does not pick the same parts again.
+            cursor.execute(
+                "DELETE FROM upload_chunks WHERE session_id = ?", (session_id,)
+            )
+            cursor.execute("DELETE FROM upload_sessions WHERE id = ?", (session_id,))
+            shutil.rmtree(staging_path, ignore_errors=True)
+            return (
+                jsonify(
+                    {
+                        "message": f"Uploaded file has checksum {received}, "
+                        f"expected {checksum}"
+                    }
+                ),
+                400,
+            )
+        checksum = received
+        if assemble:
+            os.replace(assembled_path, path)
+            shutil.rmtree(staging_path)
+        else:
+            path = chunks_dir_path
+            if os.path.isdir(chunks_dir_path):
+                shutil.rmtree(chunks_dir_path)
+            os.replace(staging_path, chunks_dir_path)
+        cursor.execute("DELETE FROM upload_chunks WHERE session_id = ?", (session_id,))
+        cursor.execute("DELETE FROM upload_sessions WHERE id = ?", (session_id,))
+
+    if assemble and os.path.isdir(chunks_dir_path):
+        shutil.rmtree(chunks_dir_path)
+    upload_metadata(
+        filename,
+        path,
+        upload_session["category"],
+        checksum,
+        chunks,
+        upload_session["file_size"],
+        encoding,
+    )
+    return jsonify({"message": "File uploaded successfully", "filename": filename})
+
+
+def staged_checksum(staging_path, encoding):
+    """SHA-256 of the file the staged parts of a session make up, decompressed."""
+    segments = file_segments(staging_path)
+    if encoding:
+        return hash_decoded(segments, encoding)
+    return hash_segments(segments)
+
+
+def remove_stored_file(path):
+    """Remove a plain file or `_chunks` directory that is no longer referenced."""
+    if not path:
+        return
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def collect_chunks():
+    """Delete the objects of chunks that no manifest references any more."""
+    with cas_lock:
+        for chunk_hash in remove_unreferenced_chunks():
+            try:
+                os.remove(object_path(chunk_hash))
+            except FileNotFoundError:
+                pass
+
+
+@app.route("/cas/have", methods=["POST"])
+def cas_have():
+    """
+    Negotiate a deduplicated upload: given the chunk hashes of a file, answer
+    with the ones the server does not have and which must be sent.
+    """
+    auth_token = request.headers.get("Authorization")
+    if not check_auth(auth_token):
+        return jsonify({"message": "Unauthorized"}), 401
+
+    hashes = (request.get_json(silent=True) or {}).get("hashes")
+    if not isinstance(hashes, list) or not all(
+        isinstance(chunk_hash, str) and SHA256_PATTERN.fullmatch(chunk_hash)
+        for chunk_hash in hashes
+    ):
+        return jsonify({"message": "hashes must be a list of SHA-256 digests"}), 400
+    return jsonify({"missing": missing_chunk_hashes(hashes)})
+
+
+@app.route("/cas/chunk/<chunk_hash>", methods=["PUT"])
+@tracks_in_flight("tinydist_chunk_uploads_in_flight")
+def cas_put_chunk(chunk_hash):
+    """Store one chunk under its SHA-256, which the body must hash to."""
+    auth_token = request.headers.get("Authorization")
+    if not check_auth(auth_token):
+        return jsonify({"message": "Unauthorized"}), 401
+    if not SHA256_PATTERN.fullmatch(chunk_hash):
+        return jsonify({"message": "Invalid chunk hash"}), 400
+
+    path = object_path(chunk_hash)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    staging_path = f"{path}.{uuid.uuid4().hex}.incoming"
+    try:
+        size, _ = save_stream(request.stream, staging_path, chunk_hash)
+    except ChecksumMismatch as e:
+        return jsonify({"message": str(e)}), 400
+    with cas_lock:
+        os.replace(staging_path, path)
+        add_chunk(chunk_hash, size)
+    return jsonify({"message": "Chunk stored", "hash": chunk_hash, "size": size})
+
+
+def chunks_checksum(hashes):
+    """
+    SHA-256 of the file made of the stored chunks `hashes`, in order, or None
+    if one of them is not stored.
+    """
+    segments = []
+    for chunk_hash in hashes:
+        path = object_path(chunk_hash)
+        try:
+            segments.append(Segment(path, 0, os.path.getsize(path)))
+        except FileNotFoundError:
+            return None
+    try:
+        return hash_segments(segments)
+    except FileNotFoundError:
+        return None
+
+
+@app.route("/cas/commit", methods=["POST"])
+def cas_commit():
+    """
+    Publish a file as an ordered list of stored chunk hashes, replacing any
+    previous upload of the same name. Answers 409 with the hashes still
+    missing if any chunk has not been uploaded.
+    """
+    auth_token = request.headers.get("Authorization")
+    if not check_auth(auth_token):
+        return jsonify({"message": "Unauthorized"}), 401
+
+    data = request.get_json(silent=True) or {}
+    filename = secure_filename(data.get("filename") or "")
+    hashes = data.get("chunks")
+    if not filename:
+        return jsonify({"message": "Invalid filename"}), 400
+    if response := misdirected(filename):
+        return response
+    if not isinstance(hashes, list) or not all(
+        isinstance(chunk_hash, str) and SHA256_PATTERN.fullmatch(chunk_hash)
+        for chunk_hash in hashes
+    ):
+        return jsonify({"message": "chunks must be a list of SHA-256 digests"}), 400
+
+    category = data.get("category", "default")
+    checksum = chunks_checksum(hashes)
+    if checksum is None:
+        return (
+            jsonify(
+                {"message": "Chunks missing", "missing": missing_chunk_hashes(hashes)}
+            ),
+            409,
+        )
+    declared = data.get("checksum")
+    if declared and declared.lower() != checksum:
+        return (
+            jsonify(
+                {"message": f"Chunks have checksum {checksum}, expected {declared}"}
+            ),
+            400,
+        )
+    missing, previous = commit_manifest(filename, category, checksum, hashes)
+    if missing:
+        return jsonify({"message": "Chunks missing", "missing": missing}), 409
+    if previous and previous[1] not in (CAS_STORAGE, PACK_STORAGE):
+        remove_stored_file(previous[0])
+    collect_chunks()
+    replicator.replicate(filename, category)
+    tierer.schedule()
+    return jsonify({"message": "File committed", "filename": filename})
+
+
+def encode_cursor(row):
+    """Opaque pagination cursor pointing just past `row`."""
+    position = json.dumps([row["upload_timestamp"], row["id"]])
+    return base64.urlsafe_b64encode(position.encode()).decode()
+
+
+def decode_cursor(cursor):
+    upload_timestamp, file_id = json.loads(base64.urlsafe_b64decode(cursor))
+    return str(upload_timestamp), int(file_id)
+
 
 @app.route("/metadata", methods=["GET"])
 def list_metadata():
+    """
+    List metadata, newest first, filtered by category, filename prefix, upload
+    time range (since/until) and size (min_size/max_size), optionally only
+    some `fields`.
+
+    JSON responses hold one page of `limit` rows; the `X-Next-Cursor` header
+    is passed back as `cursor` to get the next one. With `format=ndjson` rows
+    are streamed one per line as they are read, for every matching row unless
+    `limit` is given, in which case a final `{"next_cursor": ...}` line
+    follows a full page.
+    """
     auth_token = request.headers.get("Authorization")
     if not check_auth(auth_token):
         return jsonify({"message": "Unauthorized"}), 401
 
-    limit = request.args.get("limit", 5, type=int)
-    category = request.args.get("category", None)
+    ndjson = request.args.get("format") == "ndjson" or (
+        request.accept_mimetypes.best == "application/x-ndjson"
+    )
+    limit = request.args.get("limit", None if ndjson else 5, type=int)
+    if limit is not None and limit < 1:
+        return jsonify({"message": "limit must be at least 1"}), 400
+    if limit is not None and not ndjson:
+        limit = min(limit, MAX_METADATA_PAGE)
+    fields = request.args.get("fields")
+    fields = fields.split(",") if fields else list(METADATA_COLUMNS)
+    unknown = set(fields) - set(METADATA_COLUMNS)
+    if unknown:
+        return jsonify({"message": f"Unknown fields: {sorted(unknown)}"}), 400
+    try:
+        after = (
+            decode_cursor(request.args["cursor"]) if "cursor" in request.args else None
+        )
+    except (ValueError, TypeError):
+        return jsonify({"message": "Invalid cursor"}), 400
 
-    query = "SELECT * FROM metadata"
-    params = []
-    if category:
-        query += " WHERE category = ?"
-        params.append(category)
-    query += " ORDER BY upload_timestamp DESC LIMIT ?"
-    params.append(limit)
+    rows = iter_metadata(
+        category=request.args.get("category"),
+        prefix=request.args.get("prefix"),
+        since=request.args.get("since"),
+        until=request.args.get("until"),
+        min_size=request.args.get("min_size", type=int),
+        max_size=request.args.get("max_size", type=int),
+        after=after,
+        limit=limit,
+    )
 
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute(query, params)
-        records = cursor.fetchall()
-    return jsonify(records)
+    if ndjson:
+
+        def generate():
+            count = 0
+            row = None
+            for row in rows:
+                count += 1
+                yield json.dumps({field: row[field] for field in fields}) + "\n"
+            if limit is not None and count == limit and row is not None:
+                yield json.dumps({"next_cursor": encode_cursor(row)}) + "\n"
+
+        return Response(generate(), mimetype="application/x-ndjson")
+
+    records = list(rows)
+    response = jsonify([{field: row[field] for field in fields} for row in records])
+    if limit is not None and len(records) == limit and records:
+        response.headers["X-Next-Cursor"] = encode_cursor(records[-1])
+    return response
+
+
+@app.route("/cache_stats", methods=["GET"])
+def cache_stats():
+    """Hit, miss and eviction counters of the file lookup cache."""
+    auth_token = request.headers.get("Authorization")
+    if not check_auth(auth_token):
+        return jsonify({"message": "Unauthorized"}), 401
+    return jsonify(file_cache.stats())
+
+
+@app.route("/tiering", methods=["GET"])
+def tiering_stats():
+    """Hot volume usage against the disk quota, and what sits in the cold tier."""
+    auth_token = request.headers.get("Authorization")
+    if not check_auth(auth_token):
+        return jsonify({"message": "Unauthorized"}), 401
+    cold_files, cold_bytes = cold_usage()
+    return jsonify(
+        {
+            "hot_bytes": hot_usage(),
+            "quota_bytes": DISK_QUOTA,
+            "low_watermark": LOW_WATERMARK,
+            "cold_files": cold_files,
+            "cold_bytes": cold_bytes,
+        }
+    )
+
+
+@app.route("/packs", methods=["GET"])
+def packs_stats():
+    """Pack segments on disk and how much of them packed files still use."""
+    auth_token = request.headers.get("Authorization")
+    if not check_auth(auth_token):
+        return jsonify({"message": "Unauthorized"}), 401
+    return jsonify(pack_stats(packer))
+
+
+@app.route("/packs/compact", methods=["POST"])
+def compact_packs():
+    """Compact the pack segments that are mostly garbage now."""
+    auth_token = request.headers.get("Authorization")
+    if not check_auth(auth_token):
+        return jsonify({"message": "Unauthorized"}), 401
+    return jsonify(compact(packer))
 
 
 @app.route("/verify_get", methods=["POST"])
 def verify_upload():
     filename = request.form.get("filename")
     actual_checksum = request.form.get("checksum")
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT checksum FROM metadata WHERE filename = ?", (filename,))
-        record = cursor.fetchone()
-        print("record", record)
-        if not record:
-            return jsonify({"message": "File not found"}), 404
-        expected_checksum = record[0]
+    record = get_checksum(filename)
+    if not record:
+        return jsonify({"message": "File not found"}), 404
+    expected_checksum = record[0]
     if actual_checksum == expected_checksum:
         return jsonify({"message": "File is intact"}), 200
     else:
         return jsonify({"message": "File corrupted during transfer"}), 400
 
 
+def chunks_etag(path):
+    """Validator for a `_chunks` directory, which changes whenever it is rewritten."""
+    stat = os.stat(path)
+    return f"{stat.st_ino:x}-{stat.st_mtime_ns:x}"
+
+
+def if_range_matches(etag, last_modified=None):
+    """Whether a Range request may be honoured given its `If-Range` header."""
+    if_range = request.if_range
+    if if_range.etag is not None:
+        return if_range.etag == etag
+    if if_range.date is not None:
+        return last_modified is not None and last_modified <= if_range.date
+    return True
+
+
+def segments_response(segments, etag, headers, last_modified=None, files=None):
+    """
+    Stream `segments` as one body, answering a single byte Range with a 206
+    and an If-None-Match naming `etag` with a 304. The body is read from
+    `files` if they were opened beforehand with `open_segments`.
+    """
+    total = sum(segment.length for segment in segments)
+    headers = dict(headers, **{"Accept-Ranges": "bytes", "ETag": f'"{etag}"'})
+    if request.if_none_match.contains_weak(etag):
+        return Response(status=304, headers={"ETag": headers["ETag"]})
+    start, stop, status = 0, total, 200
+    if request.range and if_range_matches(etag, last_modified):
+        byte_range = request.range.range_for_length(total)
+        if byte_range is None:
+            headers["Content-Range"] = f"bytes */{total}"
+            return Response(status=416, headers=headers)
+        start, stop = byte_range
+        status = 206
+        headers["Content-Range"] = f"bytes {start}-{stop - 1}/{total}"
+    headers["Content-Length"] = str(stop - start)
+    return Response(
+        stream_with_context(iter_segments(segments, start, stop, files=files)),
+        status=status,
+        headers=headers,
+    )
+
+
+def encoded_response(record, size):
+    """
+    Serve a file stored as compressed parts: as they are, with
+    Content-Encoding, to clients accepting the encoding, and decompressed on
+    the fly to the others. Neither answers byte ranges.
+    """
+    _, filename, path, checksum, encoding = record
+    etag = checksum or chunks_etag(path)
+    segments = file_segments(path)
+    headers = {
+        "Content-Disposition": f'attachment; filename="{filename}"',
+        "Vary": "Accept-Encoding",
+    }
+    # Both representations have the same content, so either tag revalidates.
+    tags = (etag, f"{etag}-{encoding}")
+    if any(request.if_none_match.contains_weak(tag) for tag in tags):
+        return Response(status=304, headers=dict(headers, ETag=f'"{etag}"'))
+    if request.accept_encodings[encoding]:
+        headers.update(
+            {
+                "Content-Encoding": encoding,
+                "Content-Length": str(sum(segment.length for segment in segments)),
+                "ETag": f'"{etag}-{encoding}"',
+            }
+        )
+        body = iter_segments(segments)
+    else:
+        headers.update({"Content-Length": str(size), "ETag": f'"{etag}"'})
+        body = iter_decoded(segments, encoding)
+    return Response(stream_with_context(body), headers=headers)
+
+
+def open_record(record):
+    """
+    Count an access to a `lookup_file` record and bring it back from the cold
+    tier if it was moved there, returning the record to serve.
+    """
+    record_access(record[0])
+    return promote(record) if record[4] == COLD_STORAGE else record
+
+
+def failover(filename):
+    """
+    Redirect to a replica holding `filename` when this node cannot serve it,
+    unless the request was itself redirected here.
+    """
+    if replicator.max_replicas < 2 or request.args.get("failover") == "0":
+        return None
+    for node in ring.nodes_for(filename, replicator.max_replicas):
+        if node == NODE_URL or not replicator.enabled:
+            continue
+        url = f"{node}get?filename={quote(filename)}&failover=0"
+        try:
+            if replicator.session.head(url, timeout=5).status_code == 200:
+                return redirect(url, 307)
+        except requests.RequestException:
+            continue
+    return None
+
+
 @app.route("/get", methods=["GET"])
 def get():
-    identifier, is_id = (
-        (request.args.get("id"), True)
-        if request.args.get("id")
-        else (request.args.get("filename"), False)
-    )
+    identifier, is_id = file_identifier()
     if not identifier:
         return jsonify({"message": "Missing file identifier"}), 400
-    path = get_path_sync(identifier, is_id)
+    record = lookup_file(identifier, is_id)
 
-    if not path:
+    # Packed files are looked up again when read, since compaction moves them.
+    shared = (CAS_STORAGE, PACK_STORAGE)
+    if record and record[4] not in shared and not os.path.exists(record[2]):
+        record = None  # Lost from disk; a replica may still have it.
+    if not record:
+        if not is_id and (response := failover(identifier)):
+            return response
+        # Not moved here yet or held by its owner: point the client there.
+        if not is_id and (response := misdirected(identifier)):
+            return response
         return jsonify({"message": "File not found"}), 404
 
+    _, filename, path, checksum, storage = record = open_record(record)
+    if storage == CAS_STORAGE:
+        segments = stored_segments(record)
+        # Same content, same validator; the manifest stands in for a missing checksum.
+        etag = (
+            checksum
+            or hashlib.sha256(
+                "".join(os.path.basename(segment.path) for segment in segments).encode()
+            ).hexdigest()
+        )
+        headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
+        return segments_response(segments, etag, headers)
+    if storage == PACK_STORAGE:
+        # A slice of a shared segment, read with positioned reads. It is opened
+        # before answering, so compaction removing it cannot cut the body short.
+        try:
+            segments, files = open_packed(record)
+        except FileNotFoundError:
+            return jsonify({"message": "File not found"}), 404
+        headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
+        response = segments_response(segments, checksum, headers, files=files)
+        # Also when the body is never read, e.g. for a 304 or a HEAD request.
+        response.call_on_close(lambda: close_files(files))
+        return response
+    if storage in ENCODINGS:
+        return encoded_response(record, get_metadata(filename)["size"])
     if os.path.isdir(path):
         folder_name = os.path.basename(path).split("_chunks")[0]
         headers = {
             "X-Chunked": "True",
             "Content-Disposition": f'attachment; filename="{folder_name}"',
         }
-        return Response(
-            stream_with_context(generate_file_stream(path)), headers=headers
+        etag = checksum or chunks_etag(path)
+        return segments_response(file_segments(path), etag, headers)
+    else:
+        # Relative paths would be resolved against the app root, not the cwd.
+        # The checksum is a strong validator, so clients can revalidate copies.
+        return send_file(
+            os.path.abspath(path), as_attachment=True, etag=checksum or True
         )
+
+
+def open_packed(record):
+    """
+    The segments of a packed file and their open files. A segment compaction
+    removed between reading the record and opening it has moved the file, so
+    it is looked up once more.
+    """
+    try:
+        segments = stored_segments(record)
+        return segments, open_segments(segments)
+    except FileNotFoundError:
+        segments = stored_segments(record)
+        return segments, open_segments(segments)
+
+
+def archive_entries(records):
+    """Archive members for `records`, leaving out files deleted meanwhile."""
+    for record in records:
+        try:
+            yield archive_entry(record)
+        except FileNotFoundError:
+            continue
+
+
+def archive_entry(record):
+    """Archive member for a `lookup_file` metadata record."""
+    _, filename, path, checksum, storage = record = open_record(record)
+    if storage == PACK_STORAGE:
+        segments, files = open_packed(record)
     else:
-        print("path", path)
-        return send_file(path, as_attachment=True)
+        segments, files = stored_segments(record), None
+    if storage in ENCODINGS:
+        size = get_metadata(filename)["size"]
+        content = iter_decoded(segments, storage)
+    else:
+        size = sum(segment.length for segment in segments)
+        content = iter_segments(segments, files=files)
+    return ArchiveEntry(
+        filename,
+        size,
+        # A shared segment's mtime says nothing about the file in it.
+        int(
+            time.time()
+            if storage in (CAS_STORAGE, PACK_STORAGE)
+            else os.path.getmtime(path)
+        ),
+        checksum,
+        content,
+    )
+
+
+@app.route("/files", methods=["GET"])
+def get_files():
+    """
+    Stream several files as one archive, built on the fly: a ZIP (stored,
+    ZIP64) by default or a tar with `format=tar`. Files are selected by any
+    number of `id` and `filename` parameters and/or a `category`.
+    """
+    auth_token = request.headers.get("Authorization")
+    if not check_auth(auth_token):
+        return jsonify({"message": "Unauthorized"}), 401
+
+    archive_format = request.args.get("format", "zip")
+    if archive_format not in ("zip", "tar"):
+        return jsonify({"message": "format must be zip or tar"}), 400
+
+    records = {}
+    missing = []
+    identifiers = [(file_id, True) for file_id in request.args.getlist("id")]
+    identifiers += [(name, False) for name in request.args.getlist("filename")]
+    for identifier, is_id in identifiers:
+        record = lookup_file(identifier, is_id)
+        if record:
+            records[record[0]] = record
+        else:
+            missing.append(identifier)
+    if missing:
+        return jsonify({"message": "Files not found", "missing": missing}), 404
+
+    category = request.args.get("category")
+    if category:
+        for row in iter_metadata(category=category):
+            records[row["id"]] = (
+                row["id"],
+                row["filename"],
+                row["path"],
+                row["checksum"],
+                row["storage"],
+            )
+    if not records:
+        return jsonify({"message": "No files selected"}), 400
+
+    entries = archive_entries(records.values())
+    generate = iter_tar if archive_format == "tar" else iter_zip
+    headers = {"Content-Disposition": f'attachment; filename="files.{archive_format}"'}
+    mimetype = "application/x-tar" if archive_format == "tar" else "application/zip"
+    return Response(generate(entries), mimetype=mimetype, headers=headers)
+
+
+def file_identifier():
+    """The (identifier, is_id) a request selects a file by."""
+    if request.args.get("id"):
+        return request.args.get("id"), True
+    return request.args.get("filename"), False
+
+
+@app.route("/manifest", methods=["GET"])
+def get_manifest():
+    """
+    The size and SHA-256 of a stored file and of each of its chunks, so a
+    download can be checked chunk by chunk as it arrives. `chunks` is empty
+    for files stored before chunks were hashed.
+    """
+    identifier, is_id = file_identifier()
+    if not identifier:
+        return jsonify({"message": "Missing file identifier"}), 400
+    record = lookup_file(identifier, is_id)
+    if not record:
+        return jsonify({"message": "File not found"}), 404
+    row = get_metadata(record[1])
+    chunks = []
+    offset = 0
+    for size, chunk_hash in chunk_checksums(record):
+        chunks.append({"offset": offset, "size": size, "sha256": chunk_hash})
+        offset += size
+    return jsonify(
+        {
+            "filename": record[1],
+            "size": row["size"],
+            "checksum": record[3],
+            "chunks": chunks,
+        }
+    )
+
+
+@app.route("/arrays", methods=["GET"])
+def get_arrays():
+    """
+    Names, dtypes and shapes of the arrays in a stored `.npz` or `.npy`,
+    read from the zip directory and array headers only.
+    """
+    identifier, is_id = file_identifier()
+    if not identifier:
+        return jsonify({"message": "Missing file identifier"}), 400
+    record = lookup_file(identifier, is_id)
+    if not record:
+        return jsonify({"message": "File not found"}), 404
+    record = open_record(record)
+    if record[4] in ENCODINGS:
+        return jsonify({"message": "Arrays cannot be read from compressed files"}), 400
+    try:
+        arrays = list_arrays(stored_segments(record), record[1])
+    except FileNotFoundError:
+        return jsonify({"message": "File not found"}), 404
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+    return jsonify({"filename": record[1], "arrays": list(map(describe, arrays))})
+
+
+@app.route("/array", methods=["GET"])
+def get_array():
+    """
+    Serve one array of a stored `.npz` or `.npy`, or the rows [`start`,
+    `stop`) of it, as a `.npy` file. Only the bytes of those rows are read;
+    uncompressed members are memory-mapped. `name` may be left out for a
+    `.npy` file.
+    """
+    identifier, is_id = file_identifier()
+    if not identifier:
+        return jsonify({"message": "Missing file identifier"}), 400
+    record = lookup_file(identifier, is_id)
+    if not record:
+        return jsonify({"message": "File not found"}), 404
+    record = open_record(record)
+    if record[4] in ENCODINGS:
+        return jsonify({"message": "Arrays cannot be read from compressed files"}), 400
+    try:
+        segments = stored_segments(record)
+        arrays = list_arrays(segments, record[1])
+    except FileNotFoundError:
+        return jsonify({"message": "File not found"}), 404
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+
+    name = request.args.get("name")
+    matches = [info for info in arrays if name is None or info.name == name]
+    if len(matches) != 1:
+        message = f"No array named {name}" if name else "Missing array name"
+        return jsonify({"message": message}), 404 if name else 400
+    try:
+        pieces = iter_array(
+            segments,
+            matches[0],
+            request.args.get("start", type=int),
+            request.args.get("stop", type=int),
+        )
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+    headers = {"Content-Disposition": f'attachment; filename="{matches[0].name}.npy"'}
+    return Response(
+        stream_with_context(pieces),
+        mimetype="application/octet-stream",
+        headers=headers,
+    )
+
+
+@app.route("/sync/digest", methods=["GET"])
+def sync_digest():
+    """
+    Anti-entropy: SHA-256 per bucket of the (filename, checksum) pairs of the
+    files both this node and `peer` replicate.
+    """
+    auth_token = request.headers.get("Authorization")
+    if not check_auth(auth_token):
+        return jsonify({"message": "Unauthorized"}), 401
+    peer = request.args.get("peer")
+    if not peer:
+        return jsonify({"message": "Missing peer"}), 400
+    return jsonify({"buckets": replicator.digest(peer)})
+
+
+@app.route("/sync/files", methods=["GET"])
+def sync_files():
+    """Anti-entropy: checksum and upload time of the shared files in one bucket."""
+    auth_token = request.headers.get("Authorization")
+    if not check_auth(auth_token):
+        return jsonify({"message": "Unauthorized"}), 401
+    peer = request.args.get("peer")
+    bucket = request.args.get("bucket", type=int)
+    if not peer or bucket is None:
+        return jsonify({"message": "Missing peer or bucket"}), 400
+    return jsonify({"files": replicator.shared_files(peer, bucket)})
+
+
+@app.route("/sync", methods=["POST"])
+def sync():
+    """Run an anti-entropy pass against every peer now."""
+    auth_token = request.headers.get("Authorization")
+    if not check_auth(auth_token):
+        return jsonify({"message": "Unauthorized"}), 401
+    return jsonify({"pushed": replicator.anti_entropy()})
 
 
 @app.route("/delete", methods=["DELETE"])
@@ -197,24 +1480,45 @@ def delete_file_and_or_metadata():
     if not metadata_id and not filename:
         return jsonify({"message": "Missing metadata ID or filename"}), 400
 
+    # A delete passed on by a peer carries the time of the original delete.
+    # A copy moved to another node is not a delete and leaves no tombstone.
+    replica_deleted_at = request.headers.get(REPLICA_HEADER)
+    moved = request.args.get("moved") == "1"
+    deleted_at = replica_deleted_at if replica_deleted_at and not moved else now()
+    category = request.args.get("category", "default")
     message_details = []
 
-    with sqlite3.connect(DB_NAME) as conn:
+    with connection() as conn:
         cursor = conn.cursor()
 
         if metadata_id:
-            query = "SELECT filename, path FROM metadata WHERE id = ?"
+            query = (
+                "SELECT id, filename, path, storage, category, upload_timestamp"
+                " FROM metadata WHERE id = ?"
+            )
             params = (metadata_id,)
         elif filename:
-            query = "SELECT filename, path FROM metadata WHERE filename = ?"
+            query = (
+                "SELECT id, filename, path, storage, category, upload_timestamp"
+                " FROM metadata WHERE filename = ?"
+            )
             params = (filename,)
 
         cursor.execute(query, params)
         record = cursor.fetchone()
 
+        if record and replica_deleted_at and (record[5] or "") > deleted_at:
+            return jsonify({"message": "A newer version is stored"}), 409
         if record:
-            filename, path = record
-            if os.path.isdir(path):
+            metadata_id, filename, path, storage, category, _ = record
+            replace_chunk_checksums(conn, filename, None)
+            if storage == CAS_STORAGE:
+                release_manifest(conn, filename)
+                message_details.append(f"Chunks of '{filename}' released.")
+            elif storage == PACK_STORAGE:
+                # Other files share the segment; compaction reclaims the space.
+                message_details.append(f"File '{filename}' deleted successfully.")
+            elif os.path.isdir(path):
                 shutil.rmtree(path)
                 message_details.append(
                     f"Directory for '{filename}' deleted successfully."
@@ -236,6 +1540,16 @@ def delete_file_and_or_metadata():
             ).rowcount
             if deleted_rows > 0:
                 message_details.append("Metadata deleted.")
+        if filename and (record or replica_deleted_at) and not moved:
+            record_tombstone(conn, filename, category, deleted_at)
+
+    if filename:
+        invalidate_file(filename, metadata_id)
+    elif metadata_id:
+        file_cache.pop(("id", metadata_id))
+    collect_chunks()
+    if record and not replica_deleted_at:
+        replicator.replicate_delete(filename, category, deleted_at)
 
     return jsonify(
         {
@@ -247,4 +1561,4 @@ def delete_file_and_or_metadata():
 
 
 if __name__ == "__main__":
-    app.run(debug=True, port=5002, host="0.0.0.0")
+    create_app().run(debug=True, port=5002, host="0.0.0.0")
@@ -0,0 +1,859 @@
+import atexit
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import dotenv
+
+from tinydist.cache import MISSING, LRUCache
+from tinydist.compression import ENCODINGS
+from tinydist.metrics import observe
+from tinydist.utils import Segment, cold_path, file_segments, object_path
+
+dotenv.load_dotenv()
+
+DB_NAME = os.getenv("DATABASE_NAME", "metadata.db")
+POOL_SIZE = 16
+CACHE_CAPACITY = int(os.getenv("CACHE_CAPACITY", "4096"))
+CACHE_TTL = float(os.getenv("CACHE_TTL", "300"))
+# Seconds a chunk stored for a deduplicated upload is kept before it is
+# committed, so a commit still on its way does not find it collected.
+CHUNK_GRACE = float(os.getenv("CAS_CHUNK_GRACE", "3600"))
+
+# Each entry upgrades the schema by one version (tracked in PRAGMA user_version).
+# Never edit an applied migration; append a new one instead.
+MIGRATIONS = [
+    (
+        """CREATE TABLE IF NOT EXISTS metadata (
+                            id INTEGER PRIMARY KEY AUTOINCREMENT,
+                            filename TEXT UNIQUE,
+                            path TEXT,
+                            checksum TEXT,
+                            upload_timestamp DATETIME,
+                            last_accessed DATETIME,
+                            access_count INTEGER DEFAULT 0,
+                            category TEXT)""",
+        """CREATE TABLE IF NOT EXISTS upload_sessions (
+                        id TEXT PRIMARY KEY,
+                        filename TEXT,
+                        category TEXT,
+                        file_size INTEGER,
+                        chunk_size INTEGER,
+                        total_chunks INTEGER,
+                        created_timestamp DATETIME)""",
+        """CREATE TABLE IF NOT EXISTS upload_chunks (
+                        session_id TEXT,
+                        chunk_index INTEGER,
+                        size INTEGER,
+                        PRIMARY KEY (session_id, chunk_index))""",
+    ),
+    (
+        """CREATE INDEX IF NOT EXISTS metadata_upload_timestamp
+            ON metadata (upload_timestamp)""",
+        """CREATE INDEX IF NOT EXISTS metadata_category
+            ON metadata (category, upload_timestamp)""",
+        """CREATE INDEX IF NOT EXISTS upload_sessions_filename
+            ON upload_sessions (filename)""",
+    ),
+    ("ALTER TABLE metadata ADD COLUMN size INTEGER",),
+    (
+        "ALTER TABLE metadata ADD COLUMN storage TEXT",
+        """CREATE TABLE IF NOT EXISTS chunks (
+                        hash TEXT PRIMARY KEY,
+                        size INTEGER,
+                        refcount INTEGER NOT NULL DEFAULT 0)""",
+        """CREATE TABLE IF NOT EXISTS manifests (
+                        filename TEXT,
+                        seq INTEGER,
+                        hash TEXT,
+                        PRIMARY KEY (filename, seq))""",
+        """CREATE INDEX IF NOT EXISTS chunks_unreferenced
+            ON chunks (refcount) WHERE refcount <= 0""",
+    ),
+    (
+        "ALTER TABLE upload_chunks ADD COLUMN hash TEXT",
+        """CREATE TABLE IF NOT EXISTS chunk_checksums (
+                        filename TEXT,
+                        seq INTEGER,
+                        size INTEGER,
+                        hash TEXT,
+                        PRIMARY KEY (filename, seq))""",
+    ),
+    (
+        "ALTER TABLE metadata ADD COLUMN verified_at DATETIME",
+        "ALTER TABLE metadata ADD COLUMN verify_result TEXT",
+    ),
+    ("ALTER TABLE upload_sessions ADD COLUMN encoding TEXT",),
+    (
+        "ALTER TABLE metadata ADD COLUMN pack_offset INTEGER",
+        """CREATE INDEX IF NOT EXISTS metadata_packed
+            ON metadata (path) WHERE storage = 'pack'""",
+    ),
+    ("ALTER TABLE chunks ADD COLUMN stored_at DATETIME",),
+    (
+        """CREATE TABLE IF NOT EXISTS tombstones (
+                        filename TEXT PRIMARY KEY,
+                        category TEXT,
+                        deleted_at DATETIME)""",
+    ),
+]
+
+# metadata.storage of files kept as a manifest of shared, content-addressed
+# chunks. Other files are a plain file or a `_chunks` directory at `path`.
+CAS_STORAGE = "cas"
+# metadata.storage of files moved off the hot volume; `path` is then their
+# compressed copy under the cold directory.
+COLD_STORAGE = "cold"
+# A `_chunks` directory whose parts are each compressed on their own has the
+# encoding ("gzip" or "zstd", see tinydist.compression) as metadata.storage.
+# metadata.storage of small files appended to a pack segment (see
+# tinydist.packs); `path` is the segment and the file is the `size` bytes
+# from `pack_offset`.
+PACK_STORAGE = "pack"
+
+# Files tiering can move off the hot volume: those with data of their own,
+# a plain file or a `_chunks` directory, compressed or not.
+TIERABLE = f"storage IS NULL OR storage IN ({', '.join('?' * len(ENCODINGS))})"
+
+METADATA_COLUMNS = (
+    "id",
+    "filename",
+    "path",
+    "checksum",
+    "upload_timestamp",
+    "last_accessed",
+    "access_count",
+    "category",
+    "size",
+    "storage",
+    "verified_at",
+    "verify_result",
+    "pack_offset",
+)
+
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16384",
+    "PRAGMA mmap_size = 268435456",
+)
+
+GET_FILE_BY_ID = (
+    "SELECT id, filename, path, checksum, storage FROM metadata WHERE id = ?"
+)
+GET_FILE_BY_FILENAME = (
+    "SELECT id, filename, path, checksum, storage FROM metadata WHERE filename = ?"
+)
+UPSERT_METADATA = """INSERT INTO metadata \
+                (filename, path, upload_timestamp, category, checksum, size, storage,
+                pack_offset)
+                              VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                              ON CONFLICT(filename) DO UPDATE SET
+                              path=excluded.path,
+                              upload_timestamp=excluded.upload_timestamp,
+                              category=excluded.category,
+                              checksum=excluded.checksum,
+                              size=excluded.size,
+                              storage=excluded.storage,
+                              pack_offset=excluded.pack_offset,
+                              verified_at=NULL,
+                              verify_result=NULL"""
+
+_pool = queue.LifoQueue(maxsize=POOL_SIZE)
+
+# Rows of hot files, keyed by ("id", id) and ("filename", filename).
+file_cache = LRUCache(CACHE_CAPACITY, CACHE_TTL)
+
+# Accesses not yet written to the metadata table: {id: [count, last_accessed]}.
+_accesses = {}
+_accesses_lock = threading.Lock()
+
+
+def statement_type(sql):
+    """`select`, `insert`, ... for the metrics of a statement."""
+    return sql.lstrip().split(None, 1)[0].lower()
+
+
+class TimedCursor(sqlite3.Cursor):
+    """
+    Cursor recording how long each statement takes to execute. Rows a SELECT
+    yields after the first are stepped lazily and are not included.
+    """
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._observe(sql, started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._observe(sql, started)
+
+    def _observe(self, sql, started):
+        observe(
+            "tinydist_sqlite_query_seconds",
+            time.perf_counter() - started,
+            (("statement", statement_type(sql)),),
+        )
+
+
+class TimedConnection(sqlite3.Connection):
+    """Connection whose statements all run on a `TimedCursor`."""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    # The C implementations create their cursor without calling cursor().
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def connect(db_name=DB_NAME):
+    """
+    Open a tuned connection. Writes take the lock when their transaction
+    starts, so concurrent writers wait on busy_timeout instead of failing to
+    upgrade a read lock.
+    """
+    conn = sqlite3.connect(
+        db_name,
+        isolation_level="IMMEDIATE",
+        check_same_thread=False,
+        cached_statements=256,
+        factory=TimedConnection,
+    )
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+@contextmanager
+def connection():
+    """
+    Borrow a pooled connection for one unit of work, committing on success
+    and rolling back on error.
+    """
+    try:
+        conn = _pool.get_nowait()
+    except queue.Empty:
+        conn = connect()
+    try:
+        with conn:
+            yield conn
+    finally:
+        try:
+            _pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+
+def init_db():
+    """Create or upgrade the schema. Safe to call from several processes."""
+    with connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for migration in MIGRATIONS[version:]:
+            for statement in migration:
+                conn.execute(statement)
+        conn.execute(f"PRAGMA user_version = {len(MIGRATIONS)}")
+
+
+def now():
+    """Timestamp in the format stored in DATETIME columns."""
+    return datetime.now().isoformat(" ")
+
+
+def lookup_file(identifier, is_id):
+    """
+    (id, filename, path, checksum, storage) of the file with the given id or
+    filename, or None, served from `file_cache` when possible.
+    """
+    if is_id:
+        try:
+            key = ("id", int(identifier))
+        except (TypeError, ValueError):
+            return None
+    else:
+        key = ("filename", identifier)
+    record = file_cache.get(key)
+    if record is not MISSING:
+        return record
+    generation = file_cache.generation
+    with connection() as conn:
+        record = conn.execute(
+            GET_FILE_BY_ID if is_id else GET_FILE_BY_FILENAME, (key[1],)
+        ).fetchone()
+    if record:
+        file_cache.put(("id", record[0]), record, generation)
+        file_cache.put(("filename", record[1]), record, generation)
+    return record
+
+
+def invalidate_file(filename, file_id=None):
+    """Drop cached rows for a file after its metadata changed or was deleted."""
+    record = file_cache.pop(("filename", filename))
+    if record:
+        file_cache.pop(("id", record[0]))
+    if file_id is not None:
+        file_cache.pop(("id", int(file_id)))
+    elif not record:
+        with connection() as conn:
+            row = conn.execute(
+                "SELECT id FROM metadata WHERE filename = ?", (filename,)
+            ).fetchone()
+        if row:
+            file_cache.pop(("id", row[0]))
+
+
+def get_path(identifier, is_id):
+    """Path of the file with the given id or filename, or None."""
+    record = lookup_file(identifier, is_id)
+    return record[2] if record else None
+
+
+def get_checksum(filename):
+    """
+    Stored checksum for `filename` as a one-element tuple (the checksum may be
+    None), or None when there is no such file.
+    """
+    record = lookup_file(filename, False)
+    return (record[3],) if record else None
+
+
+def upsert_metadata(
+    filename,
+    path,
+    category,
+    checksum=None,
+    size=None,
+    timestamp=None,
+    chunks=None,
+    storage=None,
+    pack_offset=None,
+):
+    """
+    Insert file metadata, replacing any previous upload of the same name.
+    Replicas pass the `timestamp` of the original upload. `chunks` lists the
+    (size, sha256) of each consecutive chunk of the file. Packed files pass
+    their segment as `path` and where they start in it as `pack_offset`.
+    """
+    with connection() as conn:
+        release_manifest(conn, filename)
+        replace_chunk_checksums(conn, filename, chunks)
+        conn.execute(
+            UPSERT_METADATA,
+            (
+                filename,
+                path,
+                timestamp or now(),
+                category,
+                checksum,
+                size,
+                storage,
+                pack_offset,
+            ),
+        )
+    invalidate_file(filename)
+    discard_cold_copies([filename])
+
+
+def get_metadata(filename):
+    """The metadata row of `filename` as a dict, or None."""
+    with connection() as conn:
+        row = conn.execute(
+            f"SELECT {', '.join(METADATA_COLUMNS)} FROM metadata WHERE filename = ?",
+            (filename,),
+        ).fetchone()
+    return dict(zip(METADATA_COLUMNS, row)) if row else None
+
+
+def upsert_metadata_many(records):
+    """
+    Insert many (filename, path, category, checksum, size, chunks, storage,
+    pack_offset) records in a single transaction.
+    """
+    timestamp = now()
+    with connection() as conn:
+        for record in records:
+            release_manifest(conn, record[0])
+            replace_chunk_checksums(conn, record[0], record[5])
+        conn.executemany(
+            UPSERT_METADATA,
+            [
+                (filename, path, timestamp, category, checksum, size, storage, offset)
+                for filename, path, category, checksum, size, _, storage, offset in (
+                    records
+                )
+            ],
+        )
+    for record in records:
+        invalidate_file(record[0])
+    discard_cold_copies([record[0] for record in records])
+
+
+def iter_metadata(
+    category=None,
+    prefix=None,
+    since=None,
+    until=None,
+    min_size=None,
+    max_size=None,
+    after=None,
+    limit=None,
+    batch_size=500,
+):
+    """
+    Yield metadata rows as dicts, newest first, as SQLite produces them.
+
+    Pages are keyset based: `after` is the (upload_timestamp, id) of the last
+    row already seen, so each page is an index range scan rather than an
+    OFFSET that re-reads every earlier row.
+    """
+    query = f"SELECT {', '.join(METADATA_COLUMNS)} FROM metadata"
+    conditions = []
+    params = []
+    if category:
+        conditions.append("category = ?")
+        params.append(category)
+    if prefix:
+        # A range on the unique filename index, unlike LIKE which ignores case.
+        conditions.append("filename >= ? AND filename < ?")
+        params.extend((prefix, prefix + chr(0x10FFFF)))
+    if since:
+        conditions.append("upload_timestamp >= ?")
+        params.append(since)
+    if until:
+        conditions.append("upload_timestamp < ?")
+        params.append(until)
+    if min_size is not None:
+        conditions.append("size >= ?")
+        params.append(min_size)
+    if max_size is not None:
+        conditions.append("size <= ?")
+        params.append(max_size)
+    if after:
+        conditions.append("(upload_timestamp, id) < (?, ?)")
+        params.extend(after)
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY upload_timestamp DESC, id DESC"
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(limit)
+
+    with connection() as conn:
+        cursor = conn.execute(query, params)
+        while rows := cursor.fetchmany(batch_size):
+            for row in rows:
+                yield dict(zip(METADATA_COLUMNS, row))
+
+
+def record_tombstone(conn, filename, category, deleted_at):
+    """
+    Remember that `filename` was deleted at `deleted_at`, so anti-entropy
+    deletes the copies replicas still hold instead of restoring them.
+    """
+    conn.execute(
+        """INSERT INTO tombstones (filename, category, deleted_at) VALUES (?, ?, ?)
+        ON CONFLICT(filename) DO UPDATE SET
+        category = excluded.category,
+        deleted_at = max(deleted_at, excluded.deleted_at)""",
+        (filename, category, deleted_at),
+    )
+
+
+def get_tombstone(filename):
+    """The (category, deleted_at) of the last delete of `filename`, or None."""
+    with connection() as conn:
+        return conn.execute(
+            "SELECT category, deleted_at FROM tombstones WHERE filename = ?",
+            (filename,),
+        ).fetchone()
+
+
+def iter_tombstones():
+    """Yield the (filename, category, deleted_at) of every deleted file."""
+    with connection() as conn:
+        yield from conn.execute(
+            "SELECT filename, category, deleted_at FROM tombstones"
+        ).fetchall()
+
+
+def missing_chunk_hashes(hashes):
+    """The distinct `hashes` with no stored chunk, in first-seen order."""
+    wanted = list(dict.fromkeys(hashes))
+    present = set()
+    with connection() as conn:
+        for start in range(0, len(wanted), 500):
+            batch = wanted[start : start + 500]
+            placeholders = ", ".join("?" * len(batch))
+            present.update(
+                row[0]
+                for row in conn.execute(
+                    f"SELECT hash FROM chunks WHERE hash IN ({placeholders})", batch
+                )
+            )
+    return [chunk_hash for chunk_hash in wanted if chunk_hash not in present]
+
+
+def add_chunk(chunk_hash, size):
+    """
+    Record a stored chunk. It is unreferenced until a manifest uses it, and
+    kept for CHUNK_GRACE seconds meanwhile.
+    """
+    with connection() as conn:
+        conn.execute(
+            "INSERT INTO chunks (hash, size, stored_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(hash) DO UPDATE SET stored_at = excluded.stored_at",
+            (chunk_hash, size, now()),
+        )
+
+
+def release_manifest(conn, filename):
+    """
+    Drop the manifest of `filename`, if any, releasing one reference per chunk
+    occurrence. Runs inside the caller's transaction.
+    """
+    hashes = conn.execute(
+        "SELECT hash FROM manifests WHERE filename = ?", (filename,)
+    ).fetchall()
+    if hashes:
+        conn.executemany(
+            "UPDATE chunks SET refcount = refcount - 1 WHERE hash = ?", hashes
+        )
+        conn.execute("DELETE FROM manifests WHERE filename = ?", (filename,))
+
+
+def replace_chunk_checksums(conn, filename, chunks):
+    """
+    Record the (size, sha256) of each chunk of `filename`, dropping those of
+    a previous upload. Runs inside the caller's transaction.
+    """
+    conn.execute("DELETE FROM chunk_checksums WHERE filename = ?", (filename,))
+    if chunks:
+        conn.executemany(
+            "INSERT INTO chunk_checksums (filename, seq, size, hash) VALUES (?, ?, ?, ?)",
+            [
+                (filename, seq, size, chunk_hash)
+                for seq, (size, chunk_hash) in enumerate(chunks)
+            ],
+        )
+
+
+def chunk_checksums(record):
+    """
+    (size, sha256) of each chunk of a `lookup_file` record, in order, or an
+    empty list for files stored before chunks were hashed.
+    """
+    filename, storage = record[1], record[4]
+    if storage == CAS_STORAGE:
+        return [(size, chunk_hash) for chunk_hash, size in manifest_chunks(filename)]
+    with connection() as conn:
+        return conn.execute(
+            "SELECT size, hash FROM chunk_checksums WHERE filename = ? ORDER BY seq",
+            (filename,),
+        ).fetchall()
+
+
+def commit_manifest(filename, category, checksum, hashes):
+    """
+    Publish `filename` as the chunks `hashes`, in order, replacing any previous
+    version. Returns (missing, previous): the hashes that are not stored, in
+    which case nothing changed, and the (path, storage) it replaced, if any.
+    """
+    with connection() as conn:
+        # Checked in the same write transaction that takes the references, so
+        # the chunks cannot be collected in between.
+        conn.execute("BEGIN IMMEDIATE")
+        missing = [
+            chunk_hash
+            for chunk_hash in dict.fromkeys(hashes)
+            if not conn.execute(
+                "SELECT 1 FROM chunks WHERE hash = ?", (chunk_hash,)
+            ).fetchone()
+        ]
+        if missing:
+            return missing, None
+        previous = conn.execute(
+            "SELECT path, storage FROM metadata WHERE filename = ?", (filename,)
+        ).fetchone()
+        release_manifest(conn, filename)
+        replace_chunk_checksums(conn, filename, None)
+        conn.executemany(
+            "INSERT INTO manifests (filename, seq, hash) VALUES (?, ?, ?)",
+            [(filename, seq, chunk_hash) for seq, chunk_hash in enumerate(hashes)],
+        )
+        conn.executemany(
+            "UPDATE chunks SET refcount = refcount + 1, stored_at = NULL "
+            "WHERE hash = ?",
+            [(chunk_hash,) for chunk_hash in hashes],
+        )
+        size = conn.execute(
+            """SELECT COALESCE(SUM(chunks.size), 0) FROM manifests
+            JOIN chunks ON chunks.hash = manifests.hash
+            WHERE manifests.filename = ?""",
+            (filename,),
+        ).fetchone()[0]
+        conn.execute(
+            UPSERT_METADATA,
+            (filename, "", now(), category, checksum, size, CAS_STORAGE, None),
+        )
+    invalidate_file(filename)
+    discard_cold_copies([filename])
+    return [], previous
+
+
+def manifest_chunks(filename):
+    """(hash, size) of each chunk of a content-addressed file, in order."""
+    with connection() as conn:
+        return conn.execute(
+            """SELECT chunks.hash, chunks.size FROM manifests
+            JOIN chunks ON chunks.hash = manifests.hash
+            WHERE manifests.filename = ? ORDER BY manifests.seq""",
+            (filename,),
+        ).fetchall()
+
+
+def remove_unreferenced_chunks(grace=CHUNK_GRACE):
+    """
+    Forget the chunks no manifest uses any more and return their hashes.
+    Chunks stored within `grace` seconds and never committed since are kept.
+    """
+    stored_before = (datetime.now() - timedelta(seconds=grace)).isoformat(" ")
+    with connection() as conn:
+        # No commit can take a reference between the SELECT and the DELETE.
+        conn.execute("BEGIN IMMEDIATE")
+        hashes = [
+            row[0]
+            for row in conn.execute(
+                """SELECT hash FROM chunks WHERE refcount <= 0
+                AND (stored_at IS NULL OR stored_at < ?)""",
+                (stored_before,),
+            )
+        ]
+        conn.executemany("DELETE FROM chunks WHERE hash = ?", [(h,) for h in hashes])
+    return hashes
+
+
+def stored_segments(record):
+    """The segments holding the file of a `lookup_file` record, in order."""
+    file_id, filename, path, checksum, storage = record
+    if storage == CAS_STORAGE:
+        return [
+            Segment(object_path(chunk_hash), 0, size)
+            for chunk_hash, size in manifest_chunks(filename)
+        ]
+    if storage == PACK_STORAGE:
+        # Read again by id, so a file compaction moved since the record was
+        # read is found in its new segment.
+        with connection() as conn:
+            row = conn.execute(
+                f"""SELECT path, pack_offset, size FROM metadata
+                WHERE id = ? AND storage = '{PACK_STORAGE}' AND checksum IS ?""",
+                (file_id, checksum),
+            ).fetchone()
+        if row is None:
+            raise FileNotFoundError(f"{filename} was deleted or replaced")
+        return [Segment(*row)]
+    return file_segments(path)
+
+
+def discard_cold_copies(filenames):
+    """Remove compressed copies left behind by files that were uploaded again."""
+    for filename in filenames:
+        try:
+            os.remove(cold_path(filename))
+        except FileNotFoundError:
+            pass
+
+
+def record_access(file_id):
+    """
+    Count a download of the file with id `file_id`. Only an in-memory buffer
+    is touched; `flush_accesses` writes the totals in one batch later, so
+    serving a file never waits for the database write lock.
+    """
+    timestamp = now()
+    with _accesses_lock:
+        entry = _accesses.setdefault(file_id, [0, timestamp])
+        entry[0] += 1
+        entry[1] = timestamp
+
+
+def flush_accesses():
+    """Write buffered access counts and times to the metadata table."""
+    global _accesses
+    with _accesses_lock:
+        pending, _accesses = _accesses, {}
+    if pending:
+        with connection() as conn:
+            conn.executemany(
+                """UPDATE metadata SET access_count = access_count + ?,
+                last_accessed = MAX(COALESCE(last_accessed, ''), ?)
+                WHERE id = ?""",
+                [(count, last, file_id) for file_id, (count, last) in pending.items()],
+            )
+    return len(pending)
+
+
+def start_access_flusher(interval):
+    """Flush buffered accesses every `interval` seconds and at exit."""
+    atexit.register(flush_accesses)
+
+    def loop():
+        while not stop.wait(interval):
+            flush_accesses()
+
+    stop = threading.Event()
+    threading.Thread(target=loop, name="access-flusher", daemon=True).start()
+    return stop
+
+
+def hot_usage():
+    """
+    Bytes of the files on the hot volume that tiering can move off, the same
+    ones `tiering_candidates` lists, counted uncompressed. Packed files and
+    content-addressed chunks share their data with other files and are left
+    out.
+    """
+    with connection() as conn:
+        return conn.execute(
+            f"SELECT COALESCE(SUM(size), 0) FROM metadata WHERE {TIERABLE}",
+            ENCODINGS,
+        ).fetchone()[0]
+
+
+def cold_usage():
+    """(file count, bytes) of the files moved to the cold tier, uncompressed."""
+    with connection() as conn:
+        return conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM metadata WHERE storage = ?",
+            (COLD_STORAGE,),
+        ).fetchone()
+
+
+def tiering_candidates():
+    """Metadata rows of the files on the hot volume that could be moved off."""
+    columns = ", ".join(METADATA_COLUMNS)
+    with connection() as conn:
+        rows = conn.execute(
+            f"SELECT {columns} FROM metadata WHERE {TIERABLE}", ENCODINGS
+        ).fetchall()
+    return [dict(zip(METADATA_COLUMNS, row)) for row in rows]
+
+
+def move_storage(
+    filename, old_path, new_path, storage, checksum, upload_timestamp=None
+):
+    """
+    Point `filename` at `new_path` with the given storage, unless it was
+    uploaded again since it was read: it no longer lives at `old_path`, or
+    has another `checksum` or `upload_timestamp` (when given). A new upload
+    of a plain file reuses its path, so the path alone does not tell.
+    Returns whether it moved.
+    """
+    with connection() as conn:
+        moved = conn.execute(
+            """UPDATE metadata SET path = ?, storage = ?
+            WHERE filename = ? AND path = ? AND checksum IS ?
+            AND (? IS NULL OR upload_timestamp = ?)""",
+            (
+                new_path,
+                storage,
+                filename,
+                old_path,
+                checksum,
+                upload_timestamp,
+                upload_timestamp,
+            ),
+        ).rowcount
+    invalidate_file(filename)
+    return bool(moved)
+
+
+def scrub_candidates(verified_before=None, batch_size=500):
+    """
+    Yield the id, filename, path, checksum and storage of the files with a
+    checksum to verify: all of them, or those not verified since
+    `verified_before`. Reads in short batches so uploads are not held up.
+    """
+    query = """SELECT id, filename, path, checksum, storage FROM metadata
+        WHERE id > ? AND checksum IS NOT NULL"""
+    params = []
+    if verified_before:
+        query += " AND (verified_at IS NULL OR verified_at < ?)"
+        params.append(verified_before)
+    query += " ORDER BY id LIMIT ?"
+    last_id = 0
+    while True:
+        with connection() as conn:
+            rows = conn.execute(query, [last_id, *params, batch_size]).fetchall()
+        yield from rows
+        if len(rows) < batch_size:
+            return
+        last_id = rows[-1][0]
+
+
+def record_verification(file_id, path, checksum, result):
+    """
+    Store when and with what `result` a file was verified, unless it was
+    replaced since it was read. Returns whether it was recorded.
+    """
+    with connection() as conn:
+        return bool(
+            conn.execute(
+                """UPDATE metadata SET verified_at = ?, verify_result = ?
+                WHERE id = ? AND path = ? AND checksum = ?""",
+                (now(), result, file_id, path, checksum),
+            ).rowcount
+        )
+
+
+def packed_usage():
+    """{segment path: bytes of the files still in it} for every pack segment."""
+    with connection() as conn:
+        return dict(
+            conn.execute(
+                f"""SELECT path, COALESCE(SUM(size), 0) FROM metadata
+                WHERE storage = '{PACK_STORAGE}' GROUP BY path"""
+            ).fetchall()
+        )
+
+
+def packed_files(segment):
+    """(id, filename, pack_offset, size) of the files in a pack segment."""
+    with connection() as conn:
+        return conn.execute(
+            # The literal storage lets SQLite use the partial index.
+            f"""SELECT id, filename, pack_offset, size FROM metadata
+            WHERE storage = '{PACK_STORAGE}' AND path = ? ORDER BY pack_offset""",
+            (segment,),
+        ).fetchall()
+
+
+def move_packed(file_id, filename, old_path, old_offset, new_path, new_offset):
+    """
+    Point a packed file at its copy in another segment, unless it was
+    replaced or deleted meanwhile. Returns whether it moved.
+    """
+    with connection() as conn:
+        moved = conn.execute(
+            """UPDATE metadata SET path = ?, pack_offset = ?
+            WHERE id = ? AND storage = ? AND path = ? AND pack_offset = ?""",
+            (new_path, new_offset, file_id, PACK_STORAGE, old_path, old_offset),
+        ).rowcount
+    invalidate_file(filename, file_id)
+    return bool(moved)
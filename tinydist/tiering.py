@@ -0,0 +1,227 @@
+import gzip
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+import dotenv
+
+from tinydist.compression import ENCODINGS, iter_decoded
+from tinydist.store import (
+    COLD_STORAGE,
+    flush_accesses,
+    hot_usage,
+    lookup_file,
+    move_storage,
+    stored_segments,
+    tiering_candidates,
+)
+from tinydist.utils import CHUNK_SIZE, cold_path, file_directory, iter_segments
+
+dotenv.load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+# Hot volume quota; 0 leaves it unbounded.
+DISK_QUOTA = int(float(os.getenv("DISK_QUOTA_MB", "0")) * MB)
+# Once over quota, files are moved off until usage is back under this share.
+LOW_WATERMARK = float(os.getenv("TIERING_LOW_WATERMARK", "0.9"))
+EVICTION_POLICIES = ("lru", "lfu")
+
+
+def parse_policies(overrides):
+    """Eviction policy per category from a `category=lru|lfu,...` list."""
+    policies = {}
+    for item in filter(str.strip, overrides.split(",")):
+        category, policy = (part.strip() for part in item.split("="))
+        if policy not in EVICTION_POLICIES:
+            raise ValueError(f"Unknown eviction policy {policy} for {category}")
+        policies[category] = policy
+    return policies
+
+
+EVICTION_POLICY = os.getenv("EVICTION_POLICY", "lru")
+CATEGORY_POLICIES = parse_policies(os.getenv("CATEGORY_EVICTION_POLICY", ""))
+
+
+def coldness_key(row, policy):
+    """Sort key putting a category's coldest files first under `policy`."""
+    last_used = row["last_accessed"] or row["upload_timestamp"] or ""
+    if policy == "lfu":
+        return (row["access_count"] or 0, last_used)
+    return (last_used,)
+
+
+def eviction_order(rows, policy=EVICTION_POLICY, category_policies=CATEGORY_POLICIES):
+    """
+    `rows` coldest first. Each category is ranked by its own policy, and the
+    ranks are compared as fractions of the category, so an LRU and an LFU
+    category give up their coldest files at the same pace.
+    """
+    by_category = {}
+    for row in rows:
+        by_category.setdefault(row["category"], []).append(row)
+    ranked = []
+    for category, members in by_category.items():
+        category_policy = category_policies.get(category, policy)
+        members.sort(key=lambda row: coldness_key(row, category_policy))
+        ranked.extend(
+            (index / len(members), -(row["size"] or 0), row)
+            for index, row in enumerate(members)
+        )
+    ranked.sort(key=lambda item: item[:2])
+    return [row for _, _, row in ranked]
+
+
+def write_atomically(path, write):
+    """Call `write` with a temporary file next to `path`, then move it in place."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path) or ".", prefix=".tier-", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def demote(row):
+    """
+    Move a plain file or chunk directory to the cold tier as a gzip copy of
+    its content. Returns whether it moved; files replaced meanwhile stay.
+    """
+    path = row["path"]
+    if not path or not os.path.exists(path):
+        return False
+    target = cold_path(row["filename"])
+    record = (row["id"], row["filename"], path, row["checksum"], row["storage"])
+
+    def compress(f):
+        with gzip.GzipFile(fileobj=f, mode="wb", compresslevel=1) as dst:
+            for chunk in iter_stored(record):
+                dst.write(chunk)
+
+    write_atomically(target, compress)
+    if not move_storage(
+        row["filename"],
+        path,
+        target,
+        COLD_STORAGE,
+        row["checksum"],
+        row["upload_timestamp"],
+    ):
+        os.remove(target)
+        return False
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+    return True
+
+
+def promote(record):
+    """
+    Bring a cold file back to the hot volume, as a plain file, and return its
+    fresh `lookup_file` record. Other records are returned as they are.
+    """
+    _, filename, path, checksum, storage = record
+    if storage != COLD_STORAGE:
+        return record
+    target = os.path.join(file_directory, filename)
+
+    def decompress(f):
+        with gzip.open(path, "rb") as src:
+            shutil.copyfileobj(src, f, CHUNK_SIZE)
+
+    try:
+        write_atomically(target, decompress)
+    except FileNotFoundError:
+        # Promoted by a concurrent request, which also removed the cold copy.
+        return lookup_file(filename, False)
+    if move_storage(filename, path, target, None, checksum):
+        os.remove(path)
+        # Make the access that promoted it count before the quota is enforced.
+        flush_accesses()
+        tierer.schedule()
+    return lookup_file(filename, False)
+
+
+def iter_stored(record):
+    """
+    Yield the content of a `lookup_file` record, decompressing cold files in
+    place rather than promoting them.
+    """
+    if record[4] in ENCODINGS:
+        yield from iter_decoded(stored_segments(record), record[4])
+        return
+    if record[4] != COLD_STORAGE:
+        yield from iter_segments(stored_segments(record))
+        return
+    with gzip.open(record[2], "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            yield chunk
+
+
+def enforce_quota(quota=DISK_QUOTA):
+    """
+    Move the coldest files off the hot volume while it is over `quota`.
+    Nothing moves when the candidates cannot bring it under the low
+    watermark, as they would only be read back in. Returns the filenames
+    moved.
+    """
+    usage = hot_usage()
+    if not quota or usage <= quota:
+        return []
+    target = quota * LOW_WATERMARK
+    candidates = eviction_order(tiering_candidates())
+    movable = sum(row["size"] or 0 for row in candidates)
+    demoted = []
+    for row in candidates:
+        if usage <= target or usage - movable > target:
+            break
+        movable -= row["size"] or 0
+        if demote(row):
+            usage -= row["size"] or 0
+            demoted.append(row["filename"])
+    if usage > target:
+        logger.warning(
+            "Hot usage of %d bytes stays over the quota's low watermark", usage
+        )
+    return demoted
+
+
+class QuotaEnforcer:
+    """Runs `enforce_quota` on a daemon thread whenever it is scheduled."""
+
+    def __init__(self):
+        self._wanted = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def schedule(self):
+        if not DISK_QUOTA:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="quota-enforcer", daemon=True
+                )
+                self._thread.start()
+        self._wanted.set()
+
+    def _run(self):
+        while self._wanted.wait():
+            self._wanted.clear()
+            try:
+                enforce_quota()
+            except OSError:
+                logger.exception("Enforcing the disk quota failed")
+
+
+tierer = QuotaEnforcer()
@@ -1,57 +1,281 @@
-import asyncio
 import hashlib
 import os
-from concurrent.futures import ThreadPoolExecutor
+import shutil
+import tempfile
+from collections import namedtuple
+from contextlib import ExitStack, nullcontext
 
-import aiosqlite
-
-# TODO: Consider use more sustainable way to handle async
 CHUNK_SIZE = 5 * 1024 * 1024
-DB_NAME = "metadata.db"
 file_directory = "files/"
+# Content-addressed chunks, stored once each as objects/<first 2 hex>/<sha256>.
+object_directory = os.path.join(file_directory, "objects")
+# Compressed copies of files moved off the hot volume.
+cold_directory = os.getenv("COLD_DIRECTORY", "cold/")
 
+# Files that failed an integrity check are moved here when quarantining.
+quarantine_directory = os.getenv("QUARANTINE_DIRECTORY", "quarantine/")
 
-def get_path_sync(identifier, is_id):
-    """Synchronously wrapper function to get file path for given identifier."""
+# A run of `length` bytes stored at `offset` in the file at `path`.
+Segment = namedtuple("Segment", "path offset length")
 
-    async def get_path_async(identifier, is_id):
-        if is_id:
-            query = "SELECT path FROM metadata WHERE id = ?"
-        else:
-            query = "SELECT path FROM metadata WHERE filename = ?"
-        async with aiosqlite.connect(DB_NAME) as db:
-            async with db.execute(query, (identifier,)) as cursor:
-                row = await cursor.fetchone()
-                if row:
-                    return row[0]
-                return None
 
-    with ThreadPoolExecutor() as executor:
-        future = executor.submit(asyncio.run, get_path_async(identifier, is_id))
-        return future.result()
+def part_number(filename):
+    """Numeric index of a `<name>.partN` chunk file."""
+    return int(filename.rsplit(".part", 1)[1])
 
 
-def generate_file_stream(path):
-    """Generate a file stream from the given path."""
+def list_chunk_parts(path):
+    """Paths of the chunk files in `path`, ordered by part number."""
+    names = [
+        name
+        for name in os.listdir(path)
+        if ".part" in name and name.rsplit(".part", 1)[1].isdigit()
+    ]
+    return [os.path.join(path, name) for name in sorted(names, key=part_number)]
+
+
+def copy_file_data(src, dst):
+    """
+    Append all of `src` to `dst` (open binary files), letting the kernel move
+    the bytes where possible.
+    """
+    size = os.fstat(src.fileno()).st_size
+    offset = 0
+    for copy in (_copy_file_range, _sendfile):
+        try:
+            while offset < size:
+                copied = copy(src.fileno(), dst.fileno(), offset, size - offset)
+                if copied == 0:
+                    break
+                offset += copied
+            if offset == size:
+                return size
+        except (AttributeError, OSError):
+            # Not supported for this platform or filesystem; try the next way.
+            pass
+    src.seek(offset)
+    dst.seek(0, os.SEEK_END)
+    shutil.copyfileobj(src, dst, CHUNK_SIZE)
+    return size
+
+
+def _copy_file_range(src_fd, dst_fd, offset, count):
+    return os.copy_file_range(src_fd, dst_fd, count, offset)
+
+
+def _sendfile(src_fd, dst_fd, offset, count):
+    return os.sendfile(dst_fd, src_fd, offset, count)
+
+
+def assemble_parts(parts, path):
+    """Concatenate chunk files, in the given order, into a single file at `path`."""
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as dst:
+        for part in parts:
+            with open(part, "rb") as src:
+                copy_file_data(src, dst)
+    os.replace(temp_path, path)
+
+
+def file_segments(path):
+    """The segments that make up a stored file or `_chunks` directory, in order."""
     if os.path.isdir(path):
-        for filename in sorted(os.listdir(path)):
-            chunk_path = os.path.join(path, filename)
-            with open(chunk_path, "rb") as file:
-                while chunk := file.read(CHUNK_SIZE):
-                    yield chunk
+        parts = list_chunk_parts(path)
     else:
-        with open(path, "rb") as file:
-            while chunk := file.read(CHUNK_SIZE):
-                yield chunk
+        parts = [path]
+    return [Segment(part, 0, os.path.getsize(part)) for part in parts]
+
+
+def object_path(chunk_hash):
+    """Where the content-addressed chunk with SHA-256 `chunk_hash` is stored."""
+    return os.path.join(object_directory, chunk_hash[:2], chunk_hash)
+
+
+def cold_path(filename):
+    """Where the compressed copy of a file moved to the cold tier is kept."""
+    return os.path.join(cold_directory, f"{filename}.gz")
+
+
+def open_segments(segments):
+    """
+    Open the files of `segments` now, keyed by path, so that they can still be
+    read by `iter_segments` after they are removed.
+    """
+    files = {}
+    with ExitStack() as stack:
+        for segment in segments:
+            if segment.path not in files:
+                files[segment.path] = stack.enter_context(open(segment.path, "rb"))
+        # Opened them all: they are the caller's to close from here on.
+        stack.pop_all()
+    return files
+
+
+def close_files(files):
+    for file in files.values():
+        file.close()
+
+
+def iter_segments(segments, start=0, stop=None, buffer_size=CHUNK_SIZE, files=None):
+    """
+    Yield the bytes in [start, stop) of the concatenation of `segments`. The
+    files in `files`, from `open_segments`, are read instead of opening their
+    paths, and closed once done.
+    """
+    position = 0
+    try:
+        for segment in segments:
+            segment_start = position
+            position += segment.length
+            if stop is not None and segment_start >= stop:
+                break
+            if position <= start:
+                continue
+            skip = max(start - segment_start, 0)
+            remaining = segment.length - skip
+            if stop is not None:
+                remaining = min(remaining, stop - segment_start - skip)
+            offset = segment.offset + skip
+            opened = files.get(segment.path) if files else None
+            with nullcontext(opened) if opened else open(segment.path, "rb") as file:
+                # Positioned reads: packed files are a slice of a shared segment.
+                while remaining > 0:
+                    chunk = os.pread(file.fileno(), min(buffer_size, remaining), offset)
+                    if not chunk:
+                        break
+                    offset += len(chunk)
+                    remaining -= len(chunk)
+                    yield chunk
+    finally:
+        if files:
+            close_files(files)
+
+
+def generate_file_stream(path):
+    """Generate a file stream from the given path."""
+    return iter_segments(file_segments(path))
+
+
+class ChunkHasher:
+    """
+    SHA-256 of each consecutive `chunk_size` run of the bytes fed to it,
+    whatever sizes they arrive in.
+    """
+
+    def __init__(self, chunk_size=CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.chunks = []
+        self._sha256 = None
+        self._filled = 0
+
+    def update(self, data):
+        view = memoryview(data)
+        while view:
+            if self._sha256 is None:
+                self._sha256 = hashlib.sha256()
+                self._filled = 0
+            take = min(len(view), self.chunk_size - self._filled)
+            self._sha256.update(view[:take])
+            self._filled += take
+            view = view[take:]
+            if self._filled == self.chunk_size:
+                self._finish_chunk()
+
+    def _finish_chunk(self):
+        self.chunks.append((self._filled, self._sha256.hexdigest()))
+        self._sha256 = None
+
+    def digests(self):
+        """(size, sha256) of each chunk, the last one possibly shorter."""
+        if self._sha256 is not None:
+            self._finish_chunk()
+        return self.chunks
+
+
+def read_at_most(stream, size):
+    """Read from `stream` until `size` bytes or its end, whichever comes first."""
+    data = bytearray()
+    while len(data) < size and (chunk := stream.read(size - len(data))):
+        data += chunk
+    return bytes(data)
+
+
+class PrefixedStream:
+    """A readable stream of `prefix` followed by the rest of `stream`."""
+
+    def __init__(self, prefix, stream):
+        self.prefix = memoryview(prefix)
+        self.stream = stream
+
+    def read(self, size=-1):
+        if not self.prefix:
+            return self.stream.read(size)
+        if size is None or size < 0:
+            data = bytes(self.prefix) + self.stream.read()
+            self.prefix = self.prefix[:0]
+            return data
+        data = bytes(self.prefix[:size])
+        self.prefix = self.prefix[size:]
+        return data
+
+
+class ChecksumMismatch(ValueError):
+    """Received data does not hash to the checksum declared for it."""
+
+
+def save_stream(
+    stream, path, expected_checksum=None, buffer_size=CHUNK_SIZE, chunk_hasher=None
+):
+    """
+    Write a readable stream to `path` in large buffers, hashing it in the same
+    pass, and return its size and SHA-256. A `chunk_hasher` is fed the same
+    bytes to hash each chunk too.
+
+    Data goes to a temporary sibling first so a reader never sees a partial
+    file, and `path` is left untouched if `expected_checksum` does not match.
+    """
+    fd, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path) or ".", prefix=".upload-", suffix=".tmp"
+    )
+    sha256 = hashlib.sha256()
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as f:
+            while chunk := stream.read(buffer_size):
+                sha256.update(chunk)
+                if chunk_hasher is not None:
+                    chunk_hasher.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+        checksum = sha256.hexdigest()
+        if expected_checksum and expected_checksum.lower() != checksum:
+            raise ChecksumMismatch(
+                f"Received data has checksum {checksum}, "
+                f"expected {expected_checksum}"
+            )
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return size, checksum
 
 
 def verify_checksum(file_path, expected_checksum):
     return calculate_checksum(file_path) == expected_checksum
 
 
+def hash_parts(path):
+    """(size, sha256) of each chunk file of a `_chunks` directory, in order."""
+    return [
+        (os.path.getsize(part), calculate_checksum(part))
+        for part in list_chunk_parts(path)
+    ]
+
+
 def calculate_checksum(file_path):
     sha256_hash = hashlib.sha256()
     with open(file_path, "rb") as f:
-        for byte_block in iter(lambda: f.read(4096), b""):
+        for byte_block in iter(lambda: f.read(1024 * 1024), b""):
             sha256_hash.update(byte_block)
     return sha256_hash.hexdigest()